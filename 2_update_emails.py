@@ -1,62 +1,86 @@
-from utils.rules_and_actions import process_rule, process_action
+from utils.rule_engine import load_rules, get_rule_conditions, merge_actions
+from utils.action_planner import ActionPlanner
 from entities.db.googledb import GoogleDB
 from entities.google.gmail import GmailService
 import json
+import sys
 
 rule_location = "config/rule.json"
 
 
-def get_rule_and_action():
+def get_rules():
     with open(rule_location, "r") as file:
         file_content = json.load(file)
 
-    return file_content["rule"], file_content["action"]
+    return load_rules(file_content)
 
 
-def get_message_ids_by_rule(rule):
-    condition = process_rule(rule)
-    if condition:
-        condition = "where " + condition
-    else:
-        condition = ""
-    db = GoogleDB()
-    message_ids = db.get_message_ids_by_condition(
-        condition,
-        onSuccess=lambda result: [record[0] for record in result],
-        onError=lambda error: print("Error getting message ids", error),
-    )
-    if len(message_ids) == 0:
-        print("No message ids found")
-        return
-    return message_ids
+def get_rule_conditions_to_run(rules):
+    conditions = get_rule_conditions(rules)
+    for rule, condition in zip(rules, conditions):
+        if condition == "false":
+            print(f"{rule['name']}: can never match, skipped")
+    if all(condition == "false" for condition in conditions):
+        return None
+    return conditions
 
 
-def message_id_chunks(message_ids, chunk_size=100):
-    n = len(message_ids)
-    for i in range(0, n, chunk_size):
-        yield message_ids[i : min(i + chunk_size, n)]
+def make_the_actions(rules, conditions, logout=False):
+    db = GoogleDB()
+    gmail = GmailService()
 
+    def update_local_labels(add_labels, remove_labels, message_ids):
+        db.apply_label_changes(
+            message_ids,
+            add_labels,
+            remove_labels,
+            onError=lambda error: print("Error updating local labels", error),
+        )
 
-def make_the_action(message_ids, action):
-    add_labels, remove_labels = process_action(action)
-    gmail = GmailService()
-    print("Making the action...")
-    for chunk in message_id_chunks(message_ids, 100):
-        gmail.bulk_modify_message_labels(chunk, add_labels, remove_labels)
-    print("Action made... Logging out...")
-    gmail.logout()
+    matched = [0] * len(rules)
+    total = changed = 0
+    print("Making the actions...")
+    # Matches are streamed from the database, and full batchModify calls go out
+    # while the query is still returning rows
+    with ActionPlanner(gmail, onSuccess=update_local_labels) as planner:
+        try:
+            for matches in db.stream_rule_matches(
+                conditions, batch_size=planner.batch_size
+            ):
+                for _, rule_indexes, _ in matches:
+                    for index in rule_indexes:
+                        matched[index] += 1
+                total += len(matches)
+                # Messages already labelled the way the rules want are left out
+                changes = merge_actions(matches, rules)
+                changed += len(changes)
+                planner.add_changes(changes)
+        except Exception as e:
+            print("Error getting message ids", e)
+
+    for rule, count in zip(rules, matched):
+        print(f"{rule['name']}: {count} messages matched")
+    print(f"{changed} of {total} messages needed label changes")
+    print(
+        f"Modified {planner.modified} messages in {planner.calls} calls"
+        f" ({planner.failed} failed)..."
+    )
+    if logout:
+        print("Logging out...")
+        gmail.logout()
 
 
-def main():
-    rule, action = get_rule_and_action()
-    print("Rule and action fetched...")
-    message_ids = get_message_ids_by_rule(rule)
-    if message_ids:
-        print("Message ids fetched...")
-        make_the_action(message_ids, action)
+def main(logout=False):
+    rules = get_rules()
+    print(f"{len(rules)} rules fetched...")
+    if not rules:
+        return
+    conditions = get_rule_conditions_to_run(rules)
+    if conditions:
+        make_the_actions(rules, conditions, logout)
 
 
 if __name__ == "__main__":
     print("Starting script...")
-    main()
+    main(logout="--logout" in sys.argv[1:])
     print("Script completed...")
@@ -0,0 +1,81 @@
+import json
+import os
+import signal
+import threading
+from dotenv import load_dotenv
+from entities.google import GmailService
+from entities.db import GoogleDB
+from utils.daemon import RuleDaemon, serve_metrics
+from utils.notifications import PollingNotifier, PushNotifier
+from utils.rule_engine import load_rules
+
+load_dotenv()
+
+rule_location = "config/rule.json"
+
+
+def get_rules():
+    with open(rule_location, "r") as file:
+        file_content = json.load(file)
+
+    return load_rules(file_content)
+
+
+def get_notifier(gmail):
+    if os.getenv("DAEMON_NOTIFIER", "poll") == "push":
+        return PushNotifier(port=int(os.getenv("DAEMON_PUSH_PORT", "8080")))
+    return PollingNotifier(gmail, float(os.getenv("DAEMON_POLL_INTERVAL", "1")))
+
+
+def main():
+    rules = get_rules()
+    print(f"{len(rules)} rules fetched...")
+    if not rules:
+        return
+
+    gmail = GmailService()
+    gmail.authenticate(keep_fresh=True)
+    db = GoogleDB(pool_size=int(os.getenv("DB_POOL_SIZE", "0")) or 4)
+    daemon = RuleDaemon(
+        gmail,
+        db,
+        rules,
+        get_notifier(gmail),
+        watch_topic=os.getenv("DAEMON_PUBSUB_TOPIC") or None,
+    )
+
+    metrics_port = int(os.getenv("DAEMON_METRICS_PORT", "0"))
+    metrics_server = serve_metrics(daemon, port=metrics_port) if metrics_port else None
+
+    def shutdown(*_):
+        print("Stopping the daemon...")
+        daemon.stop()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    report_interval = float(os.getenv("DAEMON_REPORT_INTERVAL", "300"))
+    stopped = threading.Event()
+
+    def report():
+        while not stopped.wait(report_interval):
+            daemon.report()
+
+    threading.Thread(target=report, daemon=True).start()
+    try:
+        daemon.run()
+    finally:
+        stopped.set()
+        daemon.report()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        if daemon.watch_topic:
+            gmail.stop_watch()
+        gmail.close()
+        db.close()
+
+
+if __name__ == "__main__":
+    print("Starting daemon...")
+    main()
+    print("Daemon stopped...")
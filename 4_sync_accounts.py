@@ -0,0 +1,60 @@
+import json
+import os
+import signal
+import sys
+import threading
+from dotenv import load_dotenv
+from utils.accounts import gmail_for, load_accounts
+from utils.coordinator import SyncCoordinator
+
+load_dotenv()
+
+accounts_location = "config/accounts.json"
+
+
+def get_accounts(location):
+    with open(location, "r") as file:
+        file_content = json.load(file)
+
+    return load_accounts(file_content)
+
+
+def authorize(accounts):
+    # The browser flow cannot run in a worker process, so every account is
+    # signed in here once and the workers only ever refresh stored tokens
+    for account in accounts:
+        print(f"Signing in {account['name']}...")
+        gmail_for(account).authenticate()
+
+
+def main(args):
+    paths = [arg for arg in args if not arg.startswith("--")]
+    accounts = get_accounts(paths[0] if paths else accounts_location)
+    print(f"{len(accounts)} accounts fetched...")
+    if not accounts:
+        return
+
+    if "--authorize" in args:
+        authorize(accounts)
+        return
+
+    interval = float(os.getenv("SYNC_INTERVAL", "0"))
+    stop = threading.Event()
+
+    def shutdown(*_):
+        print("Stopping after this round...")
+        stop.set()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    with SyncCoordinator(accounts) as coordinator:
+        coordinator.run_round(full="--full" in args)
+        if interval:
+            coordinator.run(interval, stop)
+
+
+if __name__ == "__main__":
+    print("Starting script...")
+    main(sys.argv[1:])
+    print("Done! Thanks for your patience...")
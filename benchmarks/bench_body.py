@@ -0,0 +1,48 @@
+"""
+Compare the body extraction strategies of get_email_body on a mix of regular
+emails and multi-megabyte newsletters.
+
+    python -m benchmarks.bench_body [messages] [max_length]
+"""
+
+import sys
+import time
+import tracemalloc
+from benchmarks.corpus import make_corpus
+from utils.gmail import get_email_body
+
+
+def _measure(corpus, strategy, max_length):
+    tracemalloc.start()
+    started = time.perf_counter()
+    stored = 0
+    for message in corpus:
+        body = get_email_body(message["payload"], strategy, max_length)
+        stored += len(body or "")
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, stored
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    max_length = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    # One in ten messages is a newsletter with about 3MB of HTML
+    corpus = make_corpus(count - count // 10) + make_corpus(
+        count // 10, paragraphs=40, html_padding=100000, seed=7
+    )
+    print(f"{len(corpus)} messages, {count // 10} of them multi-megabyte newsletters")
+    print(f"{'strategy':<22} {'ms/message':>10} {'peak MB':>8} {'stored chars':>13}")
+    for strategy in ["html2text", "strip", "plain"]:
+        for limit in [0, max_length]:
+            elapsed, peak, stored = _measure(corpus, strategy, limit)
+            label = f"{strategy} (cap {limit})" if limit else strategy
+            print(
+                f"{label:<22} {elapsed * 1000 / len(corpus):>10.2f} "
+                f"{peak / 2**20:>8.1f} {stored:>13}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""
+Compare single-process parsing with the process pool of parse_messages_parallel.
+
+    python -m benchmarks.bench_parse [messages] [max_workers]
+"""
+
+import os
+import sys
+import time
+from benchmarks.corpus import make_corpus
+from utils.gmail import get_required_data, parse_messages_parallel
+
+
+def _timed(label, parse, corpus):
+    started = time.perf_counter()
+    rows = parse(corpus)
+    elapsed = time.perf_counter() - started
+    rate = len(rows) / elapsed
+    print(f"{label:<24} {len(rows):>6} messages {elapsed:>7.2f}s {rate:>9.1f} msg/s")
+    return elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else (os.cpu_count() or 1)
+    corpus = make_corpus(count)
+    print(f"Parsing {count} synthetic multipart messages")
+
+    baseline = _timed(
+        "single process", lambda c: [get_required_data(m) for m in c], corpus
+    )
+    workers = 1
+    while workers <= max_workers:
+        elapsed = _timed(
+            f"{workers} worker processes",
+            lambda c: list(parse_messages_parallel(c, workers=workers)),
+            corpus,
+        )
+        print(f"{'':<24} speedup {baseline / elapsed:.2f}x")
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Sustained fetch throughput against the fake Gmail server enforcing a per-user
+quota, with and without the rate limiter.
+
+    python -m benchmarks.bench_quota [messages] [quota units per second]
+
+Without the limiter the fetch runs into the quota, backs off and idles; with
+it the fetch is paced just under the quota.
+"""
+
+import sys
+import time
+from entities.google import GmailService
+from entities.google.ratelimit import RateLimiter
+from fake_gmail import FakeGmailServer, make_message
+
+
+def _run(messages, quota, limited):
+    server = FakeGmailServer([make_message(f"m{i}") for i in range(messages)])
+    with server:
+        server.quota = quota
+        gmail = GmailService()
+        gmail.service = server.build_service()
+        gmail.page_size = 500
+        gmail.backoff_base = 0.25
+        gmail.max_retries = 10
+        gmail.rate_limiter = RateLimiter(units_per_second=quota if limited else 0)
+        started = time.monotonic()
+        fetched = sum(
+            1 for _ in gmail.messages_list(remainingMessages=messages, batched=True)
+        )
+        seconds = time.monotonic() - started
+        return fetched, seconds, server.units_served / seconds, server.quota_rejected
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 1500
+    quota = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    print(f"{'':<16} {'messages':>9} {'time':>8} {'units/s':>9} {'429s':>6}")
+    for limited, label in [(False, "no limiter"), (True, "rate limiter")]:
+        fetched, seconds, rate, rejected = _run(messages, quota, limited)
+        print(
+            f"{label:<16} {fetched:>9} {seconds:>7.1f}s {rate:>9.0f} {rejected:>6}"
+        )
+    print(f"quota: {quota} units/s")
+
+
+if __name__ == "__main__":
+    main()
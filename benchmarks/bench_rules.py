@@ -0,0 +1,39 @@
+"""
+Compare compiling a rule on every evaluation with the compiled-rule cache.
+
+    python -m benchmarks.bench_rules [evaluations]
+"""
+
+import json
+import sys
+import time
+from utils.message_index import compile_rule
+from utils.rule_cache import CompiledRuleCache
+from utils.rules_and_actions import process_rule
+
+with open("config/rule.json", "r") as file:
+    config = json.load(file)
+rule = config["rules"][0]["rule"] if "rules" in config else config["rule"]
+
+
+def _timed(label, compile_once, evaluations):
+    started = time.perf_counter()
+    for _ in range(evaluations):
+        compile_once()
+    elapsed = time.perf_counter() - started
+    print(f"{label:<28} {elapsed / evaluations * 1e6:>8.2f} us per rule")
+
+
+def main():
+    evaluations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    cache = CompiledRuleCache()
+    print(f"Compiling config/rule.json {evaluations} times")
+    _timed("process_rule", lambda: process_rule(rule), evaluations)
+    _timed("cached process_rule", lambda: cache.get(rule, process_rule), evaluations)
+    _timed("compile_rule", lambda: compile_rule(rule), evaluations)
+    _timed("cached compile_rule", lambda: cache.get(rule, compile_rule), evaluations)
+    print(cache)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Time from process start to the first Gmail API call, against the fake Gmail
+server, with a fresh stored token and a cached discovery document.
+
+    python -m benchmarks.bench_startup [runs]
+
+Each run is a new interpreter. The "eager imports" rows load the Google
+client libraries up front, the way entities.google used to.
+"""
+
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from fake_gmail import FakeGmailServer, make_message
+
+child = """
+import json, sys, time
+started = float(sys.argv[1])
+if sys.argv[2] == "eager":
+    import google_auth_oauthlib.flow, google.auth.transport.requests
+    import googleapiclient.discovery, google_auth_httplib2
+from entities.google import GmailService
+imported = time.time()
+gmail = GmailService()
+gmail.authenticate()
+authenticated = time.time()
+gmail.get_profile()
+called = time.time()
+timings = [imported - started, authenticated - imported, called - authenticated]
+print(json.dumps(timings))
+"""
+
+
+def _prepare(directory, root_url):
+    from googleapiclient.discovery_cache import get_static_doc
+
+    expiry = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+    token = {
+        "token": "token",
+        "refresh_token": "refresh",
+        "client_id": "client",
+        "client_secret": "secret",
+        "expiry": expiry.strftime("%Y-%m-%dT%H:%M:%SZ"),
+    }
+    with open(os.path.join(directory, "token.json"), "w") as file:
+        json.dump(token, file)
+    document = json.loads(get_static_doc("gmail", "v1"))
+    document["rootUrl"] = root_url
+    with open(os.path.join(directory, "gmail.v1.json"), "w") as file:
+        json.dump(document, file)
+
+
+def _run(mode, env):
+    started = time.time()
+    output = subprocess.run(
+        [sys.executable, "-c", child, str(started), mode],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    server = FakeGmailServer([make_message("m0")])
+    with server, tempfile.TemporaryDirectory() as directory:
+        _prepare(directory, server.root_url)
+        env = dict(
+            os.environ,
+            GOOGLE_TOKEN_PATH=os.path.join(directory, "token.json"),
+            GOOGLE_DISCOVERY_CACHE_DIR=directory,
+        )
+        print(f"{'':<16} {'import':>9} {'auth':>9} {'1st call':>9} {'total':>9}")
+        for mode, label in [("lazy", "lazy imports"), ("eager", "eager imports")]:
+            timings = sorted((_run(mode, env) for _ in range(runs)), key=sum)
+            imported, authenticated, called = timings[len(timings) // 2]
+            total = imported + authenticated + called
+            print(
+                f"{label:<16} {imported * 1000:>7.0f}ms {authenticated * 1000:>7.0f}ms"
+                f" {called * 1000:>7.0f}ms {total * 1000:>7.0f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Synthetic Gmail messages for the benchmarks."""
+
+import base64
+import random
+
+WORDS = (
+    "invoice meeting schedule newsletter offer travel booking review account "
+    "update security alert weekly digest project deadline report family photo "
+    "discount receipt order shipped delivery subscription renewal"
+).split()
+
+
+def _encode(text):
+    return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii")
+
+
+def _paragraphs(rng, count):
+    return [
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 60)))
+        for _ in range(count)
+    ]
+
+
+def _html(paragraphs, padding):
+    rows = "".join(
+        f'<tr><td style="padding:4px;font-family:Arial"><p>{text}</p></td></tr>'
+        for text in paragraphs
+    )
+    filler = "<div><span>&nbsp;</span></div>" * padding
+    return (
+        "<html><head><style>td { color: #333; }</style>"
+        "<script>var tracking = 1;</script></head>"
+        f"<body><table>{rows}</table>{filler}"
+        '<a href="https://example.com/unsubscribe">Unsubscribe</a></body></html>'
+    )
+
+
+def make_corpus(count=500, paragraphs=8, html_padding=200, seed=42):
+    """
+    Build `count` multipart/mixed messages shaped like Gmail's full format:
+    a multipart/alternative body with text/plain and text/html parts, plus
+    an attachment part without inline data.
+
+    Args:
+        count: Number of messages
+        paragraphs: Paragraphs of text per message
+        html_padding: Number of empty layout elements padding each HTML part,
+            to mimic the markup heavy bodies of newsletters
+        seed: Random seed, so runs compare the same corpus
+    """
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(count):
+        text = _paragraphs(rng, paragraphs)
+        corpus.append(
+            {
+                "id": f"bench{i}",
+                "threadId": f"bench{i}",
+                "labelIds": ["INBOX", "CATEGORY_PROMOTIONS"],
+                "internalDate": str(1700000000000 + i * 1000),
+                "payload": {
+                    "mimeType": "multipart/mixed",
+                    "headers": [
+                        {"name": "From", "value": f"News <news{i % 50}@example.com>"},
+                        {"name": "To", "value": "Me <me@example.com>"},
+                        {"name": "Subject", "value": " ".join(text[0].split()[:6])},
+                    ],
+                    "parts": [
+                        {
+                            "mimeType": "multipart/alternative",
+                            "parts": [
+                                {
+                                    "mimeType": "text/plain",
+                                    "body": {"data": _encode("\n\n".join(text))},
+                                },
+                                {
+                                    "mimeType": "text/html",
+                                    "body": {"data": _encode(_html(text, html_padding))},
+                                },
+                            ],
+                        },
+                        {
+                            "mimeType": "application/pdf",
+                            "filename": "invoice.pdf",
+                            "body": {"attachmentId": f"att{i}", "size": 20480},
+                        },
+                    ],
+                },
+            }
+        )
+    return corpus
@@ -1,5 +1,8 @@
 create schema gmail authorization username;
 
+-- Trigram indexes let "contains" rules (ilike '%value%') use an index
+create extension if not exists pg_trgm;
+
 create table gmail.messages (
     message_id text,
     thread_id text,
@@ -8,9 +11,33 @@ create table gmail.messages (
     subject text,
     body text,
     received_at timestamptz,
-    PRIMARY KEY (message_id)
+    -- Mailbox the message belongs to, see config/accounts.json
+    account text not null default 'default',
+    -- Message ids are only unique within a mailbox
+    PRIMARY KEY (account, message_id)
 );
 
+-- Rules are matched within one account
+create index messages_account_idx
+on gmail.messages (account);
+
+create index messages_from_address_trgm_idx
+on gmail.messages using gin (from_address gin_trgm_ops);
+
+create index messages_subject_trgm_idx
+on gmail.messages using gin (subject gin_trgm_ops);
+
+create index messages_body_trgm_idx
+on gmail.messages using gin (body gin_trgm_ops);
+
+-- "received_at" rules are range comparisons
+create index messages_received_at_idx
+on gmail.messages (received_at);
+
+-- "from_address" is / is_not rules compare lower(from_address)
+create index messages_lower_from_address_idx
+on gmail.messages (lower(from_address));
+
 create table gmail.labels (
     label text,
     PRIMARY KEY (label)
@@ -33,15 +60,41 @@ values ('INBOX'),
     ('DRAFT');
 
 create table gmail.message_labels (
+    account text not null default 'default',
     message_id text,
     label text,
-    PRIMARY KEY (message_id, label)
+    PRIMARY KEY (account, message_id, label)
 );
 
+-- The primary key only serves lookups by message, this one serves label -> messages
+create index message_labels_label_idx
+on gmail.message_labels (label, account, message_id);
+
 alter table gmail.message_labels
 add constraint message_labels_fk_message_id 
-foreign key (message_id) references gmail.messages(message_id);
+foreign key (account, message_id) references gmail.messages(account, message_id);
 
 alter table gmail.message_labels
 add constraint message_labels_fk_label 
 foreign key (label) references gmail.labels(label);
+
+-- Checkpoints for incremental sync, keyed by account
+create table gmail.sync_state (
+    sync_key text,
+    history_id text,
+    updated_at timestamptz default now(),
+    PRIMARY KEY (sync_key)
+);
+
+-- Progress of an unfinished full sync, keyed by account
+create table gmail.full_sync_progress (
+    sync_key text,
+    -- Mailbox history id when the full sync started
+    history_id text,
+    -- Next listing page to fetch, null once every page was listed
+    page_token text,
+    -- Messages listed before page_token, all stored
+    messages bigint default 0,
+    updated_at timestamptz default now(),
+    PRIMARY KEY (sync_key)
+);
@@ -0,0 +1,6 @@
+# Applies every migration of migrations/ in order to an existing database.
+# Migrations are idempotent, so running this again is safe.
+for migration in migrations/*.sql; do
+    echo "Applying $migration"
+    psql googledb -U username -h localhost -p 5432 -v ON_ERROR_STOP=1 -f "$migration" || exit 1
+done
@@ -0,0 +1,7 @@
+-- Checkpoints for incremental sync, keyed by sync name
+create table if not exists gmail.sync_state (
+    sync_key text,
+    history_id text,
+    updated_at timestamptz default now(),
+    PRIMARY KEY (sync_key)
+);
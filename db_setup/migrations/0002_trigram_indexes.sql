@@ -0,0 +1,11 @@
+-- Trigram indexes let "contains" rules (ilike '%value%') use an index
+create extension if not exists pg_trgm;
+
+create index if not exists messages_from_address_trgm_idx
+on gmail.messages using gin (from_address gin_trgm_ops);
+
+create index if not exists messages_subject_trgm_idx
+on gmail.messages using gin (subject gin_trgm_ops);
+
+create index if not exists messages_body_trgm_idx
+on gmail.messages using gin (body gin_trgm_ops);
@@ -0,0 +1,11 @@
+-- "received_at" rules are range comparisons
+create index if not exists messages_received_at_idx
+on gmail.messages (received_at);
+
+-- "from_address" is / is_not rules compare lower(from_address)
+create index if not exists messages_lower_from_address_idx
+on gmail.messages (lower(from_address));
+
+-- The primary key only serves lookups by message, this one serves label -> messages
+create index if not exists message_labels_label_idx
+on gmail.message_labels (label, message_id);
@@ -0,0 +1,9 @@
+-- Messages of several mailboxes share the tables, each row names its own.
+-- Rows stored before this migration belong to the "default" account, the
+-- one the single-mailbox scripts sync.
+alter table gmail.messages
+add column if not exists account text not null default 'default';
+
+-- Rules are matched within one account
+create index if not exists messages_account_idx
+on gmail.messages (account);
@@ -0,0 +1,14 @@
+-- Progress of an unfinished full sync, so a restarted one resumes from the
+-- last listing page whose messages were all stored instead of starting over
+create table if not exists gmail.full_sync_progress (
+    sync_key text,
+    -- Mailbox history id when the full sync started, the incremental sync
+    -- that follows it replays every change made since
+    history_id text,
+    -- Next listing page to fetch, null once every page was listed
+    page_token text,
+    -- Messages listed before page_token, all stored
+    messages bigint default 0,
+    updated_at timestamptz default now(),
+    PRIMARY KEY (sync_key)
+);
@@ -0,0 +1,35 @@
+-- Message ids are only unique within a mailbox, so messages and their labels
+-- are keyed by (account, message_id). Labels take the account of the message
+-- they belong to.
+alter table gmail.message_labels
+add column if not exists account text not null default 'default';
+
+update gmail.message_labels ml
+set account = m.account
+from gmail.messages m
+where m.message_id = ml.message_id and ml.account <> m.account;
+
+alter table gmail.message_labels
+drop constraint if exists message_labels_fk_message_id;
+
+alter table gmail.message_labels
+drop constraint if exists message_labels_pkey;
+
+alter table gmail.messages
+drop constraint if exists messages_pkey;
+
+alter table gmail.messages
+add constraint messages_pkey primary key (account, message_id);
+
+alter table gmail.message_labels
+add constraint message_labels_pkey primary key (account, message_id, label);
+
+alter table gmail.message_labels
+add constraint message_labels_fk_message_id
+foreign key (account, message_id) references gmail.messages(account, message_id);
+
+-- Serves label -> messages lookups within an account
+drop index if exists gmail.message_labels_label_idx;
+
+create index message_labels_label_idx
+on gmail.message_labels (label, account, message_id);
@@ -1,3 +1,4 @@
 from .googledb import GoogleDB
+from .writer import BufferedEmailWriter
 
-__all__ = ["GoogleDB"]
+__all__ = ["GoogleDB", "BufferedEmailWriter"]
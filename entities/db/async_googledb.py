@@ -0,0 +1,310 @@
+import asyncio
+import os
+from datetime import datetime
+import asyncpg
+from dotenv import load_dotenv
+from .googledb import (
+    gmail_message_fields,
+    prepared_statements,
+    create_staging_tables,
+    merge_staged_emails,
+    _rule_matches_query,
+)
+
+load_dotenv()
+
+
+def _rowcount(status):
+    # asyncpg returns the command tag, e.g. "INSERT 0 3"
+    count = status.split()[-1]
+    return int(count) if count.isdigit() else 0
+
+
+class AsyncGoogleDB:
+    """
+    asyncio counterpart of GoogleDB on an asyncpg connection pool.
+
+    Methods are coroutines with the same arguments and callbacks as their
+    GoogleDB namesakes and run the same SQL. asyncpg prepares and caches
+    every statement per connection, so repeated calls only send parameters.
+    At most `pool_size` queries run at once, other callers wait for a free
+    connection.
+
+    Args:
+        pool_size: Maximum number of connections
+    """
+
+    def __init__(
+        self,
+        host=None,
+        port=None,
+        user=None,
+        password=None,
+        dbname=None,
+        pool_size=None,
+        account=None,
+    ):
+        self.connection_config = {
+            "host": host or os.getenv("POSTGRES_HOST"),
+            "port": port or os.getenv("POSTGRES_PORT"),
+            "user": user or os.getenv("POSTGRES_USER"),
+            "password": password or os.getenv("POSTGRES_PASSWORD"),
+            "database": dbname or os.getenv("POSTGRES_DB"),
+        }
+        self.pool_size = pool_size or int(os.getenv("DB_ASYNC_POOL_SIZE", "10"))
+        self.gmail_message_fields = gmail_message_fields
+        self.account = account or os.getenv("GMAIL_ACCOUNT", "default")
+        self._pool = None
+        self._pool_lock = asyncio.Lock()
+
+    def _message_row(self, email_data):
+        row = []
+        for field in self.gmail_message_fields:
+            value = self.account if field == "account" else email_data.get(field)
+            if field == "received_at" and isinstance(value, str):
+                # asyncpg's binary codec only takes datetimes for timestamptz.
+                # get_required_data formats the local time of the message.
+                value = datetime.strptime(value, "%Y-%m-%d %H:%M:%S").astimezone()
+            row.append(value)
+        return row
+
+    async def _get_pool(self):
+        async with self._pool_lock:
+            if self._pool is None:
+                config = dict(self.connection_config)
+                if config["port"]:
+                    config["port"] = int(config["port"])
+                self._pool = await asyncpg.create_pool(
+                    min_size=1, max_size=self.pool_size, **config
+                )
+        return self._pool
+
+    async def _run_in_transaction(self, work, onSuccess=None, onError=None):
+        try:
+            pool = await self._get_pool()
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    result = await work(conn)
+        except Exception as e:
+            if onError is None:
+                raise
+            return onError(e)
+        return onSuccess(result) if onSuccess else result
+
+    async def _run_prepared(
+        self, name, params, fetch=False, onSuccess=None, onError=None
+    ):
+        statement = prepared_statements[name][1]
+
+        async def work(conn):
+            if fetch:
+                return await conn.fetch(statement, *params)
+            return _rowcount(await conn.execute(statement, *params))
+
+        return await self._run_in_transaction(
+            work, onSuccess=onSuccess, onError=onError
+        )
+
+    async def insert_email(self, email_data, onSuccess=None, onError=None):
+        return await self._run_prepared(
+            "insert_email",
+            self._message_row(email_data),
+            onSuccess=onSuccess,
+            onError=onError,
+        )
+
+    async def bulk_insert_labels(
+        self, message_id, label_data_list, onSuccess=None, onError=None
+    ):
+        if not label_data_list:
+            return True, []
+
+        return await self._run_prepared(
+            "insert_labels",
+            [self.account, message_id, list(label_data_list)],
+            onSuccess=onSuccess,
+            onError=onError,
+        )
+
+    async def bulk_upsert_emails(self, email_data_list, onSuccess=None, onError=None):
+        """
+        Upsert many emails and their labels in a single transaction, through
+        the same staging tables as GoogleDB.bulk_upsert_emails.
+        """
+        if not email_data_list:
+            return onSuccess(0) if onSuccess else 0
+
+        columns = list(self.gmail_message_fields)
+
+        async def work(conn):
+            await conn.execute(create_staging_tables)
+            await conn.copy_records_to_table(
+                "messages_staging",
+                records=[
+                    self._message_row(email_data) for email_data in email_data_list
+                ],
+                columns=columns,
+            )
+            await conn.copy_records_to_table(
+                "message_labels_staging",
+                records=[
+                    (self.account, email_data["message_id"], label)
+                    for email_data in email_data_list
+                    for label in email_data.get("labels") or []
+                ],
+                columns=["account", "message_id", "label"],
+            )
+            await conn.execute(merge_staged_emails)
+            return len(email_data_list)
+
+        return await self._run_in_transaction(
+            work, onSuccess=onSuccess, onError=onError
+        )
+
+    async def get_rule_matches(self, conditions, onSuccess=None, onError=None):
+        """
+        Evaluate several rule conditions in a single scan of gmail.messages.
+
+        Returns:
+            List of (message_id, [indexes of the conditions the message matched],
+            [labels the message has]) for every message matching at least one
+            condition
+        """
+
+        async def work(conn):
+            rows = await conn.fetch(_rule_matches_query(conditions, self.account))
+            return [tuple(row) for row in rows]
+
+        return await self._run_in_transaction(
+            work, onSuccess=onSuccess, onError=onError
+        )
+
+    async def stream_rule_matches(self, conditions, batch_size=1000):
+        """
+        Streaming get_rule_matches over a server-side cursor.
+
+        Yields:
+            Lists of at most `batch_size` (message_id, [indexes of the matched
+            conditions], [labels the message has]) tuples
+        """
+        query = _rule_matches_query(conditions, self.account)
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                cursor = await conn.cursor(query)
+                while True:
+                    rows = await cursor.fetch(batch_size)
+                    if not rows:
+                        return
+                    yield [tuple(row) for row in rows]
+
+    async def apply_label_changes(
+        self, message_ids, add_labels, remove_labels, onSuccess=None, onError=None
+    ):
+        return await self._run_prepared(
+            "apply_label_changes",
+            [self.account, list(message_ids), list(add_labels), list(remove_labels)],
+            onSuccess=onSuccess,
+            onError=onError,
+        )
+
+    async def delete_emails(self, message_ids, onSuccess=None, onError=None):
+        if not message_ids:
+            return True, []
+
+        return await self._run_prepared(
+            "delete_emails",
+            [self.account, list(message_ids)],
+            onSuccess=onSuccess,
+            onError=onError,
+        )
+
+    async def delete_labels(
+        self, message_id, label_data_list, onSuccess=None, onError=None
+    ):
+        if not label_data_list:
+            return True, []
+
+        return await self._run_prepared(
+            "delete_labels",
+            [self.account, message_id, list(label_data_list)],
+            onSuccess=onSuccess,
+            onError=onError,
+        )
+
+    async def get_history_id(self, sync_key=None, onError=None):
+        return await self._run_prepared(
+            "get_history_id",
+            [sync_key or self.account],
+            fetch=True,
+            onSuccess=lambda result: result[0][0] if result else None,
+            onError=onError,
+        )
+
+    async def set_history_id(
+        self, history_id, sync_key=None, onSuccess=None, onError=None
+    ):
+        return await self._run_prepared(
+            "set_history_id",
+            [sync_key or self.account, history_id],
+            onSuccess=onSuccess,
+            onError=onError,
+        )
+
+    async def get_stored_labels(self, message_ids, onError=None):
+        if not message_ids:
+            return {}
+
+        return await self._run_prepared(
+            "get_stored_labels",
+            [self.account, list(message_ids)],
+            fetch=True,
+            onSuccess=lambda result: {row[0]: set(row[1]) for row in result},
+            onError=onError,
+        )
+
+    async def get_full_sync_progress(self, sync_key=None, onError=None):
+        return await self._run_prepared(
+            "get_full_sync_progress",
+            [sync_key or self.account],
+            fetch=True,
+            onSuccess=lambda result: dict(result[0]) if result else None,
+            onError=onError,
+        )
+
+    async def set_full_sync_progress(
+        self,
+        history_id,
+        page_token,
+        messages,
+        sync_key=None,
+        onSuccess=None,
+        onError=None,
+    ):
+        return await self._run_prepared(
+            "set_full_sync_progress",
+            [sync_key or self.account, history_id, page_token, messages],
+            onSuccess=onSuccess,
+            onError=onError,
+        )
+
+    async def clear_full_sync_progress(
+        self, sync_key=None, onSuccess=None, onError=None
+    ):
+        return await self._run_prepared(
+            "clear_full_sync_progress",
+            [sync_key or self.account],
+            onSuccess=onSuccess,
+            onError=onError,
+        )
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
@@ -1,12 +1,281 @@
+import io
 import os
+import threading
+import weakref
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.pool
 from dotenv import load_dotenv
 from arena.data import Postgres
+from .writer import BufferedEmailWriter
 
 load_dotenv()
 
 
+def _copy_value(value):
+    # Postgres COPY text format: tab separated, \N for null, backslash escapes
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\x00", "")
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def _copy_rows(cursor, table, columns, rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_value(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    cursor.copy_expert(f"copy {table} ({', '.join(columns)}) from stdin", buffer)
+
+
+gmail_message_fields = {
+    "message_id": "text",
+    "thread_id": "text",
+    "from_address": "text",
+    "to_address": "text",
+    "subject": "text",
+    "body": "text",
+    "received_at": "timestamptz",
+    # Mailbox the message belongs to, filled in from GoogleDB.account
+    "account": "text",
+}
+
+# Statements are prepared once per connection and executed with bound
+# parameters. Lists are passed as arrays, so each statement has one shape no
+# matter how many labels or ids it is called with.
+prepared_statements = {
+    "insert_email": (
+        list(gmail_message_fields.values()),
+        """
+        insert into gmail.messages ({columns})
+        values ({placeholders})
+        on conflict (account, message_id) do update set
+            {updates};
+        """.format(
+            columns=", ".join(gmail_message_fields),
+            placeholders=", ".join(
+                f"${i}" for i in range(1, len(gmail_message_fields) + 1)
+            ),
+            updates=",\n            ".join(
+                f"{field} = excluded.{field}"
+                for field in gmail_message_fields
+                if field not in ("message_id", "account")
+            ),
+        ),
+    ),
+    # Message ids are only unique within a mailbox, so every statement on
+    # messages or their labels takes the account first.
+    # Label changes can arrive for messages we never stored (e.g. from the
+    # history API), so only keep the ones whose message exists. User labels
+    # are not seeded by init.sql and are registered on the way.
+    "insert_labels": (
+        ["text", "text", "text[]"],
+        """
+        with registered as (
+            insert into gmail.labels (label)
+            select unnest($3::text[])
+            on conflict (label) do nothing
+        )
+        insert into gmail.message_labels (account, message_id, label)
+        select $1, $2, label from unnest($3::text[]) as label
+        where exists (
+            select 1 from gmail.messages m
+            where m.account = $1 and m.message_id = $2
+        )
+        on conflict (account, message_id, label) do nothing;
+        """,
+    ),
+    "delete_labels": (
+        ["text", "text", "text[]"],
+        """
+        delete from gmail.message_labels
+        where account = $1 and message_id = $2 and label = any($3);
+        """,
+    ),
+    # Mirrors a label change, a successful batchModify or one found by a sync,
+    # in the local label table
+    "apply_label_changes": (
+        ["text", "text[]", "text[]", "text[]"],
+        """
+        with registered as (
+            insert into gmail.labels (label)
+            select unnest($3::text[])
+            on conflict (label) do nothing
+        ),
+        removed as (
+            delete from gmail.message_labels
+            where account = $1 and message_id = any($2) and label = any($4)
+        )
+        insert into gmail.message_labels (account, message_id, label)
+        select m.account, m.message_id, label
+        from gmail.messages m, unnest($3::text[]) as label
+        where m.account = $1 and m.message_id = any($2)
+        on conflict (account, message_id, label) do nothing;
+        """,
+    ),
+    "delete_emails": (
+        ["text", "text[]"],
+        """
+        with deleted_labels as (
+            delete from gmail.message_labels
+            where account = $1 and message_id = any($2)
+        )
+        delete from gmail.messages where account = $1 and message_id = any($2);
+        """,
+    ),
+    "get_history_id": (
+        ["text"],
+        "select history_id from gmail.sync_state where sync_key = $1;",
+    ),
+    "set_history_id": (
+        ["text", "text"],
+        """
+        insert into gmail.sync_state (sync_key, history_id, updated_at)
+        values ($1, $2, now())
+        on conflict (sync_key) do update set
+            history_id = excluded.history_id,
+            updated_at = excluded.updated_at;
+        """,
+    ),
+    "get_stored_labels": (
+        ["text", "text[]"],
+        """
+        select m.message_id, array_remove(array_agg(l.label), null)
+        from gmail.messages m
+        left join gmail.message_labels l
+            on l.account = m.account and l.message_id = m.message_id
+        where m.account = $1 and m.message_id = any($2)
+        group by m.message_id;
+        """,
+    ),
+    "get_full_sync_progress": (
+        ["text"],
+        """
+        select history_id, page_token, messages from gmail.full_sync_progress
+        where sync_key = $1;
+        """,
+    ),
+    "set_full_sync_progress": (
+        ["text", "text", "text", "bigint"],
+        """
+        insert into gmail.full_sync_progress
+            (sync_key, history_id, page_token, messages, updated_at)
+        values ($1, $2, $3, $4, now())
+        on conflict (sync_key) do update set
+            history_id = excluded.history_id,
+            page_token = excluded.page_token,
+            messages = excluded.messages,
+            updated_at = excluded.updated_at;
+        """,
+    ),
+    "clear_full_sync_progress": (
+        ["text"],
+        "delete from gmail.full_sync_progress where sync_key = $1;",
+    ),
+}
+
+execute_statements = {
+    name: f"execute {name} ({', '.join(['%s'] * len(types))})"
+    for name, (types, _) in prepared_statements.items()
+}
+
+
+# bulk_upsert_emails COPYs a batch into these staging tables and merges it
+# from there in one transaction
+create_staging_tables = """
+    create temp table if not exists messages_staging
+        (like gmail.messages) on commit delete rows;
+    create temp table if not exists message_labels_staging
+        (account text, message_id text, label text) on commit delete rows;
+"""
+
+merge_staged_emails = """
+    insert into gmail.messages (message_id,
+        thread_id,
+        from_address,
+        to_address,
+        subject,
+        body,
+        received_at,
+        account)
+    select distinct on (account, message_id) message_id,
+        thread_id,
+        from_address,
+        to_address,
+        subject,
+        body,
+        received_at,
+        account
+    from messages_staging
+    order by account, message_id
+    on conflict (account, message_id) do update set
+        thread_id = excluded.thread_id,
+        from_address = excluded.from_address,
+        to_address = excluded.to_address,
+        subject = excluded.subject,
+        body = excluded.body,
+        received_at = excluded.received_at;
+
+    -- User labels are not seeded by init.sql, register them so a
+    -- single custom label cannot fail the whole batch
+    insert into gmail.labels (label)
+    select distinct label from message_labels_staging
+    on conflict (label) do nothing;
+
+    delete from gmail.message_labels ml
+    using (select distinct account, message_id from messages_staging) s
+    where ml.account = s.account
+        and ml.message_id = s.message_id
+        and not exists (
+            select 1 from message_labels_staging ls
+            where ls.account = ml.account
+                and ls.message_id = ml.message_id
+                and ls.label = ml.label
+        );
+
+    insert into gmail.message_labels (account, message_id, label)
+    select distinct account, message_id, label from message_labels_staging
+    on conflict (account, message_id, label) do nothing;
+"""
+
+
+def _quote(value):
+    # standard_conforming_strings is on since Postgres 9.1
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _rule_matches_query(conditions, account):
+    matched = ", ".join(
+        f"case when ({condition}) then {index} end"
+        for index, condition in enumerate(conditions)
+    )
+    where = " or ".join(f"({condition})" for condition in conditions)
+    return (
+        f"select m.message_id, array_remove(array[{matched}], null), "
+        "array(select l.label from gmail.message_labels l "
+        "where l.account = m.account and l.message_id = m.message_id) "
+        f"from gmail.messages m where m.account = {_quote(account)} and ({where})"
+    )
+
+
 class GoogleDB(Postgres):
-    def __init__(self, host=None, port=None, user=None, password=None, dbname=None):
+    def __init__(
+        self,
+        host=None,
+        port=None,
+        user=None,
+        password=None,
+        dbname=None,
+        pool_size=None,
+        account=None,
+    ):
         config = {
             "host": host or os.getenv("POSTGRES_HOST"),
             "port": port or os.getenv("POSTGRES_PORT"),
@@ -15,74 +284,47 @@ class GoogleDB(Postgres):
             "database": dbname or os.getenv("POSTGRES_DB"),
         }
         super().__init__(config)
-        self.gmail_message_fields = {
-            "message_id": "text",
-            "thread_id": "text",
-            "from_address": "text",
-            "to_address": "text",
-            "subject": "text",
-            "body": "text",
-            "received_at": "timestamptz",
-        }
+        self.connection_config = config
+        self._conn = None
+        # With a pool size, connections come from a thread-safe pool so a long
+        # running process can share one GoogleDB between threads
+        self.pool_size = pool_size or int(os.getenv("DB_POOL_SIZE", "0"))
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # The pool raises when it runs out of connections, callers wait instead
+        self._pool_slots = threading.BoundedSemaphore(self.pool_size or 1)
+        # connection -> names of the statements prepared on it
+        self._prepared = weakref.WeakKeyDictionary()
+        self.gmail_message_fields = gmail_message_fields
+        # Messages are stored under, rules matched within and the sync
+        # checkpoint kept for this mailbox
+        self.account = account or os.getenv("GMAIL_ACCOUNT", "default")
+
+    def _message_row(self, email_data):
+        return [
+            self.account if field == "account" else email_data.get(field)
+            for field in self.gmail_message_fields
+        ]
+
+    def _execute(self, cursor, name, params):
+        prepared = self._prepared.setdefault(cursor.connection, set())
+        if name not in prepared:
+            types, statement = prepared_statements[name]
+            cursor.execute(f"prepare {name} ({', '.join(types)}) as {statement}")
+            prepared.add(name)
+        cursor.execute(execute_statements[name], params)
+
+    def _run_prepared(self, name, params, fetch=False, onSuccess=None, onError=None):
+        def work(cursor):
+            self._execute(cursor, name, params)
+            return cursor.fetchall() if fetch else cursor.rowcount
 
-    def clean_data(self, email_data, required_fields={}):
-        clean_data = {}
-        # print(email_data)
-        for field in required_fields:
-            datatype = self.gmail_message_fields[field]
-            if field not in email_data:
-                clean_data[field] = "null"
-            elif datatype == "number":
-                clean_data[field] = (
-                    f"{email_data[field]}" if email_data[field] is not None else "null"
-                )
-            elif datatype == "timestamptz":
-                clean_data[field] = (
-                    f"'{email_data[field]}'::timestamptz"
-                    if email_data[field] is not None
-                    else "null"
-                )
-            else:
-                if email_data[field] is not None:
-                    email_data[field] = email_data[field].replace("'", "''")
-                clean_data[field] = (
-                    f"'{email_data[field]}'"
-                    if email_data[field] is not None
-                    else "null"
-                )
-
-        return clean_data
+        return self._run_in_transaction(work, onSuccess=onSuccess, onError=onError)
 
     def insert_email(self, email_data, onSuccess=None, onError=None):
-        clean_data = self.clean_data(email_data, self.gmail_message_fields)
-        # print(clean_data)
-        query = """
-            insert into gmail.messages ( message_id,
-                thread_id,
-                from_address,
-                to_address,
-                subject,
-                body,
-                received_at)
-            values ({{message_id}},
-                {{thread_id}},
-                {{from_address}},
-                {{to_address}},
-                {{subject}},
-                {{body}},
-                {{received_at}})
-            on conflict (message_id) do update set
-                thread_id = {{thread_id}},
-                from_address = {{from_address}},
-                to_address = {{to_address}},
-                subject = {{subject}},
-                body = {{body}},
-                received_at = {{received_at}};
-        """
-        return self.run_query(
-            query,
-            params=clean_data,
-            isUpdate=True,
+        return self._run_prepared(
+            "insert_email",
+            self._message_row(email_data),
             onSuccess=onSuccess,
             onError=onError,
         )
@@ -91,52 +333,303 @@ class GoogleDB(Postgres):
         self, message_id, label_data_list, onSuccess=None, onError=None
     ):
         """
-        Insert multiple emails in a single query for better performance.
+        Insert all labels of a message in a single statement.
 
         Args:
-            email_data_list: List of dictionaries containing email data
+            message_id: Id of the message the labels belong to
+            label_data_list: List of label ids
             onSuccess: Success callback function
             onError: Error callback function
 
         Returns:
-            Result from run_query method
+            Result from the callbacks
+        """
+        if not label_data_list:
+            return True, []
+
+        return self._run_prepared(
+            "insert_labels",
+            [self.account, message_id, list(label_data_list)],
+            onSuccess=onSuccess,
+            onError=onError,
+        )
+
+    def get_rule_matches(self, conditions, onSuccess=None, onError=None):
+        """
+        Evaluate several rule conditions in a single scan of gmail.messages.
+
+        Args:
+            conditions: SQL conditions, one per rule
+
+        Returns:
+            List of (message_id, [indexes of the conditions the message matched],
+            [labels the message has]) for every message matching at least one
+            condition
+        """
+
+        def work(cursor):
+            cursor.execute(_rule_matches_query(conditions, self.account))
+            return cursor.fetchall()
+
+        return self._run_in_transaction(work, onSuccess=onSuccess, onError=onError)
+
+    def stream_rule_matches(self, conditions, batch_size=1000):
+        """
+        Streaming get_rule_matches.
+
+        Yields:
+            Lists of at most `batch_size` (message_id, [indexes of the matched
+            conditions], [labels the message has]) tuples
+        """
+        yield from self._stream(
+            _rule_matches_query(conditions, self.account), batch_size
+        )
+
+    def explain_rule_matches(
+        self, conditions, analyze=False, onSuccess=None, onError=None
+    ):
+        """
+        Return the Postgres plan of the query get_rule_matches and
+        stream_rule_matches run.
+
+        Args:
+            conditions: The same conditions get_rule_matches takes
+            analyze: Also run the query and report actual rows and timings
+
+        Returns:
+            The plan as parsed from `explain (format json)`
         """
+        options = "analyze, format json" if analyze else "format json"
+        query = _rule_matches_query(conditions, self.account)
+
+        def work(cursor):
+            cursor.execute(f"explain ({options}) {query}")
+            return cursor.fetchone()[0][0]
+
+        return self._run_in_transaction(work, onSuccess=onSuccess, onError=onError)
+
+    def apply_label_changes(
+        self, message_ids, add_labels, remove_labels, onSuccess=None, onError=None
+    ):
+        return self._run_prepared(
+            "apply_label_changes",
+            [self.account, list(message_ids), list(add_labels), list(remove_labels)],
+            onSuccess=onSuccess,
+            onError=onError,
+        )
+
+    def delete_emails(self, message_ids, onSuccess=None, onError=None):
+        if not message_ids:
+            return True, []
+
+        return self._run_prepared(
+            "delete_emails",
+            [self.account, list(message_ids)],
+            onSuccess=onSuccess,
+            onError=onError,
+        )
+
+    def delete_labels(self, message_id, label_data_list, onSuccess=None, onError=None):
         if not label_data_list:
             return True, []
 
-        # Generate values section for each email
-        values_list = []
-        for label in label_data_list:
-            values_part = f"""(
-                '{message_id}', 
-                '{label}'
-            )"""
-            values_list.append(values_part)
-
-        # Combine all values into one query
-        values_clause = ",\n".join(values_list)
-
-        query = """
-        insert into gmail.message_labels (
-            message_id, label
-        ) values 
-        {{values_clause}}
-        on conflict (message_id, label) do nothing;
-        """
-
-        return self.run_query(
-            query,
-            params={"values_clause": values_clause},
-            isUpdate=True,
+        return self._run_prepared(
+            "delete_labels",
+            [self.account, message_id, list(label_data_list)],
+            onSuccess=onSuccess,
+            onError=onError,
+        )
+
+    def get_history_id(self, sync_key=None, onError=None):
+        return self._run_prepared(
+            "get_history_id",
+            [sync_key or self.account],
+            fetch=True,
+            onSuccess=lambda result: result[0][0] if result else None,
+            onError=onError,
+        )
+
+    def set_history_id(
+        self, history_id, sync_key=None, onSuccess=None, onError=None
+    ):
+        return self._run_prepared(
+            "set_history_id",
+            [sync_key or self.account, history_id],
             onSuccess=onSuccess,
             onError=onError,
         )
 
-    def get_message_ids_by_condition(self, condition, onSuccess=None, onError=None):
-        query = """
-            select message_id from gmail.messages
-            {{condition}};
+    def get_stored_labels(self, message_ids, onError=None):
+        """
+        Labels of the `message_ids` already stored, in one query.
+
+        Returns:
+            {message_id: set of labels}, messages not stored are left out
         """
-        return self.run_query(
-            query, params={"condition": condition}, onSuccess=onSuccess, onError=onError
+        if not message_ids:
+            return {}
+
+        return self._run_prepared(
+            "get_stored_labels",
+            [self.account, list(message_ids)],
+            fetch=True,
+            onSuccess=lambda result: {row[0]: set(row[1]) for row in result},
+            onError=onError,
         )
+
+    def get_full_sync_progress(self, sync_key=None, onError=None):
+        """
+        Checkpoint of an unfinished full sync.
+
+        Returns:
+            {"history_id", "page_token", "messages"} or None when no full sync
+            was interrupted
+        """
+        return self._run_prepared(
+            "get_full_sync_progress",
+            [sync_key or self.account],
+            fetch=True,
+            onSuccess=lambda result: (
+                dict(zip(["history_id", "page_token", "messages"], result[0]))
+                if result
+                else None
+            ),
+            onError=onError,
+        )
+
+    def set_full_sync_progress(
+        self,
+        history_id,
+        page_token,
+        messages,
+        sync_key=None,
+        onSuccess=None,
+        onError=None,
+    ):
+        return self._run_prepared(
+            "set_full_sync_progress",
+            [sync_key or self.account, history_id, page_token, messages],
+            onSuccess=onSuccess,
+            onError=onError,
+        )
+
+    def clear_full_sync_progress(self, sync_key=None, onSuccess=None, onError=None):
+        return self._run_prepared(
+            "clear_full_sync_progress",
+            [sync_key or self.account],
+            onSuccess=onSuccess,
+            onError=onError,
+        )
+
+    def writer(self, **kwargs):
+        return BufferedEmailWriter(self, **kwargs)
+
+    def _connection_kwargs(self):
+        config = dict(self.connection_config)
+        config["dbname"] = config.pop("database")
+        return config
+
+    def _connect(self):
+        return psycopg2.connect(**self._connection_kwargs())
+
+    @contextmanager
+    def _connection(self):
+        if self.pool_size:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = psycopg2.pool.ThreadedConnectionPool(
+                        1, self.pool_size, **self._connection_kwargs()
+                    )
+            with self._pool_slots:
+                conn = self._pool.getconn()
+                try:
+                    yield conn
+                finally:
+                    self._pool.putconn(conn, close=conn.closed != 0)
+            return
+        if self._conn is None or self._conn.closed:
+            self._conn = self._connect()
+        yield self._conn
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.closeall()
+            self._pool = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _stream(self, query, batch_size):
+        # A named cursor keeps the result set on the server and sends it
+        # `batch_size` rows at a time. It lives on its own connection, so the
+        # caller can keep writing through this one while the rows arrive.
+        conn = self._connect()
+        try:
+            with conn:
+                with conn.cursor(name="gmail_stream") as cursor:
+                    cursor.itersize = batch_size
+                    cursor.execute(query)
+                    while True:
+                        rows = cursor.fetchmany(batch_size)
+                        if not rows:
+                            return
+                        yield rows
+        finally:
+            conn.close()
+
+    def _run_in_transaction(self, work, onSuccess=None, onError=None):
+        try:
+            with self._connection() as conn:
+                with conn:
+                    with conn.cursor() as cursor:
+                        result = work(cursor)
+        except Exception as e:
+            if onError is None:
+                raise
+            return onError(e)
+        return onSuccess(result) if onSuccess else result
+
+    def bulk_upsert_emails(self, email_data_list, onSuccess=None, onError=None):
+        """
+        Upsert many emails and their labels in a single transaction.
+
+        Rows are COPYed into temporary staging tables and merged from there,
+        so a batch costs a handful of statements regardless of its size. The
+        stored labels of every message in the batch are replaced by the ones
+        in `email_data_list`.
+
+        Args:
+            email_data_list: List of dictionaries as returned by get_required_data
+            onSuccess: Success callback function, called with the row count
+            onError: Error callback function
+
+        Returns:
+            Result of the callback, or the number of merged emails
+        """
+        if not email_data_list:
+            return onSuccess(0) if onSuccess else 0
+
+        columns = list(self.gmail_message_fields)
+
+        def work(cursor):
+            cursor.execute(create_staging_tables)
+            _copy_rows(
+                cursor,
+                "messages_staging",
+                columns,
+                (self._message_row(email_data) for email_data in email_data_list),
+            )
+            _copy_rows(
+                cursor,
+                "message_labels_staging",
+                ["account", "message_id", "label"],
+                (
+                    [self.account, email_data["message_id"], label]
+                    for email_data in email_data_list
+                    for label in email_data.get("labels") or []
+                ),
+            )
+            cursor.execute(merge_staged_emails)
+            return len(email_data_list)
+
+        return self._run_in_transaction(work, onSuccess=onSuccess, onError=onError)
@@ -0,0 +1,101 @@
+import os
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class BufferedEmailWriter:
+    """
+    Collects parsed emails and writes them to the database in batches.
+
+    A batch is flushed once it holds `batch_size` emails, or once
+    `flush_interval` seconds passed since the last flush, checked on every
+    add and by callers waiting for more emails through flush_if_due. Use it
+    as a context manager (or call close) so the last partial batch is written.
+
+    Failed flushes are counted in `failed_batches` and `failed`, and the last
+    error is kept in `error`, so callers can tell a partial run from a clean
+    one even when onError only reports the error.
+
+    Args:
+        db: GoogleDB to write to
+        batch_size: Number of emails per flush
+        flush_interval: Maximum seconds a buffered email waits for its flush
+        onSuccess: Called with the number of emails of every flushed batch
+        onError: Called with the exception of a failed flush, without it the
+            exception is raised
+        onCommit: Called with the message ids of every committed batch
+    """
+
+    def __init__(
+        self,
+        db,
+        batch_size=None,
+        flush_interval=None,
+        onSuccess=None,
+        onError=None,
+        onCommit=None,
+    ):
+        self.db = db
+        self.batch_size = batch_size or int(os.getenv("DB_BATCH_SIZE", "500"))
+        self.flush_interval = flush_interval or float(
+            os.getenv("DB_FLUSH_INTERVAL", "5")
+        )
+        self.onSuccess = onSuccess
+        self.onError = onError
+        self.onCommit = onCommit
+        self.buffer = []
+        self.written = 0
+        self.flushes = 0
+        self.failed = 0
+        self.failed_batches = 0
+        self.error = None
+        self._last_flush = time.monotonic()
+
+    def add(self, email_data):
+        self.buffer.append(email_data)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self.buffer:
+            return
+        batch, self.buffer = self.buffer, []
+        self.db.bulk_upsert_emails(
+            batch,
+            onSuccess=lambda count: self._flushed(count, batch),
+            onError=lambda error: self._failed(error, batch),
+        )
+
+    def _flushed(self, count, batch):
+        self.written += count
+        self.flushes += 1
+        if self.onSuccess:
+            self.onSuccess(count)
+        if self.onCommit:
+            self.onCommit([email_data["message_id"] for email_data in batch])
+
+    def _failed(self, error, batch):
+        self.failed += len(batch)
+        self.failed_batches += 1
+        self.error = error
+        if self.onError is None:
+            raise error
+        return self.onError(error)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
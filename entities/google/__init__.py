@@ -1,3 +1,4 @@
 from .gmail import GmailService
+from .pager import MessagePager
 
-__all__ = ["GmailService"]
+__all__ = ["GmailService", "MessagePager"]
@@ -0,0 +1,234 @@
+import asyncio
+import json
+import os
+import aiohttp
+import httplib2
+from dotenv import load_dotenv
+from googleapiclient.errors import HttpError
+from .gmail import GmailService
+from .ratelimit import default_units, is_retryable, quota_units
+
+load_dotenv()
+
+# Failures of the connection itself, retried like the blocking client's
+# ConnectionError and TimeoutError
+_transport_errors = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+class AsyncGmailService:
+    """
+    asyncio counterpart of GmailService on an aiohttp session.
+
+    Requests go straight to the Gmail REST API over a keep-alive connection
+    pool. Up to `concurrency` requests are in flight at once, which bounds
+    both the connections and the messages held in memory, so thousands of
+    concurrent requests cost a few hundred kilobytes of buffers rather than
+    a thread stack each. Errors are raised as the same googleapiclient
+    HttpError the blocking client raises, and retried the same way, as are
+    connection errors and timeouts, raised as aiohttp errors once retries run
+    out.
+
+    Requests are paced by the RateLimiter of `gmail`: each one takes its quota
+    units from the shared token bucket, waiting without blocking the loop,
+    and reports its outcome so rate limit errors slow the bucket down for
+    both clients. `concurrency` stays the bound on requests in flight, the
+    limiter's adaptive concurrency only applies to the blocking client.
+
+    Args:
+        gmail: GmailService providing the credentials and settings (page
+            size, retries, backoff), a new one by default
+        concurrency: Maximum number of requests in flight
+        root_url: API root, to point the client at another server
+    """
+
+    def __init__(self, gmail=None, concurrency=None, root_url=None):
+        self.gmail = gmail or GmailService()
+        self.concurrency = concurrency or int(
+            os.getenv("GMAIL_ASYNC_CONCURRENCY", "100")
+        )
+        self.root_url = (
+            root_url
+            or self.gmail.root_url
+            or os.getenv("GMAIL_ROOT_URL", "https://gmail.googleapis.com/")
+        )
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._session = None
+        self._slots = None
+
+    async def open(self):
+        """Open the HTTP session, without loading credentials."""
+        if self._session is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+            timeout = float(os.getenv("GMAIL_HTTP_TIMEOUT", "60"))
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(total=timeout),
+            )
+        return self
+
+    async def authenticate(self):
+        if self.gmail.credentials is None:
+            self.gmail.credentials = await asyncio.to_thread(
+                self.gmail.credential_store.get
+            )
+        return await self.open()
+
+    async def _headers(self):
+        creds = self.gmail.credentials
+        if creds is None:
+            return {}
+        store = self.gmail.credential_store
+        if not store.is_fresh(creds):
+            await asyncio.to_thread(store.refresh, creds)
+        return {"Authorization": f"Bearer {creds.token}"}
+
+    async def _request(self, method, path, params=None, body=None, units=None):
+        if self._session is None:
+            await self.authenticate()
+
+        url = f"{self.root_url}gmail/v1/users/{self.gmail.user_id}/{path}"
+        limiter = self.gmail.rate_limiter
+        attempt = 0
+        while True:
+            delay = limiter.pace(units or default_units)
+            if delay:
+                await asyncio.sleep(delay)
+            try:
+                async with self._slots:
+                    self.in_flight += 1
+                    self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                    try:
+                        async with self._session.request(
+                            method,
+                            url,
+                            params=params,
+                            json=body,
+                            headers=await self._headers(),
+                        ) as response:
+                            content = await response.read()
+                            status = response.status
+                    finally:
+                        self.in_flight -= 1
+            except _transport_errors as e:
+                error = e
+            else:
+                if status < 300:
+                    limiter.record()
+                    return json.loads(content) if content else {}
+                error = HttpError(httplib2.Response({"status": status}), content, url)
+                if not is_retryable(error):
+                    raise error
+            limiter.record(error)
+            attempt += 1
+            if attempt > self.gmail.max_retries:
+                raise error
+            await asyncio.sleep(
+                limiter.backoff(attempt, self.gmail.backoff_base, error)
+            )
+
+    async def get_profile(self):
+        return await self._request(
+            "GET", "profile", units=quota_units["gmail.users.getProfile"]
+        )
+
+    async def message_ids(
+        self, pageToken=None, remainingMessages=1000, labels=["INBOX"]
+    ):
+        while remainingMessages > 0:
+            params = [("maxResults", min(remainingMessages, self.gmail.page_size))]
+            params += [("labelIds", label) for label in labels]
+            if pageToken:
+                params.append(("pageToken", pageToken))
+            results = await self._request(
+                "GET",
+                "messages",
+                params=params,
+                units=quota_units["gmail.users.messages.list"],
+            )
+            messages = results.get("messages", [])
+            for message in messages:
+                yield message["id"]
+            remainingMessages -= len(messages)
+            pageToken = results.get("nextPageToken")
+            if not messages or not pageToken:
+                return
+
+    async def messages_get(self, message_id, format="full"):
+        return await self._request(
+            "GET",
+            f"messages/{message_id}",
+            params={"format": format},
+            units=quota_units["gmail.users.messages.get"],
+        )
+
+    async def _get_or_none(self, message_id, format):
+        try:
+            return await self.messages_get(message_id, format)
+        except (HttpError, *_transport_errors) as error:
+            print(f"Error fetching message {message_id}", error)
+            return None
+
+    async def messages_list(
+        self, pageToken=None, remainingMessages=1000, labels=["INBOX"], format="full"
+    ):
+        """
+        Fetch the messages of a listing, `concurrency` at a time.
+
+        Yields:
+            Messages in completion order; messages that failed to fetch are
+            reported and skipped
+        """
+        pending = set()
+        try:
+            async for message_id in self.message_ids(
+                pageToken, remainingMessages, labels
+            ):
+                # The listing waits while the window is full, so the messages
+                # held at once never exceed `concurrency`
+                while len(pending) >= self.concurrency:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        if task.result() is not None:
+                            yield task.result()
+                pending.add(
+                    asyncio.create_task(self._get_or_none(message_id, format))
+                )
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.result() is not None:
+                        yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def bulk_modify_message_labels(
+        self, message_ids, add_labels=None, remove_labels=None
+    ):
+        body = {
+            "ids": message_ids,
+            "addLabelIds": add_labels or [],
+            "removeLabelIds": remove_labels or [],
+        }
+        return await self._request(
+            "POST",
+            "messages/batchModify",
+            body=body,
+            units=quota_units["gmail.users.messages.batchModify"],
+        )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
@@ -0,0 +1,126 @@
+import datetime
+import json
+import os
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def _utcnow():
+    # google-auth keeps expiry as a naive UTC datetime
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+class CredentialStore:
+    """
+    Keeps the OAuth token on disk between runs and refreshes it before it
+    expires, so a run only goes through the browser flow when there is no
+    usable refresh token.
+
+    The google-auth and oauthlib modules are imported on first use: a run
+    with a token that is still fresh never loads the requests based refresh
+    transport or the installed app flow.
+
+    Args:
+        token_path: JSON file holding the authorized user info
+        scopes: OAuth scopes the token must cover
+        cred_path: Client secrets file used for the browser flow
+        refresh_margin: Seconds before expiry a token is refreshed
+    """
+
+    def __init__(self, token_path, scopes, cred_path=None, refresh_margin=None):
+        self.token_path = token_path
+        self.scopes = scopes
+        self.cred_path = cred_path
+        self.refresh_margin = refresh_margin or int(
+            os.getenv("GOOGLE_TOKEN_REFRESH_MARGIN", "300")
+        )
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._refresher = None
+
+    def load(self):
+        if not os.path.exists(self.token_path):
+            return None
+        from google.oauth2.credentials import Credentials
+
+        with open(self.token_path) as token:
+            return Credentials.from_authorized_user_info(json.load(token), self.scopes)
+
+    def save(self, creds):
+        # Written to a temporary file first so a crash never leaves half a token
+        temporary_path = f"{self.token_path}.tmp"
+        fd = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as token:
+            token.write(creds.to_json())
+        os.replace(temporary_path, self.token_path)
+
+    def expires_in(self, creds):
+        if creds.expiry is None:
+            return None
+        return (creds.expiry - _utcnow()).total_seconds()
+
+    def is_fresh(self, creds):
+        if not creds.token:
+            return False
+        remaining = self.expires_in(creds)
+        return remaining is None or remaining > self.refresh_margin
+
+    def refresh(self, creds):
+        from google.auth.transport.requests import Request
+
+        with self._lock:
+            creds.refresh(Request())
+            self.save(creds)
+        return creds
+
+    def authorize(self):
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
+        flow = InstalledAppFlow.from_client_secrets_file(self.cred_path, self.scopes)
+        creds = flow.run_local_server(port=0)
+        self.save(creds)
+        return creds
+
+    def get(self):
+        """
+        Credentials valid for at least `refresh_margin` seconds.
+
+        The stored token is used as is while it is fresh, refreshed when it is
+        about to expire and replaced through the browser flow otherwise.
+        """
+        creds = self.load()
+        if creds is not None and self.is_fresh(creds):
+            return creds
+        if creds is not None and creds.refresh_token:
+            try:
+                return self.refresh(creds)
+            except Exception as e:
+                print("Error refreshing the token, authorizing again", e)
+        return self.authorize()
+
+    def keep_fresh(self, creds):
+        """Refresh `creds` in a background thread shortly before each expiry."""
+        if self._refresher is not None:
+            return
+
+        def run():
+            while not self._stop.is_set():
+                remaining = self.expires_in(creds)
+                wait = 3600 if remaining is None else remaining - self.refresh_margin
+                if self._stop.wait(max(wait, 0)):
+                    return
+                try:
+                    self.refresh(creds)
+                except Exception as e:
+                    print("Error refreshing the token", e)
+                    self._stop.wait(60)
+
+        self._refresher = threading.Thread(target=run, daemon=True)
+        self._refresher.start()
+
+    def clear(self):
+        self._stop.set()
+        if os.path.exists(self.token_path):
+            os.remove(self.token_path)
@@ -1,12 +1,20 @@
 import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
 from dotenv import load_dotenv
 from .google import GoogleService
+from .pager import MessagePager
+from .ratelimit import RateLimiter, is_retryable, request_units
 
 load_dotenv()
 
+history_types = ["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"]
+
 
 class GmailService(GoogleService):
-    def __init__(self, scopes=None, cred_path=None, token_path=None):
+    def __init__(
+        self, scopes=None, cred_path=None, token_path=None, user_id="me", root_url=None
+    ):
         default_scopes = [
             os.getenv(
                 "GMAIL_READ_SCOPE", "https://www.googleapis.com/auth/gmail.readonly"
@@ -15,46 +23,223 @@ class GmailService(GoogleService):
                 "GMAIL_MODIFY_SCOPE", "https://www.googleapis.com/auth/gmail.modify"
             ),
         ]
-        super().__init__("gmail", "v1", scopes or default_scopes, cred_path, token_path)
+        super().__init__(
+            "gmail", "v1", scopes or default_scopes, cred_path, token_path, root_url
+        )
+        # "me" is the mailbox the token belongs to
+        self.user_id = user_id
         self.page_size = int(os.getenv("GMAIL_PAGE_SIZE", "5"))
+        # Gmail recommends keeping batches at 50 requests or fewer
+        self.batch_size = int(os.getenv("GMAIL_BATCH_SIZE", "50"))
+        self.fetch_concurrency = int(os.getenv("GMAIL_FETCH_CONCURRENCY", "4"))
+        self.max_retries = int(os.getenv("GMAIL_MAX_RETRIES", "5"))
+        self.backoff_base = float(os.getenv("GMAIL_BACKOFF_BASE", "1"))
+        self.prefetch_pages = int(os.getenv("GMAIL_PREFETCH_PAGES", "2"))
+        # batchModify accepts at most 1000 ids per call
+        self.modify_batch_size = min(
+            1000, int(os.getenv("GMAIL_MODIFY_BATCH_SIZE", "1000"))
+        )
+        self.modify_concurrency = int(os.getenv("GMAIL_MODIFY_CONCURRENCY", "4"))
+        self.pager = None
+        # Latest mailbox history id seen by history_list
+        self.history_id = None
+        self.messages_fetched = 0
+        # Quota is per mailbox, so every thread of the service shares it
+        self.rate_limiter = RateLimiter()
+
+    def execute(self, request):
+        return self.rate_limiter.call(
+            lambda: super(GmailService, self).execute(request),
+            request_units(request),
+            self.max_retries,
+            self.backoff_base,
+        )
 
-    def messages_list(self, pageToken=None, remainingMessages=1000, labels=["INBOX"]):
+    def message_pages(self, pageToken=None, remainingMessages=1000, labels=["INBOX"]):
         if self.service is None:
             self.authenticate()
+        return MessagePager(
+            self, pageToken, remainingMessages, labels, prefetch=self.prefetch_pages
+        )
 
-        if remainingMessages <= 0:
-            return
+    def messages_list(
+        self, pageToken=None, remainingMessages=1000, labels=["INBOX"], batched=False
+    ):
+        # The pager of the running listing is kept on the service so callers can
+        # watch its prefetch depth while consuming messages.
+        self.pager = self.message_pages(pageToken, remainingMessages, labels)
+        message_ids = (message_id for page in self.pager for message_id in page)
+        try:
+            if batched:
+                yield from self.messages_batch_get(message_ids)
+                return
 
-        results = (
-            self.service.users()
-            .messages()
-            .list(
-                userId="me",
-                pageToken=pageToken,
-                maxResults=min(remainingMessages, self.page_size),
-                labelIds=labels,
-            )
-            .execute()
-        )
+            for message_id in message_ids:
+                yield self.execute(
+                    self.service.users()
+                    .messages()
+                    .get(userId=self.user_id, id=message_id)
+                )
+        finally:
+            self.pager.close()
 
-        messages = results.get("messages", [])
-        pageToken = results.get("nextPageToken")
+    def messages_batch_get(
+        self, message_ids, format="full", onDropped=None, onGaveUp=None
+    ):
+        """
+        Fetch messages through HTTP batch requests, keeping up to
+        `fetch_concurrency` batches in flight at once.
 
-        if len(messages) == 0:
-            return
+        Args:
+            message_ids: Iterable of message ids, consumed lazily
+            format: Gmail message format to request
+            onDropped: Called with the ids of a batch that can never be
+                fetched, e.g. deleted meanwhile
+            onGaveUp: Called with the ids of a batch still failing with a
+                retryable error (rate limited, 5xx) after `max_retries`, which
+                a later attempt may fetch
 
-        for message in messages:
-            yield (
-                self.service.users()
-                .messages()
-                .get(userId="me", id=message["id"])
-                .execute()
+        Yields:
+            Message resources in the order their batches complete
+        """
+        if self.service is None:
+            self.authenticate()
+
+        message_ids = iter(message_ids)
+        with ThreadPoolExecutor(max_workers=self.fetch_concurrency) as executor:
+            pending = set()
+            while True:
+                while len(pending) < self.fetch_concurrency:
+                    chunk = list(islice(message_ids, self.batch_size))
+                    if not chunk:
+                        break
+                    pending.add(executor.submit(self._batch_get, chunk, format))
+                if not pending:
+                    return
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    messages, dropped, gave_up = future.result()
+                    self.messages_fetched += len(messages)
+                    if dropped and onDropped:
+                        onDropped(dropped)
+                    if gave_up and onGaveUp:
+                        onGaveUp(gave_up)
+                    yield from messages
+
+    def _batch_get(self, message_ids, format):
+        messages = []
+        dropped = []
+        gave_up = []
+        retry_ids = list(message_ids)
+        attempt = 0
+        while retry_ids:
+            failed_ids = []
+            failed_errors = []
+
+            def callback(request_id, response, exception):
+                if exception is None:
+                    messages.append(response)
+                elif is_retryable(exception):
+                    failed_ids.append(request_id)
+                    failed_errors.append(exception)
+                else:
+                    print(f"Error fetching message {request_id}", exception)
+                    dropped.append(request_id)
+
+            batch = self.service.new_batch_http_request(callback=callback)
+            for message_id in retry_ids:
+                batch.add(
+                    self.service.users()
+                    .messages()
+                    .get(userId=self.user_id, id=message_id, format=format),
+                    request_id=message_id,
+                )
+            self.execute(batch)
+
+            if not failed_ids:
+                break
+            # Parts of a batch are rate limited on their own, the batch
+            # itself succeeds
+            error = failed_errors[-1]
+            self.rate_limiter.record(error)
+            attempt += 1
+            if attempt > self.max_retries:
+                print(f"Giving up on {len(failed_ids)} messages after {attempt} attempts")
+                gave_up.extend(failed_ids)
+                break
+            self.rate_limiter.sleep(
+                self.rate_limiter.backoff(attempt, self.backoff_base, error)
             )
+            retry_ids = failed_ids
+        return messages, dropped, gave_up
 
-        if pageToken:
-            yield from self.messages_list(
-                pageToken, remainingMessages - len(messages), labels
+    def get_profile(self):
+        if self.service is None:
+            self.authenticate()
+
+        return self.execute(self.service.users().getProfile(userId=self.user_id))
+
+    def watch(self, topic_name, labels=["INBOX"]):
+        """
+        Ask Gmail to publish mailbox changes to a Cloud Pub/Sub topic.
+
+        The watch expires after 7 days, so it has to be renewed (Google
+        recommends once a day).
+
+        Args:
+            topic_name: Full topic name, projects/<project>/topics/<topic>
+
+        Returns:
+            {"historyId": ..., "expiration": epoch milliseconds}
+        """
+        if self.service is None:
+            self.authenticate()
+
+        body = {"topicName": topic_name, "labelIds": labels}
+        return self.execute(self.service.users().watch(userId=self.user_id, body=body))
+
+    def stop_watch(self):
+        if self.service is None:
+            self.authenticate()
+
+        return self.execute(self.service.users().stop(userId=self.user_id))
+
+    def history_list(self, startHistoryId, historyTypes=None):
+        """
+        Iterate over the mailbox changes recorded since `startHistoryId`.
+
+        Args:
+            startHistoryId: History id of the last synced state
+            historyTypes: Change types to list, defaults to all of them
+
+        Yields:
+            History records, oldest first
+
+        Raises:
+            HttpError with status 404 when `startHistoryId` is too old for
+            Gmail to answer from its history and a full sync is needed
+        """
+        if self.service is None:
+            self.authenticate()
+
+        historyTypes = historyTypes or history_types
+        pageToken = None
+        while True:
+            results = self.execute(
+                self.service.users()
+                .history()
+                .list(
+                    userId=self.user_id,
+                    startHistoryId=startHistoryId,
+                    historyTypes=historyTypes,
+                    pageToken=pageToken,
+                )
             )
+            self.history_id = results.get("historyId", self.history_id)
+            yield from results.get("history", [])
+            pageToken = results.get("nextPageToken")
+            if not pageToken:
+                return
 
     def bulk_modify_message_labels(
         self, message_ids, add_labels=None, remove_labels=None
@@ -71,9 +256,8 @@ class GmailService(GoogleService):
             "removeLabelIds": remove_labels,
         }
 
-        return (
+        return self.execute(
             self.service.users()
             .messages()
-            .batchModify(userId="me", body=body)
-            .execute()
+            .batchModify(userId=self.user_id, body=body)
         )
@@ -1,16 +1,23 @@
 import os
 import json
+import threading
 from dotenv import load_dotenv
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from .credentials import CredentialStore
+from .transport import HttpPool
 
 load_dotenv()
 
 
 class GoogleService:
-    def __init__(self, service_name, version, scopes, cred_path=None, token_path=None):
+    def __init__(
+        self,
+        service_name,
+        version,
+        scopes,
+        cred_path=None,
+        token_path=None,
+        root_url=None,
+    ):
         self.service_name = service_name
         self.version = version
         self.scopes = scopes
@@ -18,31 +25,95 @@ class GoogleService:
             "GOOGLE_CREDENTIALS_PATH", "credentials.json"
         )
         self.token_path = token_path or os.getenv("GOOGLE_TOKEN_PATH", "token.json")
+        # Another API root, e.g. a local fake server, instead of Google's
+        self.root_url = root_url
+        # Empty disables the on-disk discovery document cache
+        self.discovery_cache_dir = os.getenv(
+            "GOOGLE_DISCOVERY_CACHE_DIR", ".cache/discovery"
+        )
+        self.credential_store = CredentialStore(
+            self.token_path, self.scopes, self.cred_path
+        )
         self.service = None
+        self.credentials = None
+        self._http_pool = None
+        self._http_pool_lock = threading.Lock()
+
+    def _discovery_path(self):
+        return os.path.join(
+            self.discovery_cache_dir, f"{self.service_name}.{self.version}.json"
+        )
+
+    def _build(self, creds):
+        # The googleapiclient import is the bulk of the startup time, so it is
+        # only paid by the runs that talk to Google
+        from googleapiclient.discovery import build, build_from_document
+
+        path = self._discovery_path() if self.discovery_cache_dir else None
+        document = None
+        if path and os.path.exists(path):
+            try:
+                with open(path) as cached:
+                    document = json.load(cached)
+            except ValueError as e:
+                print("Ignoring unreadable discovery document", path, e)
 
-    def authenticate(self):
-        creds = None
-        if os.path.exists(self.token_path):
-            creds = Credentials.from_authorized_user_info(
-                json.loads(open(self.token_path).read()), self.scopes
-            )
-
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    self.cred_path, self.scopes
-                )
-                creds = flow.run_local_server(port=0)
-
-            with open(self.token_path, "w") as token:
-                token.write(creds.to_json())
-
-        self.service = build(self.service_name, self.version, credentials=creds)
+        if document is None:
+            service = build(self.service_name, self.version, credentials=creds)
+            document = service._rootDesc
+            if path:
+                try:
+                    os.makedirs(self.discovery_cache_dir, exist_ok=True)
+                    with open(f"{path}.tmp", "w") as cached:
+                        json.dump(document, cached)
+                    os.replace(f"{path}.tmp", path)
+                except OSError as e:
+                    print("Error caching the discovery document", e)
+            if not self.root_url:
+                return service
+
+        if self.root_url:
+            # rootUrl rather than the api_endpoint client option, which does
+            # not move the batch endpoint
+            document = dict(document, rootUrl=self.root_url)
+        return build_from_document(document, credentials=creds)
+
+    def authenticate(self, keep_fresh=False):
+        """
+        Load the stored token, refreshing it or running the browser flow when
+        needed, and build the API client.
+
+        Args:
+            keep_fresh: Refresh the token in the background before it expires,
+                for long-running processes
+        """
+        creds = self.credential_store.get()
+        self.credentials = creds
+        self.close()
+        self.service = self._build(creds)
+        if keep_fresh:
+            self.credential_store.keep_fresh(creds)
         print("Authenticated... Let's Go...")
         return self.service
 
+    @property
+    def http_pool(self):
+        # Requests go through pooled keep-alive transports rather than the
+        # single, not thread-safe one built into the service
+        with self._http_pool_lock:
+            if self._http_pool is None:
+                self._http_pool = HttpPool(self.credentials)
+            return self._http_pool
+
+    def execute(self, request):
+        return self.http_pool.execute(request)
+
+    def close(self):
+        with self._http_pool_lock:
+            if self._http_pool is not None:
+                self._http_pool.close()
+                self._http_pool = None
+
     def logout(self):
-        if os.path.exists(self.token_path):
-            os.remove(self.token_path)
+        """Forget the stored token, the next run goes through the browser flow."""
+        self.credential_store.clear()
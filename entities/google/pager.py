@@ -0,0 +1,107 @@
+import queue
+import threading
+import time
+
+_done = object()
+
+
+class Page(list):
+    """Message ids of one listing page, with the token of the page after it."""
+
+    def __init__(self, message_ids, next_page_token=None):
+        super().__init__(message_ids)
+        self.next_page_token = next_page_token
+
+
+class MessagePager:
+    """
+    Iterates over pages of message ids, listing the next pages on a
+    background thread while the current one is being processed.
+
+    Args:
+        gmail: Authenticated GmailService
+        pageToken: Page token to start listing from
+        remainingMessages: Maximum number of message ids to list
+        labels: Label ids to filter on
+        prefetch: Number of pages that may be listed ahead of the consumer
+    """
+
+    def __init__(
+        self, gmail, pageToken=None, remainingMessages=1000, labels=None, prefetch=2
+    ):
+        self.gmail = gmail
+        self.page_token = pageToken
+        self.remaining_messages = remainingMessages
+        self.labels = labels
+        self.prefetch = prefetch
+        self.pages_fetched = 0
+        self.max_depth = 0
+        self.wait_time = 0.0
+        self._queue = queue.Queue(maxsize=max(1, prefetch))
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def __iter__(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._fetch_pages, daemon=True)
+            self._thread.start()
+        try:
+            while True:
+                started = time.monotonic()
+                item = self._queue.get()
+                self.wait_time += time.monotonic() - started
+                if item is _done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        self._stop.set()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                self.max_depth = max(self.max_depth, self._queue.qsize())
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fetch_pages(self):
+        page_token = self.page_token
+        remaining = self.remaining_messages
+        try:
+            while remaining > 0 and not self._stop.is_set():
+                results = self.gmail.execute(
+                    self.gmail.service.users()
+                    .messages()
+                    .list(
+                        userId=self.gmail.user_id,
+                        pageToken=page_token,
+                        maxResults=min(remaining, self.gmail.page_size),
+                        labelIds=self.labels,
+                    )
+                )
+                messages = results.get("messages", [])
+                page_token = results.get("nextPageToken")
+                if not messages:
+                    break
+                self.pages_fetched += 1
+                remaining -= len(messages)
+                page = Page([message["id"] for message in messages], page_token)
+                if not self._put(page):
+                    return
+                if not page_token:
+                    break
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(_done)
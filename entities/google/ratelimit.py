@@ -0,0 +1,282 @@
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+rate_limit_reasons = ["rateLimitExceeded", "userRateLimitExceeded"]
+
+# Quota units Gmail charges per call, see
+# https://developers.google.com/gmail/api/reference/quota
+quota_units = {
+    "gmail.users.getProfile": 1,
+    "gmail.users.watch": 100,
+    "gmail.users.stop": 50,
+    "gmail.users.history.list": 2,
+    "gmail.users.messages.list": 5,
+    "gmail.users.messages.get": 5,
+    "gmail.users.messages.batchModify": 50,
+}
+default_units = 5
+
+
+def request_units(request):
+    """Quota units of a googleapiclient request, every part of a batch counts."""
+    parts = getattr(request, "_requests", None)
+    if parts is not None:
+        return sum(request_units(part) for part in parts.values())
+    return quota_units.get(getattr(request, "methodId", None), default_units)
+
+
+def is_rate_limited(error):
+    from googleapiclient.errors import HttpError
+
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status == 429:
+        return True
+    if error.resp.status == 403:
+        return any(
+            detail.get("reason") in rate_limit_reasons
+            for detail in (error.error_details or [])
+            if isinstance(detail, dict)
+        )
+    return False
+
+
+def is_retryable(error):
+    from googleapiclient.errors import HttpError
+
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    if isinstance(error, HttpError) and error.resp.status >= 500:
+        return True
+    return is_rate_limited(error)
+
+
+def retry_after(error):
+    # Seconds Gmail asked us to wait, when it said so
+    resp = getattr(error, "resp", None)
+    try:
+        return float(resp.get("retry-after")) if resp is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Paces requests to `rate` quota units per second, with bursts of up to
+    `capacity` units.
+
+    Callers reserve units ahead of time and the balance may go negative, so
+    waiting callers are served in order and a request larger than the
+    capacity (a batch of 50 gets is 250 units) still goes through.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, units):
+        """Take `units`, returns the seconds to wait before using them."""
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= units
+            return max(0.0, -self.tokens / self.rate)
+
+
+class RateLimiter:
+    """
+    Keeps the Gmail calls of one mailbox just under its quota.
+
+    Every call goes through `call()`, which
+    - waits for one of `concurrency` slots,
+    - takes the call's quota units from a token bucket refilled at
+      `target` times the per-user quota, with the rest of the quota as the
+      burst,
+    - retries rate limited, 5xx and connection errors with jittered
+      exponential backoff, honouring Retry-After,
+    - adapts both limits with AIMD: rate limit errors cut the bucket rate and
+      the concurrency, 5xx and connection errors only the concurrency, and
+      both grow back slowly while calls succeed.
+
+    Decreases happen at most once per `cooldown` seconds, so a burst of
+    errors from the calls already in flight counts once. The limiter is
+    thread-safe and shared by all the threads of a GmailService.
+
+    Args:
+        units_per_second: Gmail's per-user quota, 0 disables the bucket
+        target: Fraction of the quota to aim for
+        max_concurrency: Upper bound of the concurrent calls
+    """
+
+    def __init__(
+        self,
+        units_per_second=None,
+        target=None,
+        max_concurrency=None,
+        cooldown=1.0,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        if units_per_second is None:
+            units_per_second = float(
+                os.getenv("GMAIL_QUOTA_UNITS_PER_SECOND", "250")
+            )
+        self.target = target or float(os.getenv("GMAIL_QUOTA_TARGET", "0.9"))
+        self.max_rate = units_per_second * self.target
+        self.bucket = None
+        if self.max_rate:
+            # Bursts only use the headroom left under the quota, so no second
+            # goes over it
+            headroom = units_per_second - self.max_rate
+            self.bucket = TokenBucket(self.max_rate, headroom or None, clock=clock)
+        self.max_concurrency = max_concurrency or int(
+            os.getenv("GMAIL_HTTP_POOL_SIZE", "8")
+        )
+        self.concurrency = float(self.max_concurrency)
+        self.cooldown = cooldown
+        self.clock = clock
+        self.sleep = sleep
+        self.in_flight = 0
+        self.calls = 0
+        self.units = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self.throttled_time = 0.0
+        self._condition = threading.Condition()
+        self._last_decrease = None
+        self._last_increase = clock()
+
+    @property
+    def rate(self):
+        return self.bucket.rate if self.bucket else 0.0
+
+    @contextmanager
+    def slot(self, units):
+        """Hold a concurrency slot and `units` quota units for one call."""
+        started = self.clock()
+        with self._condition:
+            while self.in_flight >= int(self.concurrency):
+                self._condition.wait()
+            self.in_flight += 1
+        try:
+            delay = self.bucket.reserve(units) if self.bucket else 0.0
+            if delay:
+                self.sleep(delay)
+            with self._condition:
+                self.calls += 1
+                self.units += units
+                self.throttled_time += self.clock() - started
+            yield
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self._condition.notify()
+
+    def pace(self, units):
+        """
+        Take `units` from the bucket for a call made outside `call()`, by a
+        caller bounding its own concurrency. Returns the seconds to wait
+        before making it.
+        """
+        delay = self.bucket.reserve(units) if self.bucket else 0.0
+        with self._condition:
+            self.calls += 1
+            self.units += units
+            self.throttled_time += delay
+        return delay
+
+    def record(self, error=None):
+        """Adjust the limits after a call, `error` is None when it succeeded."""
+        now = self.clock()
+        with self._condition:
+            if error is None:
+                # Additive increase: one more slot per window of `concurrency`
+                # successful calls, and the whole rate back in 20 seconds
+                self.concurrency = min(
+                    self.max_concurrency, self.concurrency + 1 / self.concurrency
+                )
+                if self.bucket:
+                    recovered = self.max_rate * (now - self._last_increase) / 20
+                    self.bucket.rate = min(self.max_rate, self.bucket.rate + recovered)
+                self._last_increase = now
+                self._condition.notify_all()
+                return
+
+            rate_limited = is_rate_limited(error)
+            if rate_limited:
+                self.rate_limited += 1
+            else:
+                self.errors += 1
+            last = self._last_decrease
+            if last is not None and now - last < self.cooldown:
+                return
+            self._last_decrease = now
+            self._last_increase = now
+            self.concurrency = max(1.0, self.concurrency / 2)
+            if rate_limited and self.bucket:
+                self.bucket.rate = max(self.max_rate / 10, self.bucket.rate * 0.7)
+
+    def backoff(self, attempt, backoff_base=1.0, error=None):
+        """Seconds to wait before retry `attempt` (1 for the first retry)."""
+        delay = min(64, backoff_base * 2 ** (attempt - 1)) * random.uniform(0.5, 1)
+        with self._condition:
+            self.retries += 1
+        return max(delay, retry_after(error) or 0)
+
+    def call(self, function, units=default_units, max_retries=5, backoff_base=1.0):
+        """Run `function()` under the limits, retrying retryable errors."""
+        attempt = 0
+        while True:
+            try:
+                with self.slot(units):
+                    result = function()
+            except Exception as error:
+                if not is_retryable(error):
+                    raise
+                self.record(error)
+                attempt += 1
+                if attempt > max_retries:
+                    raise
+                self.sleep(self.backoff(attempt, backoff_base, error))
+                continue
+            self.record()
+            return result
+
+    def stats(self):
+        with self._condition:
+            return {
+                "rate": round(self.rate, 1),
+                "max_rate": self.max_rate,
+                "concurrency": int(self.concurrency),
+                "max_concurrency": self.max_concurrency,
+                "calls": self.calls,
+                "units": self.units,
+                "retries": self.retries,
+                "rate_limited": self.rate_limited,
+                "errors": self.errors,
+                "throttled_seconds": round(self.throttled_time, 3),
+            }
+
+    def __str__(self):
+        stats = self.stats()
+        return (
+            f"rate limiter: {stats['calls']} calls, {stats['units']} units, "
+            f"{stats['rate']}/{stats['max_rate']:g} units/s, concurrency "
+            f"{stats['concurrency']}/{stats['max_concurrency']}, "
+            f"{stats['rate_limited']} rate limited, {stats['errors']} errors, "
+            f"{stats['retries']} retries, {stats['throttled_seconds']}s throttled"
+        )
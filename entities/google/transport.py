@@ -0,0 +1,137 @@
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class PooledHttp:
+    """An authorized httplib2 transport and how often it was used."""
+
+    def __init__(self, http, number):
+        self.http = http
+        self.number = number
+        self.requests = 0
+
+    def connections(self):
+        # httplib2 keeps one keep-alive connection per scheme and host
+        http = getattr(self.http, "http", self.http)
+        return len(http.connections)
+
+    def close(self):
+        http = getattr(self.http, "http", self.http)
+        http.close()
+
+
+class HttpPool:
+    """
+    Pool of authorized HTTP transports with keep-alive connections.
+
+    httplib2.Http is not thread-safe, so a transport is only ever used by one
+    thread at a time: `connection()` checks one out and returns it to the pool
+    afterwards, keeping its TCP/TLS connection open for the next request.
+    Callers wait when all `size` transports are in use, so the pool also
+    bounds the number of requests in flight. The pool can be shared between
+    worker threads, including the executor threads of an asyncio loop.
+
+    Args:
+        credentials: google-auth credentials added to every request, or None
+        size: Maximum number of transports
+        timeout: Socket timeout of every request, in seconds
+    """
+
+    def __init__(self, credentials=None, size=None, timeout=None):
+        self.credentials = credentials
+        self.size = size or int(os.getenv("GMAIL_HTTP_POOL_SIZE", "8"))
+        self.timeout = timeout or float(os.getenv("GMAIL_HTTP_TIMEOUT", "60"))
+        # Most recently used first, so a few warm connections serve light loads
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._lock = threading.Lock()
+        self._transports = []
+        self.checkouts = 0
+        self.discarded = 0
+
+    def _create(self):
+        import httplib2
+
+        http = httplib2.Http(timeout=self.timeout)
+        if self.credentials is not None:
+            from google_auth_httplib2 import AuthorizedHttp
+
+            http = AuthorizedHttp(self.credentials, http=http)
+        with self._lock:
+            transport = PooledHttp(http, len(self._transports) + self.discarded)
+            self._transports.append(transport)
+        return transport
+
+    def _discard(self, transport):
+        transport.close()
+        with self._lock:
+            self._transports.remove(transport)
+            self.discarded += 1
+
+    @contextmanager
+    def connection(self):
+        """Check out a transport for one or more requests."""
+        with self._slots:
+            try:
+                transport = self._idle.get_nowait()
+            except queue.Empty:
+                transport = self._create()
+            with self._lock:
+                self.checkouts += 1
+                transport.requests += 1
+            try:
+                yield transport.http
+            except (OSError, ConnectionError):
+                # The connection may be half closed, don't hand it out again
+                self._discard(transport)
+                raise
+            except BaseException:
+                self._idle.put(transport)
+                raise
+            self._idle.put(transport)
+
+    def execute(self, request):
+        """Execute a googleapiclient HttpRequest or BatchHttpRequest."""
+        with self.connection() as http:
+            return request.execute(http=http)
+
+    def stats(self):
+        with self._lock:
+            transports = list(self._transports)
+            checkouts = self.checkouts
+        return {
+            "size": self.size,
+            "transports": len(transports),
+            "idle": self._idle.qsize(),
+            "checkouts": checkouts,
+            "reused": checkouts - len(transports) - self.discarded,
+            "discarded": self.discarded,
+            "per_transport": {
+                transport.number: {
+                    "requests": transport.requests,
+                    "connections": transport.connections(),
+                }
+                for transport in transports
+            },
+        }
+
+    def close(self):
+        while True:
+            try:
+                transport = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            transport.close()
+
+    def __str__(self):
+        stats = self.stats()
+        return (
+            f"http pool: {stats['transports']}/{stats['size']} transports, "
+            f"{stats['checkouts']} checkouts, {stats['reused']} reused, "
+            f"{stats['discarded']} discarded"
+        )
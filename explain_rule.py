@@ -0,0 +1,84 @@
+import json
+import sys
+from utils.rule_engine import load_rules, get_rule_conditions
+from entities.db.googledb import GoogleDB, _rule_matches_query
+
+rule_location = "config/rule.json"
+scanned_tables = ["messages", "message_labels"]
+
+
+def get_rules(location):
+    with open(location, "r") as file:
+        return load_rules(json.load(file))
+
+
+def print_plan(node, depth=0):
+    relation = node.get("Relation Name")
+    index = node.get("Index Name")
+    target = f" on {relation}" if relation else ""
+    target += f" using {index}" if index else ""
+    line = (
+        f"{'  ' * depth}-> {node['Node Type']}{target} "
+        f"(cost={node['Startup Cost']}..{node['Total Cost']} rows={node['Plan Rows']})"
+    )
+    if "Actual Total Time" in node:
+        line += f" (actual time={node['Actual Total Time']} rows={node['Actual Rows']})"
+    print(line)
+    for condition in ["Filter", "Index Cond", "Recheck Cond"]:
+        if condition in node:
+            print(f"{'  ' * depth}     {condition}: {node[condition]}")
+    for child in node.get("Plans", []):
+        print_plan(child, depth + 1)
+
+
+def full_scans(node):
+    scans = []
+    if node["Node Type"] == "Seq Scan" and node.get("Relation Name") in scanned_tables:
+        scans.append(node["Relation Name"])
+    for child in node.get("Plans", []):
+        scans += full_scans(child)
+    return scans
+
+
+def explain(rules, analyze):
+    # The rules are matched together, in the query 2_update_emails.py runs
+    conditions = []
+    for rule, condition in zip(rules, get_rule_conditions(rules)):
+        if condition == "false":
+            print(f"{rule['name']}: can never match, left out of the query")
+            continue
+        print(f"{rule['name']}: {condition}")
+        conditions.append(condition)
+    if not conditions:
+        print("No rule can match, no query is run")
+        return 0
+    db = GoogleDB()
+    print(f"\n{_rule_matches_query(conditions, db.account)}\n")
+
+    result = db.explain_rule_matches(
+        conditions,
+        analyze=analyze,
+        onError=lambda error: print("Error explaining the rules", error),
+    )
+    if result is None:
+        return 2
+
+    print_plan(result["Plan"])
+    print(f"\nEstimated total cost: {result['Plan']['Total Cost']}")
+    scans = full_scans(result["Plan"])
+    if scans:
+        print(f"Warning: the rules fall back to a full scan of {', '.join(scans)}")
+        return 1
+    print("The rules are served by indexes")
+    return 0
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    location = args[0] if args else rule_location
+    analyze = "--analyze" in sys.argv[1:]
+    return explain(get_rules(location), analyze)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+"""
+In-memory stand-ins for GoogleDB and its writer, used by the tests of the
+sync, the daemon and the coordinator.
+"""
+
+
+class RecordingWriter:
+    """Writes every row through bulk_upsert_emails, like a writer of batch size 1."""
+
+    def __init__(self, db, onError=None, onCommit=None):
+        self.db = db
+        self.onError = onError
+        self.onCommit = onCommit
+        self.written = 0
+        self.failed = 0
+        self.failed_batches = 0
+        self.error = None
+
+    def add(self, data):
+        self.db.bulk_upsert_emails(
+            [data],
+            onSuccess=lambda count: self._committed(data),
+            onError=self._failed,
+        )
+
+    def _committed(self, data):
+        self.written += 1
+        if self.onCommit:
+            self.onCommit([data["message_id"]])
+
+    def _failed(self, error):
+        self.failed += 1
+        self.failed_batches += 1
+        self.error = error
+        if self.onError is None:
+            raise error
+        return self.onError(error)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class RecordingDB:
+    """In-memory stand-in for the GoogleDB methods the sync functions use."""
+
+    def __init__(self):
+        self.messages = {}
+        self.labels = {}
+        self.history_id = None
+        self.full_sync_progress = None
+
+    def writer(self, onError=None, onCommit=None):
+        return RecordingWriter(self, onError, onCommit)
+
+    def bulk_upsert_emails(self, email_data_list, onSuccess=None, onError=None):
+        for data in email_data_list:
+            self.messages[data["message_id"]] = data
+            self.labels[data["message_id"]] = set(data["labels"])
+        return onSuccess(len(email_data_list)) if onSuccess else len(email_data_list)
+
+    def bulk_insert_labels(self, message_id, labels, onSuccess=None, onError=None):
+        if message_id in self.messages:
+            self.labels.setdefault(message_id, set()).update(labels)
+
+    def delete_labels(self, message_id, labels, onSuccess=None, onError=None):
+        self.labels.get(message_id, set()).difference_update(labels)
+
+    def apply_label_changes(
+        self, message_ids, add_labels, remove_labels, onSuccess=None, onError=None
+    ):
+        for message_id in message_ids:
+            if message_id in self.labels:
+                self.labels[message_id].difference_update(remove_labels)
+                self.labels[message_id].update(add_labels)
+
+    def delete_emails(self, message_ids, onSuccess=None, onError=None):
+        for message_id in message_ids:
+            self.messages.pop(message_id, None)
+            self.labels.pop(message_id, None)
+
+    def get_history_id(self, sync_key="default", onError=None):
+        return self.history_id
+
+    def set_history_id(self, history_id, sync_key="default", onSuccess=None, onError=None):
+        self.history_id = history_id
+
+    def get_stored_labels(self, message_ids, onError=None):
+        return {
+            message_id: set(self.labels.get(message_id, ()))
+            for message_id in message_ids
+            if message_id in self.messages
+        }
+
+    def get_full_sync_progress(self, sync_key="default", onError=None):
+        return dict(self.full_sync_progress) if self.full_sync_progress else None
+
+    def set_full_sync_progress(
+        self, history_id, page_token, messages, sync_key="default", onSuccess=None,
+        onError=None
+    ):
+        self.full_sync_progress = {
+            "history_id": history_id,
+            "page_token": page_token,
+            "messages": messages,
+        }
+
+    def clear_full_sync_progress(self, sync_key="default", onSuccess=None, onError=None):
+        self.full_sync_progress = None
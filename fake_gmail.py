@@ -0,0 +1,371 @@
+"""
+A small local stand-in for the Gmail REST endpoint, used by the tests.
+
+It speaks just enough of the real protocol for googleapiclient to talk to it:
+messages.list, messages.get, messages.batchModify, getProfile, history.list
+and the multipart/mixed batch endpoint. Mailbox changes made through add_message, delete_message and
+modify_labels are recorded in the history. With `quota` set, requests beyond
+that many quota units per second are answered with 429, the way Gmail
+enforces its per-user limit.
+"""
+
+import base64
+import json
+import threading
+import time
+import urllib.parse
+from collections import deque
+from email.parser import FeedParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Quota units of every route, as Gmail charges them
+quota_units = {
+    "getProfile": 1,
+    "history.list": 2,
+    "messages.list": 5,
+    "messages.get": 5,
+    "messages.batchModify": 50,
+}
+
+rate_limit_error = {
+    "error": {
+        "code": 429,
+        "message": "Too many concurrent requests for user",
+        "errors": [{"reason": "rateLimitExceeded"}],
+    }
+}
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def make_message(message_id, sender="sender@example.com", subject="Hello",
+                 body="Hello there", labels=None, internal_date=1700000000000,
+                 thread_id=None):
+    data = base64.urlsafe_b64encode(body.encode("utf-8")).decode("ascii")
+    return {
+        "id": message_id,
+        "threadId": thread_id or message_id,
+        "labelIds": list(labels if labels is not None else ["INBOX"]),
+        "internalDate": str(internal_date),
+        "payload": {
+            "mimeType": "text/plain",
+            "headers": [
+                {"name": "From", "value": f"Sender <{sender}>"},
+                {"name": "To", "value": "Me <me@example.com>"},
+                {"name": "Subject", "value": subject},
+            ],
+            "body": {"data": data},
+        },
+    }
+
+
+class FakeGmailServer:
+    def __init__(self, messages=None, latency=0.0):
+        self.messages = {message["id"]: message for message in messages or []}
+        self.latency = latency
+        # message id -> number of 429 responses to send before succeeding
+        self.rate_limited = {}
+        # Number of 429 responses to send to batchModify before succeeding
+        self.modify_rate_limited = 0
+        # (ids, addLabelIds, removeLabelIds) of every successful batchModify
+        self.modify_calls = []
+        self.request_counts = {}
+        self.history = []
+        self.history_id = 1000
+        # Oldest start history id Gmail still answers for
+        self.history_floor = 0
+        self.history_page_size = 100
+        self.in_flight_batches = 0
+        self.max_in_flight_batches = 0
+        self.in_flight_modifies = 0
+        self.max_in_flight_modifies = 0
+        # TCP connections accepted, keep-alive requests reuse them
+        self.connections = 0
+        # Response body bytes sent, batch responses included
+        self.bytes_served = 0
+        # format -> number of messages.get served in that format
+        self.formats_served = {}
+        # Quota units per second over a sliding `quota_window`, 0 for no limit
+        self.quota = 0
+        self.quota_window = 1.0
+        self.units_served = 0
+        self.quota_rejected = 0
+        self._charges = deque()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def root_url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                with fake._lock:
+                    fake.connections += 1
+
+            def do_GET(self):
+                self._respond(*fake.handle("GET", self.path, None))
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length).decode("utf-8")
+                if self.path.startswith("/batch"):
+                    content_type, payload = fake.handle_batch(
+                        self.headers["Content-Type"], body
+                    )
+                    self._send(200, content_type, payload)
+                else:
+                    self._respond(*fake.handle("POST", self.path, body))
+
+            def _respond(self, status, data):
+                self._send(status, "application/json", json.dumps(data))
+
+            def _send(self, status, content_type, payload):
+                payload = payload.encode("utf-8")
+                with fake._lock:
+                    fake.bytes_served += len(payload)
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def build_service(self):
+        import httplib2
+        from googleapiclient.discovery import build_from_document
+        from googleapiclient.discovery_cache import get_static_doc
+
+        document = json.loads(get_static_doc("gmail", "v1"))
+        document["rootUrl"] = self.root_url
+        return build_from_document(document, http=httplib2.Http())
+
+    def _record(self, **change):
+        self.history_id += 1
+        self.history.append({"id": str(self.history_id), **change})
+
+    def add_message(self, message):
+        self.messages[message["id"]] = message
+        self._record(messagesAdded=[{"message": self._stub(message)}])
+
+    def delete_message(self, message_id):
+        message = self.messages.pop(message_id)
+        self._record(messagesDeleted=[{"message": self._stub(message)}])
+
+    def modify_labels(self, message_id, add=(), remove=()):
+        message = self.messages[message_id]
+        if add:
+            message["labelIds"] += [label for label in add if label not in message["labelIds"]]
+            self._record(labelsAdded=[{"message": self._stub(message), "labelIds": list(add)}])
+        if remove:
+            message["labelIds"] = [label for label in message["labelIds"] if label not in remove]
+            self._record(
+                labelsRemoved=[{"message": self._stub(message), "labelIds": list(remove)}]
+            )
+
+    def expire_history(self):
+        self.history_floor = self.history_id
+
+    def _stub(self, message):
+        return {
+            "id": message["id"],
+            "threadId": message["threadId"],
+            "labelIds": list(message["labelIds"]),
+        }
+
+    def _count(self, route):
+        units = quota_units.get(route, 0)
+        with self._lock:
+            self.request_counts[route] = self.request_counts.get(route, 0) + 1
+            if not self.quota:
+                self.units_served += units
+                return
+            now = time.monotonic()
+            while self._charges and self._charges[0][0] <= now - self.quota_window:
+                self._charges.popleft()
+            used = sum(charge for _, charge in self._charges)
+            if used + units > self.quota * self.quota_window:
+                self.quota_rejected += 1
+                raise QuotaExceeded()
+            self._charges.append((now, units))
+            self.units_served += units
+
+    def handle(self, method, path, body):
+        try:
+            return self._handle(method, path, body)
+        except QuotaExceeded:
+            return 429, rate_limit_error
+
+    def _handle(self, method, path, body):
+        parsed = urllib.parse.urlparse(path)
+        query = urllib.parse.parse_qs(parsed.query)
+        parts = parsed.path.strip("/").split("/")
+        # gmail/v1/users/{userId}/messages[/{id}]
+        if parts[:3] != ["gmail", "v1", "users"] or len(parts) < 5:
+            return 404, {"error": {"code": 404, "message": "Not found"}}
+        resource = parts[4:]
+        if method == "GET" and resource == ["profile"]:
+            self._count("getProfile")
+            return 200, {
+                "emailAddress": f"{parts[3]}@example.com",
+                "messagesTotal": len(self.messages),
+                "historyId": str(self.history_id),
+            }
+        if method == "GET" and resource == ["history"]:
+            self._count("history.list")
+            return self._history(query)
+        if method == "GET" and resource == ["messages"]:
+            self._count("messages.list")
+            return 200, self._list(query)
+        if method == "POST" and resource == ["messages", "batchModify"]:
+            self._count("messages.batchModify")
+            return self._batch_modify(json.loads(body))
+        if method == "GET" and len(resource) == 2 and resource[0] == "messages":
+            self._count("messages.get")
+            return self._get(
+                urllib.parse.unquote(resource[1]), query.get("format", ["full"])[0]
+            )
+        return 404, {"error": {"code": 404, "message": "Not found"}}
+
+    def _list(self, query):
+        labels = query.get("labelIds", [])
+        ids = [
+            message_id
+            for message_id, message in self.messages.items()
+            if all(label in message["labelIds"] for label in labels)
+        ]
+        start = int(query.get("pageToken", ["0"])[0])
+        size = int(query.get("maxResults", ["100"])[0])
+        page = ids[start : start + size]
+        result = {
+            "messages": [
+                {"id": message_id, "threadId": self.messages[message_id]["threadId"]}
+                for message_id in page
+            ],
+            "resultSizeEstimate": len(ids),
+        }
+        if start + size < len(ids):
+            result["nextPageToken"] = str(start + size)
+        return result
+
+    def _history(self, query):
+        start = int(query["startHistoryId"][0])
+        if start < self.history_floor:
+            return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+        records = [record for record in self.history if int(record["id"]) > start]
+        offset = int(query.get("pageToken", ["0"])[0])
+        page = records[offset : offset + self.history_page_size]
+        result = {"historyId": str(self.history_id)}
+        if page:
+            result["history"] = page
+        if offset + self.history_page_size < len(records):
+            result["nextPageToken"] = str(offset + self.history_page_size)
+        return 200, result
+
+    def _get(self, message_id, format="full"):
+        with self._lock:
+            remaining = self.rate_limited.get(message_id, 0)
+            if remaining:
+                self.rate_limited[message_id] = remaining - 1
+            if not remaining:
+                self.formats_served[format] = self.formats_served.get(format, 0) + 1
+        if remaining:
+            return 429, rate_limit_error
+        if message_id not in self.messages:
+            return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+        message = self.messages[message_id]
+        if format == "minimal":
+            return 200, dict(self._stub(message), historyId=str(self.history_id))
+        if format == "metadata":
+            payload = {"headers": message["payload"].get("headers", [])}
+            return 200, dict(message, payload=payload)
+        return 200, message
+
+    def _batch_modify(self, body):
+        with self._lock:
+            self.in_flight_modifies += 1
+            self.max_in_flight_modifies = max(
+                self.max_in_flight_modifies, self.in_flight_modifies
+            )
+            limited = self.modify_rate_limited > 0
+            if limited:
+                self.modify_rate_limited -= 1
+        try:
+            time.sleep(self.latency)
+            if limited:
+                return 429, rate_limit_error
+            ids = body.get("ids", [])
+            if len(ids) > 1000:
+                return 400, {"error": {"code": 400, "message": "Too many ids"}}
+            add = body.get("addLabelIds", [])
+            remove = body.get("removeLabelIds", [])
+            with self._lock:
+                self.modify_calls.append((list(ids), list(add), list(remove)))
+                for message_id in ids:
+                    if message_id in self.messages:
+                        self.modify_labels(message_id, add, remove)
+            return 200, {}
+        finally:
+            with self._lock:
+                self.in_flight_modifies -= 1
+
+    def handle_batch(self, content_type, body):
+        with self._lock:
+            self.in_flight_batches += 1
+            self.max_in_flight_batches = max(
+                self.max_in_flight_batches, self.in_flight_batches
+            )
+        try:
+            self._count("batch")
+            time.sleep(self.latency)
+            parser = FeedParser()
+            parser.feed(f"Content-Type: {content_type}\r\n\r\n{body}")
+            request = parser.close()
+            boundary = "fake_gmail_batch"
+            chunks = []
+            for part in request.get_payload():
+                request_line = part.get_payload().split("\n", 1)[0]
+                method, path, _ = request_line.split(" ", 2)
+                status, data = self.handle(method, path, None)
+                content_id = part["Content-ID"][1:-1]
+                chunks.append(
+                    f"--{boundary}\r\n"
+                    "Content-Type: application/http\r\n"
+                    f"Content-ID: <response-{content_id}>\r\n\r\n"
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    "Content-Type: application/json\r\n\r\n"
+                    f"{json.dumps(data)}\r\n"
+                )
+            chunks.append(f"--{boundary}--\r\n")
+            return f"multipart/mixed; boundary={boundary}", "".join(chunks)
+        finally:
+            with self._lock:
+                self.in_flight_batches -= 1
@@ -0,0 +1,87 @@
+import unittest
+from entities.google import GmailService
+from entities.google.ratelimit import RateLimiter
+from fake_gmail import FakeGmailServer, make_message
+from utils.action_planner import ActionPlanner
+
+
+class TestActionPlanner(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeGmailServer(
+            [make_message(f"m{i}") for i in range(2500)], latency=0.05
+        ).start()
+        self.gmail = GmailService()
+        self.gmail.service = self.server.build_service()
+        self.gmail.backoff_base = 0.01
+        # The fake server enforces no quota unless asked to
+        self.gmail.rate_limiter = RateLimiter(units_per_second=0)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_groups_messages_with_the_same_change(self):
+        changes = {f"m{i}": ({"STARRED"}, {"UNREAD"}) for i in range(2300)}
+        changes.update({f"m{i}": ({"IMPORTANT"}, set()) for i in range(2300, 2500)})
+        applied = []
+
+        with ActionPlanner(
+            self.gmail, onSuccess=lambda *call: applied.append(call)
+        ) as planner:
+            planner.add_changes(changes)
+
+        calls = sorted(
+            (len(ids), add, remove) for ids, add, remove in self.server.modify_calls
+        )
+        self.assertEqual(
+            calls,
+            [
+                (200, ["IMPORTANT"], []),
+                (300, ["STARRED"], ["UNREAD"]),
+                (1000, ["STARRED"], ["UNREAD"]),
+                (1000, ["STARRED"], ["UNREAD"]),
+            ],
+        )
+        self.assertEqual(planner.calls, 4)
+        self.assertEqual(planner.modified, 2500)
+        self.assertEqual(len(applied), 4)
+        self.assertIn("STARRED", self.server.messages["m0"]["labelIds"])
+
+    def test_calls_run_concurrently(self):
+        with ActionPlanner(self.gmail, batch_size=100, concurrency=3) as planner:
+            for i in range(1000):
+                planner.add(f"m{i}", ["STARRED"], [])
+
+        self.assertEqual(len(self.server.modify_calls), 10)
+        self.assertGreater(self.server.max_in_flight_modifies, 1)
+        self.assertLessEqual(self.server.max_in_flight_modifies, 3)
+
+    def test_skips_empty_changes(self):
+        with ActionPlanner(self.gmail) as planner:
+            planner.add("m0", [], [])
+        self.assertEqual(self.server.modify_calls, [])
+
+    def test_retries_rate_limited_calls(self):
+        self.server.modify_rate_limited = 2
+        with ActionPlanner(self.gmail) as planner:
+            planner.add("m0", ["STARRED"], [])
+
+        self.assertEqual(self.server.request_counts["messages.batchModify"], 3)
+        self.assertEqual(planner.modified, 1)
+
+    def test_reports_failed_calls(self):
+        self.gmail.max_retries = 0
+        self.server.modify_rate_limited = 1
+        failed = []
+
+        with ActionPlanner(
+            self.gmail, onError=lambda error, ids: failed.extend(ids)
+        ) as planner:
+            planner.add("m0", ["STARRED"], [])
+
+        self.assertEqual(failed, ["m0"])
+        self.assertEqual(planner.failed, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,170 @@
+import asyncio
+import importlib.util
+import unittest
+from entities.google import GmailService
+from entities.google.ratelimit import RateLimiter
+from fake_gmail import FakeGmailServer, make_message
+from utils.blocking import Blocking
+
+has_aiohttp = importlib.util.find_spec("aiohttp") is not None
+
+
+class Counter:
+    def __init__(self):
+        self.closed = False
+        self.label = "counter"
+
+    async def add(self, a, b):
+        await asyncio.sleep(0)
+        return a + b
+
+    async def count(self, n):
+        for i in range(n):
+            yield i
+
+    async def close(self):
+        self.closed = True
+
+
+class TestBlocking(unittest.TestCase):
+
+    def test_coroutines_and_generators(self):
+        counter = Counter()
+        with Blocking(counter) as blocking:
+            self.assertEqual(blocking.add(2, 3), 5)
+            self.assertEqual(list(blocking.count(4)), [0, 1, 2, 3])
+            self.assertEqual(blocking.label, "counter")
+        self.assertTrue(counter.closed)
+
+    def test_generator_closed_early(self):
+        with Blocking(Counter()) as blocking:
+            numbers = blocking.count(100)
+            self.assertEqual(next(numbers), 0)
+            numbers.close()
+            self.assertEqual(blocking.add(1, 1), 2)
+
+
+@unittest.skipUnless(has_aiohttp, "aiohttp is not installed")
+class TestAsyncGmailService(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeGmailServer(
+            [make_message(f"m{i}") for i in range(300)], latency=0.05
+        ).start()
+        self.gmail = GmailService()
+        self.gmail.page_size = 100
+        self.gmail.backoff_base = 0.01
+        # Unpaced unless a test sets a quota
+        self.gmail.rate_limiter = RateLimiter(units_per_second=0)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def client(self, concurrency):
+        from entities.google.async_gmail import AsyncGmailService
+
+        return AsyncGmailService(
+            self.gmail, concurrency=concurrency, root_url=self.server.root_url
+        )
+
+    def test_messages_list_keeps_requests_in_flight(self):
+        async def run():
+            async with self.client(concurrency=50) as client:
+                await client.open()
+                messages = [
+                    message async for message in client.messages_list(
+                        remainingMessages=250
+                    )
+                ]
+                return messages, client.max_in_flight
+
+        messages, max_in_flight = asyncio.run(run())
+        self.assertEqual(len(messages), 250)
+        self.assertEqual(len({message["id"] for message in messages}), 250)
+        self.assertLessEqual(max_in_flight, 50)
+        self.assertGreater(max_in_flight, 10)
+        self.assertEqual(self.server.request_counts["messages.list"], 3)
+
+    def test_rate_limited_requests_are_retried(self):
+        self.server.rate_limited = {"m1": 2}
+        self.server.modify_rate_limited = 1
+
+        async def run():
+            async with self.client(concurrency=10) as client:
+                await client.open()
+                message = await client.messages_get("m1")
+                await client.bulk_modify_message_labels(["m1", "m2"], ["STARRED"])
+                return message
+
+        self.assertEqual(asyncio.run(run())["id"], "m1")
+        self.assertEqual(self.server.modify_calls, [(["m1", "m2"], ["STARRED"], [])])
+        self.assertGreaterEqual(self.gmail.rate_limiter.rate_limited, 1)
+
+    def test_requests_share_the_quota(self):
+        # 50 units per second with a burst of 50: 20 gets of 5 units take a
+        # second, and a rate limit error slows the bucket down
+        limiter = RateLimiter(units_per_second=100, target=0.5)
+        self.gmail.rate_limiter = limiter
+        self.server.rate_limited = {"m0": 1}
+
+        async def run():
+            async with self.client(concurrency=20) as client:
+                await client.open()
+                loop = asyncio.get_running_loop()
+                started = loop.time()
+                await asyncio.gather(
+                    *(client.messages_get(f"m{i}") for i in range(20))
+                )
+                return loop.time() - started
+
+        self.assertGreater(asyncio.run(run()), 0.8)
+        self.assertEqual(limiter.calls, 21)
+        self.assertEqual(limiter.units, 105)
+        self.assertEqual(limiter.rate_limited, 1)
+        self.assertLess(limiter.rate, limiter.max_rate)
+
+    def test_connection_errors_are_retried(self):
+        import aiohttp
+        from entities.google.async_gmail import AsyncGmailService
+
+        self.gmail.max_retries = 2
+        # Nothing listens on port 1
+        client = AsyncGmailService(self.gmail, root_url="http://127.0.0.1:1/")
+
+        async def run():
+            async with client:
+                await client.open()
+                with self.assertRaises(aiohttp.ClientConnectionError):
+                    await client.messages_get("m1")
+                # A listing skips the message rather than failing as a whole
+                return await client._get_or_none("m1", "full")
+
+        self.assertIsNone(asyncio.run(run()))
+        self.assertEqual(self.gmail.rate_limiter.errors, 6)
+        self.assertEqual(self.gmail.rate_limiter.retries, 4)
+
+    def test_errors_are_http_errors(self):
+        from googleapiclient.errors import HttpError
+
+        async def run():
+            async with self.client(concurrency=10) as client:
+                await client.open()
+                await client.messages_get("missing")
+
+        with self.assertRaises(HttpError) as error:
+            asyncio.run(run())
+        self.assertEqual(error.exception.resp.status, 404)
+
+    def test_blocking_wrapper(self):
+        client = self.client(concurrency=20)
+        with Blocking(client) as gmail:
+            gmail.open()
+            messages = gmail.messages_list(remainingMessages=30)
+            ids = [message["id"] for message in messages]
+            gmail.bulk_modify_message_labels(ids, remove_labels=["UNREAD"])
+        self.assertEqual(sorted(ids), sorted(f"m{i}" for i in range(30)))
+        self.assertEqual(len(self.server.modify_calls), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
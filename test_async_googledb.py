@@ -0,0 +1,104 @@
+import asyncio
+import importlib.util
+import unittest
+from fake_gmail import make_message
+from utils.gmail import get_required_data
+
+# entities.db imports GoogleDB, which needs arena
+has_drivers = all(
+    importlib.util.find_spec(name) is not None for name in ("arena", "asyncpg")
+)
+
+
+@unittest.skipUnless(has_drivers, "arena or asyncpg is not installed")
+class TestAsyncGoogleDB(unittest.TestCase):
+    """Writes through AsyncGoogleDB when POSTGRES_* points to a database."""
+
+    message_ids = ["async-bulk", "async-single", "sync-bulk"]
+
+    def setUp(self):
+        from entities.db.async_googledb import AsyncGoogleDB
+        from entities.db.googledb import GoogleDB
+
+        self.db = GoogleDB(account="async_test")
+        try:
+            self.db.delete_emails(self.message_ids)
+        except Exception as e:
+            raise unittest.SkipTest(f"No Postgres to write to: {e}")
+        self.async_db = AsyncGoogleDB(account="async_test")
+
+    def tearDown(self):
+        self.db.delete_emails(self.message_ids)
+
+    def run_async(self, work):
+        async def run():
+            try:
+                return await work()
+            finally:
+                await self.async_db.close()
+
+        return asyncio.run(run())
+
+    def test_writes_match_googledb(self):
+        def row(message_id):
+            return get_required_data(
+                make_message(message_id, labels=["INBOX", "Label_123"])
+            )
+
+        self.db.bulk_upsert_emails([row("sync-bulk")])
+
+        async def work():
+            self.assertEqual(
+                await self.async_db.bulk_upsert_emails([row("async-bulk")]), 1
+            )
+            await self.async_db.insert_email(row("async-single"))
+            return await self.async_db.get_stored_labels(self.message_ids)
+
+        labels = self.run_async(work)
+
+        self.assertEqual(labels["async-bulk"], {"INBOX", "Label_123"})
+        self.assertEqual(labels["sync-bulk"], {"INBOX", "Label_123"})
+        self.assertIn("async-single", labels)
+
+        def received_at(cursor):
+            cursor.execute(
+                "select distinct received_at from gmail.messages "
+                "where message_id = any(%s)",
+                [self.message_ids],
+            )
+            return cursor.fetchall()
+
+        # Both clients store the same instant
+        self.assertEqual(len(self.db._run_in_transaction(received_at)), 1)
+
+    def test_accounts_sharing_a_message_id(self):
+        from entities.db.googledb import GoogleDB
+
+        other = GoogleDB(account="async_test_other")
+        self.addCleanup(other.delete_emails, ["sync-bulk"])
+        other.bulk_upsert_emails(
+            [get_required_data(make_message("sync-bulk", labels=["INBOX"]))]
+        )
+        self.db.bulk_upsert_emails(
+            [get_required_data(make_message("sync-bulk", labels=["STARRED"]))]
+        )
+
+        async def work():
+            await self.async_db.apply_label_changes(["sync-bulk"], ["UNREAD"], [])
+            await self.async_db.delete_labels("sync-bulk", ["STARRED"])
+            return await self.async_db.get_stored_labels(["sync-bulk"])
+
+        self.assertEqual(self.run_async(work), {"sync-bulk": {"UNREAD"}})
+        # The other mailbox's copy is neither taken over nor relabeled
+        self.assertEqual(
+            other.get_stored_labels(["sync-bulk"]), {"sync-bulk": {"INBOX"}}
+        )
+
+        self.db.delete_emails(["sync-bulk"])
+        self.assertEqual(
+            other.get_stored_labels(["sync-bulk"]), {"sync-bulk": {"INBOX"}}
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
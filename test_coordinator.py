@@ -0,0 +1,198 @@
+import functools
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+from fake_db import RecordingDB
+from fake_gmail import FakeGmailServer, make_message
+from test_credentials import write_token
+from utils.accounts import load_accounts
+from utils.coordinator import SyncCoordinator
+
+
+class FileDB(RecordingDB):
+    """RecordingDB kept in a file per account, so a worker process's writes
+    can be read back by the test."""
+
+    def __init__(self, directory, account_name):
+        super().__init__()
+        self.path = os.path.join(directory, f"{account_name}.json")
+        if os.path.exists(self.path):
+            with open(self.path) as state:
+                state = json.load(state)
+            self.history_id = state["history_id"]
+            self.labels = {
+                message_id: set(labels)
+                for message_id, labels in state["labels"].items()
+            }
+            self.messages = {message_id: {} for message_id in self.labels}
+
+    def close(self):
+        with open(self.path, "w") as state:
+            json.dump(
+                {
+                    "history_id": self.history_id,
+                    "labels": {
+                        message_id: sorted(labels)
+                        for message_id, labels in self.labels.items()
+                    },
+                },
+                state,
+            )
+
+
+def read_state(directory, account_name):
+    with open(os.path.join(directory, f"{account_name}.json")) as state:
+        return json.load(state)
+
+
+class TestLoadAccounts(unittest.TestCase):
+
+    def test_defaults(self):
+        with mock.patch.dict(os.environ, {"GOOGLE_TOKEN_DIR": "secrets"}):
+            accounts = load_accounts(
+                {
+                    "accounts": [
+                        {"name": "alice@example.com"},
+                        {"name": "bob", "token_path": "bob.json", "user_id": "b"},
+                    ]
+                }
+            )
+        self.assertEqual(
+            accounts,
+            [
+                {
+                    "name": "alice@example.com",
+                    "token_path": os.path.join("secrets", "alice@example.com.json"),
+                    "user_id": "me",
+                    "root_url": None,
+                },
+                {
+                    "name": "bob",
+                    "token_path": "bob.json",
+                    "user_id": "b",
+                    "root_url": None,
+                },
+            ],
+        )
+
+    def test_invalid_names(self):
+        for accounts in [
+            [{}],
+            [{"name": "../escape"}],
+            [{"name": "it's"}],
+            [{"name": "bob"}, {"name": "bob"}],
+        ]:
+            with self.subTest(accounts=accounts):
+                with self.assertRaises(ValueError):
+                    load_accounts({"accounts": accounts})
+
+
+class TestSyncCoordinator(unittest.TestCase):
+
+    def accounts(self, count):
+        return [
+            {"name": f"user{i}", "token_path": "", "user_id": "me", "root_url": None}
+            for i in range(count)
+        ]
+
+    def test_shards_are_balanced(self):
+        coordinator = SyncCoordinator(self.accounts(7), workers=3)
+        sizes = [list(coordinator.shards.values()).count(i) for i in range(3)]
+        self.assertEqual(sorted(sizes), [2, 2, 3])
+
+    def test_workers_capped_by_accounts(self):
+        self.assertEqual(SyncCoordinator(self.accounts(2), workers=8).workers, 2)
+
+    def test_least_recently_synced_first(self):
+        coordinator = SyncCoordinator(self.accounts(4), workers=2)
+        coordinator.last_synced.update({"user0": 30.0, "user1": 10.0, "user3": 20.0})
+        self.assertEqual(
+            [account["name"] for account in coordinator._order()],
+            ["user2", "user1", "user3", "user0"],
+        )
+
+
+class TestSyncAccounts(unittest.TestCase):
+    """Several mailboxes, each on its own fake Gmail server, synced by
+    worker processes end to end."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.environment = mock.patch.dict(
+            os.environ,
+            {"GOOGLE_DISCOVERY_CACHE_DIR": "", "GMAIL_BACKOFF_BASE": "0.01"},
+        )
+        self.environment.start()
+        self.servers = {}
+        accounts = []
+        for i, count in enumerate([5, 8, 3, 12]):
+            name = f"user{i}@example.com"
+            self.servers[name] = FakeGmailServer(
+                [make_message(f"{name}-m{j}") for j in range(count)]
+            ).start()
+            token_path = os.path.join(self.directory.name, f"{name}.token")
+            write_token(token_path, 3600)
+            accounts.append(
+                {
+                    "name": name,
+                    "token_path": token_path,
+                    "root_url": self.servers[name].root_url,
+                }
+            )
+        self.accounts = load_accounts({"accounts": accounts})
+        self.coordinator = SyncCoordinator(
+            self.accounts,
+            workers=2,
+            make_db=functools.partial(FileDB, self.directory.name),
+        )
+
+    def tearDown(self):
+        self.coordinator.close()
+        for server in self.servers.values():
+            server.stop()
+        self.environment.stop()
+        self.directory.cleanup()
+
+    def test_full_then_incremental_rounds(self):
+        summaries = {
+            summary["account"]: summary for summary in self.coordinator.run_round()
+        }
+        self.assertEqual(
+            {name: summary["messages"] for name, summary in summaries.items()},
+            {name: len(server.messages) for name, server in self.servers.items()},
+        )
+        self.assertEqual(len({summary["pid"] for summary in summaries.values()}), 2)
+        for name, server in self.servers.items():
+            state = read_state(self.directory.name, name)
+            self.assertEqual(sorted(state["labels"]), sorted(server.messages))
+            self.assertEqual(state["history_id"], str(server.history_id))
+            self.assertIsNone(summaries[name]["error"])
+
+        # Only the mailbox that changed has anything to fetch next round
+        self.servers["user1@example.com"].add_message(make_message("new"))
+        summaries = {
+            summary["account"]: summary for summary in self.coordinator.run_round()
+        }
+        self.assertEqual(summaries["user1@example.com"]["messages"], 1)
+        self.assertEqual(sum(summary["messages"] for summary in summaries.values()), 1)
+        state = read_state(self.directory.name, "user1@example.com")
+        self.assertIn("new", state["labels"])
+
+    def test_failed_account_does_not_stop_the_round(self):
+        os.remove(self.accounts[2]["token_path"])
+        summaries = {
+            summary["account"]: summary for summary in self.coordinator.run_round()
+        }
+        self.assertIn("--authorize", summaries["user2@example.com"]["error"])
+        self.assertEqual(
+            [name for name, summary in summaries.items() if summary["error"]],
+            ["user2@example.com"],
+        )
+        # Never synced accounts stay at the front of the next round
+        self.assertEqual(self.coordinator._order()[0]["name"], "user2@example.com")
+
+
+if __name__ == "__main__":
+    unittest.main()
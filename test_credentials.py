@@ -0,0 +1,128 @@
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+from entities.google import GmailService
+from entities.google.credentials import CredentialStore
+from fake_gmail import FakeGmailServer, make_message
+
+scopes = ["https://www.googleapis.com/auth/gmail.modify"]
+
+
+def write_token(path, expires_in):
+    expiry = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+        seconds=expires_in
+    )
+    with open(path, "w") as token:
+        json.dump(
+            {
+                "token": "access",
+                "refresh_token": "refresh",
+                "client_id": "client",
+                "client_secret": "secret",
+                "expiry": expiry.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            },
+            token,
+        )
+
+
+class TestCredentialStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.token_path = os.path.join(self.directory.name, "token.json")
+        self.store = CredentialStore(self.token_path, scopes, refresh_margin=300)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_fresh_token_is_used_as_is(self):
+        write_token(self.token_path, 3600)
+        with mock.patch.object(CredentialStore, "refresh") as refresh:
+            creds = self.store.get()
+        refresh.assert_not_called()
+        self.assertEqual(creds.token, "access")
+
+    def test_token_close_to_expiry_is_refreshed(self):
+        write_token(self.token_path, 60)
+
+        def refresh(request):
+            creds.token = "refreshed"
+
+        creds = self.store.load()
+        with mock.patch.object(self.store, "load", return_value=creds):
+            with mock.patch.object(creds, "refresh", side_effect=refresh):
+                self.assertEqual(self.store.get().token, "refreshed")
+        with open(self.token_path) as token:
+            self.assertEqual(json.load(token)["token"], "refreshed")
+        self.assertEqual(os.stat(self.token_path).st_mode & 0o777, 0o600)
+
+    def test_missing_token_goes_through_the_browser_flow(self):
+        with mock.patch.object(CredentialStore, "authorize", return_value="new"):
+            self.assertEqual(self.store.get(), "new")
+
+    def test_clear(self):
+        write_token(self.token_path, 3600)
+        self.store.clear()
+        self.assertFalse(os.path.exists(self.token_path))
+
+
+class TestStartup(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeGmailServer([make_message("m0")]).start()
+        self.directory = tempfile.TemporaryDirectory()
+        self.token_path = os.path.join(self.directory.name, "token.json")
+        write_token(self.token_path, 3600)
+
+    def tearDown(self):
+        self.server.stop()
+        self.directory.cleanup()
+
+    def gmail(self):
+        gmail = GmailService(token_path=self.token_path)
+        gmail.discovery_cache_dir = self.directory.name
+        return gmail
+
+    def test_discovery_document_is_cached(self):
+        gmail = self.gmail()
+        gmail.authenticate()
+        path = gmail._discovery_path()
+        self.assertTrue(os.path.exists(path))
+
+        # A cached document is used instead of building from the library's copy
+        with open(path) as document:
+            cached = json.load(document)
+        cached["rootUrl"] = self.server.root_url
+        with open(path, "w") as document:
+            json.dump(cached, document)
+        gmail = self.gmail()
+        gmail.authenticate()
+        self.assertEqual(gmail.get_profile()["historyId"], str(self.server.history_id))
+
+    def test_client_libraries_are_imported_lazily(self):
+        modules = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys, entities.google; print(' '.join(sys.modules))",
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.split()
+        for module in [
+            "googleapiclient.discovery",
+            "google_auth_oauthlib.flow",
+            "google.auth.transport.requests",
+            "google.oauth2.credentials",
+        ]:
+            self.assertNotIn(module, modules)
+
+
+if __name__ == "__main__":
+    unittest.main()
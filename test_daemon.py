@@ -0,0 +1,208 @@
+import base64
+import json
+import threading
+import time
+import unittest
+import urllib.request
+from entities.google import GmailService
+from fake_db import RecordingDB
+from fake_gmail import FakeGmailServer, make_message
+from utils.daemon import LatencyStats, RuleDaemon
+from utils.notifications import PushNotifier, QueueNotifier
+from utils.rule_engine import load_rules
+
+
+class FailingOnceDB(RecordingDB):
+    """Fails the first checkpoint lookup, like a database still starting up."""
+
+    def __init__(self):
+        super().__init__()
+        self.failed = False
+
+    def get_history_id(self, sync_key="default", onError=None):
+        if not self.failed:
+            self.failed = True
+            raise ConnectionError("database is starting up")
+        return super().get_history_id(sync_key, onError)
+
+
+class FailingOnceNotifier(QueueNotifier):
+    """The first wait fails, like a poll whose retries ran out."""
+
+    def __init__(self):
+        super().__init__()
+        self.failed = False
+
+    def wait(self, timeout=None):
+        if not self.failed:
+            self.failed = True
+            raise ConnectionError("Unable to find the server")
+        return super().wait(timeout)
+
+
+rules = load_rules(
+    {
+        "rules": [
+            {
+                "name": "invoices",
+                "rule": {
+                    "type": "condition",
+                    "field": "subject",
+                    "operator": "contains",
+                    "value": "invoice",
+                },
+                "action": {"starred": True},
+            }
+        ]
+    }
+)
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+class TestLatencyStats(unittest.TestCase):
+
+    def test_snapshot(self):
+        stats = LatencyStats("cycle", window=10)
+        for seconds in range(1, 21):
+            stats.record(seconds / 10)
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot["count"], 20)
+        self.assertAlmostEqual(snapshot["mean"], 1.05)
+        self.assertEqual(snapshot["max"], 2.0)
+        # Percentiles only look at the latest samples
+        self.assertEqual(snapshot["p50"], 1.6)
+        self.assertEqual(LatencyStats("empty").snapshot()["p95"], 0.0)
+
+
+class TestRuleDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeGmailServer(
+            [make_message("old", subject="Old invoice", internal_date=now_ms())]
+        ).start()
+        self.gmail = GmailService()
+        self.gmail.service = self.server.build_service()
+        self.db = RecordingDB()
+        self.notifier = QueueNotifier()
+        self.daemon = RuleDaemon(
+            self.gmail, self.db, rules, self.notifier, fallback_interval=3600
+        )
+        self.thread = threading.Thread(target=self.daemon.run)
+        self.thread.start()
+        self.wait_for(lambda: self.daemon.cycles == 1)
+
+    def tearDown(self):
+        self.daemon.stop()
+        self.thread.join(timeout=5)
+        self.server.stop()
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("Timed out waiting for the daemon")
+            time.sleep(0.01)
+
+    def test_first_cycle_syncs_and_applies_rules(self):
+        self.assertIn("old", self.db.messages)
+        self.assertEqual(self.server.modify_calls, [(["old"], ["STARRED"], [])])
+        self.assertIn("STARRED", self.db.labels["old"])
+
+    def test_notification_applies_rules_to_new_mail(self):
+        self.server.add_message(
+            make_message("new", subject="Your invoice", internal_date=now_ms())
+        )
+        self.server.add_message(make_message("other", internal_date=now_ms()))
+        self.notifier.notify(str(self.server.history_id))
+        self.wait_for(lambda: self.daemon.cycles == 2)
+
+        self.assertEqual(self.server.modify_calls[-1], (["new"], ["STARRED"], []))
+        self.assertIn("STARRED", self.db.labels["new"])
+        self.assertNotIn("STARRED", self.db.labels["other"])
+        latency = self.daemon.metrics()["latency"]
+        self.assertEqual(latency["notification_to_action"]["count"], 1)
+        self.assertEqual(latency["arrival_to_action"]["count"], 2)
+        self.assertLess(latency["notification_to_action"]["max"], 1.0)
+        self.assertEqual(latency["cycle"]["count"], 2)
+
+    def test_failed_first_cycle_does_not_stop_the_daemon(self):
+        self.daemon.stop()
+        self.thread.join(timeout=5)
+        db = FailingOnceDB()
+        notifier = QueueNotifier()
+        daemon = RuleDaemon(self.gmail, db, rules, notifier, fallback_interval=3600)
+        thread = threading.Thread(target=daemon.run)
+        thread.start()
+        try:
+            self.wait_for(lambda: daemon.errors == 1)
+            self.assertTrue(thread.is_alive())
+            notifier.notify(str(self.server.history_id))
+            self.wait_for(lambda: daemon.cycles == 1)
+            self.assertIn("old", db.messages)
+        finally:
+            daemon.stop()
+            thread.join(timeout=5)
+
+    def test_failed_wait_does_not_stop_the_daemon(self):
+        self.daemon.stop()
+        self.thread.join(timeout=5)
+        notifier = FailingOnceNotifier()
+        daemon = RuleDaemon(
+            self.gmail, RecordingDB(), rules, notifier, fallback_interval=3600
+        )
+        thread = threading.Thread(target=daemon.run)
+        thread.start()
+        try:
+            self.wait_for(lambda: daemon.errors == 1)
+            self.server.add_message(
+                make_message("new", subject="Your invoice", internal_date=now_ms())
+            )
+            notifier.notify(str(self.server.history_id))
+            self.wait_for(lambda: daemon.cycles == 2)
+            self.assertTrue(thread.is_alive())
+            self.assertEqual(daemon.errors, 1)
+        finally:
+            daemon.stop()
+            thread.join(timeout=5)
+
+    def test_no_notification_no_cycle(self):
+        time.sleep(0.2)
+        self.assertEqual(self.daemon.cycles, 1)
+        self.assertEqual(self.server.request_counts.get("history.list", 0), 0)
+
+
+class TestNotifiers(unittest.TestCase):
+
+    def test_queued_notifications_are_collapsed(self):
+        notifier = QueueNotifier()
+        notifier.notify("1")
+        notifier.notify("2")
+        notification = notifier.wait(timeout=0.1)
+        self.assertEqual(notification["historyId"], "2")
+        self.assertIsNone(notifier.wait(timeout=0.01))
+
+    def test_push_envelope(self):
+        notifier = PushNotifier(host="127.0.0.1", port=0)
+        try:
+            host, port = notifier.address
+            data = json.dumps({"emailAddress": "me@example.com", "historyId": 42})
+            envelope = {"message": {"data": base64.b64encode(data.encode()).decode()}}
+            request = urllib.request.Request(
+                f"http://{host}:{port}/",
+                data=json.dumps(envelope).encode(),
+                headers={"Content-Type": "application/json"},
+            )
+            with urllib.request.urlopen(request) as response:
+                self.assertEqual(response.status, 204)
+            notification = notifier.wait(timeout=1)
+            self.assertEqual(notification["historyId"], 42)
+            self.assertEqual(notification["emailAddress"], "me@example.com")
+        finally:
+            notifier.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import sys
+import time
+import unittest
+from entities.google import GmailService
+from entities.google.ratelimit import RateLimiter
+from fake_gmail import FakeGmailServer, make_message
+
+
+class TestGmailService(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeGmailServer(
+            [make_message(f"m{i}") for i in range(23)], latency=0.05
+        ).start()
+        self.gmail = GmailService()
+        self.gmail.service = self.server.build_service()
+        self.gmail.page_size = 10
+        self.gmail.batch_size = 4
+        self.gmail.fetch_concurrency = 3
+        self.gmail.backoff_base = 0.01
+        # The fake server enforces no quota unless asked to
+        self.gmail.rate_limiter = RateLimiter(units_per_second=0)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_messages_list_sequential(self):
+        ids = [message["id"] for message in self.gmail.messages_list(remainingMessages=7)]
+        self.assertEqual(ids, [f"m{i}" for i in range(7)])
+
+    def test_messages_list_batched(self):
+        messages = list(self.gmail.messages_list(remainingMessages=100, batched=True))
+
+        self.assertEqual(
+            sorted(message["id"] for message in messages),
+            sorted(f"m{i}" for i in range(23)),
+        )
+        # 23 messages in batches of 4
+        self.assertEqual(self.server.request_counts["batch"], 6)
+        self.assertGreater(self.server.max_in_flight_batches, 1)
+        self.assertLessEqual(self.server.max_in_flight_batches, 3)
+
+    def test_messages_batch_get_retries_rate_limited(self):
+        self.server.rate_limited = {"m1": 2, "m5": 1}
+
+        messages = list(self.gmail.messages_batch_get(["m0", "m1", "m5", "m6"]))
+
+        self.assertEqual(
+            sorted(message["id"] for message in messages), ["m0", "m1", "m5", "m6"]
+        )
+        self.assertEqual(self.server.request_counts["batch"], 3)
+
+    def test_messages_batch_get_gives_up_after_max_retries(self):
+        self.gmail.max_retries = 1
+        self.server.rate_limited = {"m1": 5}
+        dropped, gave_up = [], []
+
+        messages = list(
+            self.gmail.messages_batch_get(
+                ["m0", "m1"], onDropped=dropped.extend, onGaveUp=gave_up.extend
+            )
+        )
+
+        self.assertEqual([message["id"] for message in messages], ["m0"])
+        self.assertEqual((dropped, gave_up), ([], ["m1"]))
+
+    def test_messages_batch_get_skips_missing(self):
+        dropped, gave_up = [], []
+
+        messages = list(
+            self.gmail.messages_batch_get(
+                ["m0", "missing"], onDropped=dropped.extend, onGaveUp=gave_up.extend
+            )
+        )
+
+        self.assertEqual([message["id"] for message in messages], ["m0"])
+        self.assertEqual((dropped, gave_up), (["missing"], []))
+
+    def test_message_pages_deeper_than_recursion_limit(self):
+        limit = sys.getrecursionlimit()
+        self.addCleanup(sys.setrecursionlimit, limit)
+        sys.setrecursionlimit(200)
+        self.server.messages = {f"m{i}": make_message(f"m{i}") for i in range(300)}
+        self.server.latency = 0
+        self.gmail.page_size = 1
+
+        pages = list(self.gmail.message_pages(remainingMessages=300))
+
+        self.assertEqual(len(pages), 300)
+        self.assertEqual(pages[-1], ["m299"])
+
+    def test_message_pages_prefetches_in_background(self):
+        self.gmail.page_size = 2
+        self.gmail.prefetch_pages = 3
+        pager = self.gmail.message_pages(remainingMessages=100)
+
+        pages = []
+        for page in pager:
+            time.sleep(0.05)
+            pages.append(page)
+
+        self.assertEqual(sum(len(page) for page in pages), 23)
+        self.assertEqual(pager.pages_fetched, 12)
+        self.assertEqual(pager.max_depth, 3)
+        self.assertEqual(pager.depth, 0)
+
+    def test_message_pages_respects_remaining_messages(self):
+        pages = list(self.gmail.message_pages(remainingMessages=15))
+
+        self.assertEqual([len(page) for page in pages], [10, 5])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import base64
+import unittest
+from utils.gmail import get_email_body
+
+
+def _part(mime_type, text):
+    data = base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii")
+    return {"mimeType": mime_type, "body": {"data": data}}
+
+
+class TestGetEmailBody(unittest.TestCase):
+
+    def setUp(self):
+        self.payload = {
+            "mimeType": "multipart/mixed",
+            "parts": [
+                {
+                    "mimeType": "multipart/alternative",
+                    "parts": [
+                        _part("text/plain", "Plain\n\n  version\t of the mail"),
+                        _part(
+                            "text/html",
+                            "<html><head><style>p {color: red}</style></head>"
+                            "<body><p>Html&nbsp;<b>ver</b>sion</p><p>of the mail</p>"
+                            "<script>track()</script></body></html>",
+                        ),
+                    ],
+                },
+                {"mimeType": "application/pdf", "body": {"attachmentId": "a1"}},
+            ],
+        }
+
+    def test_html2text_strategy(self):
+        body = get_email_body(self.payload, "html2text")
+        self.assertTrue(body.startswith("Plain version of the mail Html"))
+        self.assertNotIn("color: red", body)
+
+    def test_strip_strategy(self):
+        self.assertEqual(
+            get_email_body(self.payload, "strip"),
+            "Plain version of the mail Html version of the mail",
+        )
+
+    def test_plain_strategy_prefers_text_plain(self):
+        self.assertEqual(
+            get_email_body(self.payload, "plain"), "Plain version of the mail"
+        )
+
+    def test_plain_strategy_falls_back_to_html(self):
+        payload = _part("text/html", "<div>Only</div><div>html</div>")
+        self.assertEqual(get_email_body(payload, "plain"), "Only html")
+
+    def test_max_length(self):
+        self.assertEqual(get_email_body(self.payload, "plain", 11), "Plain versi")
+        self.assertEqual(get_email_body(self.payload, "html2text", 6), "Plain")
+
+    def test_huge_html_is_capped(self):
+        payload = _part("text/html", "<p>word</p>" * 200000)
+        body = get_email_body(payload, "strip", 100)
+        self.assertEqual(len(body), 99)
+        self.assertTrue(body.startswith("word word"))
+
+    def test_whitespace_does_not_count_towards_the_cap(self):
+        html = ("<div>\n" + " " * 5000 + "word\n</div>") * 400
+        for payload in (_part("text/html", html), _part("text/plain", html)):
+            body = get_email_body(payload, "strip", 1000)
+            self.assertGreaterEqual(len(body), 998)
+
+    def test_no_body(self):
+        self.assertIsNone(get_email_body({"mimeType": "text/plain", "body": {}}, "strip"))
+
+    def test_invalid_strategy(self):
+        with self.assertRaises(ValueError):
+            get_email_body(self.payload, "ocr")
+
+
+if __name__ == "__main__":
+    unittest.main()
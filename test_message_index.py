@@ -0,0 +1,227 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+from utils.message_index import MessageIndex, compile_rule, interval_start
+from utils.rule_engine import load_rules
+from utils.rules_and_actions import process_rule
+
+now = datetime(2024, 3, 31, 12, 0, tzinfo=timezone.utc)
+
+
+def condition(field, operator, value):
+    return {"type": "condition", "field": field, "operator": operator, "value": value}
+
+
+def group(predicate, *rules):
+    return {"type": "rule", "predicate": predicate, "rules": list(rules)}
+
+
+def make_rows():
+    # m3 and m4 sit an hour either side of "1 month" before `now`
+    leap_day = datetime(2024, 2, 29, 12, tzinfo=timezone.utc)
+    rows = [
+        ("m1", "News@Shop.com", "Weekly DEALS", "50% off_all", now - timedelta(2)),
+        ("m2", "news@shop.com", "Invoice", "Invoice is ready", now - timedelta(40)),
+        ("m3", "boss@work.com", "Meeting", "See you", leap_day - timedelta(hours=1)),
+        ("m4", "alerts@bank.com", None, None, leap_day + timedelta(hours=1)),
+        ("m5", None, "it's 100%", "a\\b", now - timedelta(400)),
+        ("m6", "friend@mail.com", "Trip", "Tripadvisor review", None),
+    ]
+    return [
+        {
+            "message_id": message_id,
+            "from_address": sender,
+            "subject": subject,
+            "body": body,
+            "received_at": received_at,
+            "labels": ["INBOX", "UNREAD"] if i % 2 else ["INBOX"],
+        }
+        for i, (message_id, sender, subject, body, received_at) in enumerate(rows)
+    ]
+
+
+# Rules whose results the in-process engine must agree with Postgres on
+parity_rules = [
+    condition("from_address", "is", "NEWS@shop.com"),
+    condition("from_address", "is_not", "news@shop.com"),
+    condition("from_address", "contains", "SHOP"),
+    condition("subject", "is", "Invoice"),
+    condition("subject", "is", "invoice"),
+    condition("subject", "is_not", "Invoice"),
+    condition("subject", "contains", "deals"),
+    condition("subject", "not_contains", "e"),
+    condition("subject", "contains", "100%"),
+    condition("body", "contains", "off_al"),
+    condition("body", "contains", "%"),
+    condition("body", "contains", "a\\b"),
+    condition("body", "not_contains", "invoice"),
+    condition("received_at", "greater_than", "1 month"),
+    condition("received_at", "less_than", "1 month"),
+    condition("received_at", "greater_than", "7 days"),
+    condition("received_at", "less_than", "1 year"),
+    group(
+        "all",
+        condition("from_address", "contains", "shop"),
+        group(
+            "any",
+            condition("subject", "contains", "deals"),
+            condition("body", "contains", "ready"),
+        ),
+    ),
+    group(
+        "any",
+        condition("subject", "not_contains", "trip"),
+        condition("body", "contains", "trip"),
+    ),
+    group("all"),
+]
+
+
+class TestMessageIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = MessageIndex.from_rows(make_rows())
+
+    def ids(self, rule):
+        return sorted(self.index.match(rule, now))
+
+    def test_contains_is_literal_and_case_insensitive(self):
+        self.assertEqual(self.ids(condition("subject", "contains", "deals")), ["m1"])
+        self.assertEqual(self.ids(condition("body", "contains", "%")), ["m1"])
+        self.assertEqual(self.ids(condition("body", "contains", "f_a")), ["m1"])
+
+    def test_from_address_is_ignores_case(self):
+        self.assertEqual(
+            self.ids(condition("from_address", "is", "NEWS@shop.com")), ["m1", "m2"]
+        )
+
+    def test_missing_values_match_nothing(self):
+        self.assertEqual(
+            self.ids(condition("subject", "not_contains", "e")), ["m5", "m6"]
+        )
+        self.assertNotIn(
+            "m6", self.ids(condition("received_at", "less_than", "1 day"))
+        )
+
+    def test_calendar_months(self):
+        self.assertEqual(interval_start(now, "1 month"), now.replace(month=2, day=29))
+        self.assertEqual(interval_start(now, "1 year"), now.replace(year=2023))
+        self.assertEqual(
+            self.ids(condition("received_at", "greater_than", "1 month")), ["m1", "m4"]
+        )
+
+    def test_empty_rule_matches_everything(self):
+        self.assertIsNone(compile_rule(group("all")))
+        self.assertEqual(len(self.ids(group("all"))), 6)
+
+    def test_invalid_rules_are_rejected(self):
+        with self.assertRaises(ValueError):
+            compile_rule(condition("received_at", "contains", "x"))
+        with self.assertRaises(ValueError):
+            compile_rule(
+                group("most", condition("body", "contains", "a"), group("all"))
+            )
+
+    def test_evaluate_tags_matching_rules(self):
+        from_shop = condition("from_address", "contains", "shop")
+        rules = load_rules(
+            {
+                "rules": [
+                    {"rule": from_shop, "action": {}},
+                    {"rule": condition("subject", "is", "Invoice"), "action": {}},
+                ]
+            }
+        )
+        matches = {
+            message_id: (rule_indexes, sorted(labels))
+            for message_id, rule_indexes, labels in self.index.evaluate(rules, now)
+        }
+        self.assertEqual(
+            matches, {"m1": ([0], ["INBOX"]), "m2": ([0, 1], ["INBOX", "UNREAD"])}
+        )
+
+    def test_received_at_is_stored_as_epoch_seconds(self):
+        self.index.add({**make_rows()[0], "received_at": "2024-02-29 12:00:00"})
+
+        row = self.index.positions["m1"]
+        self.assertEqual(
+            self.index.received_at[row],
+            int(datetime(2024, 2, 29, 12).timestamp()),
+        )
+        self.assertTrue(
+            all(isinstance(value, int) for value in self.index.received_at if value)
+        )
+
+    def test_updates_and_removals(self):
+        self.index.add({**make_rows()[0], "subject": "Invoice"})
+        self.index.remove("m2")
+        self.index.update_labels("m1", ["STARRED"], ["INBOX"])
+
+        self.assertEqual(len(self.index), 5)
+        self.assertEqual(self.ids(condition("subject", "is", "Invoice")), ["m1"])
+        invoices = condition("subject", "is", "Invoice")
+        rules = load_rules({"rule": invoices, "action": {}})
+        self.assertEqual(self.index.evaluate(rules, now), [("m1", [0], ["STARRED"])])
+
+    def test_snapshot_round_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "index.pickle")
+            self.index.save(path)
+            loaded = MessageIndex.load(path)
+        for rule in parity_rules:
+            self.assertEqual(sorted(loaded.match(rule, now)), self.ids(rule))
+
+
+class TestSqlParity(unittest.TestCase):
+    """Runs the parity rules against Postgres when POSTGRES_* points to one."""
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            import psycopg2
+
+            cls.connection = psycopg2.connect(
+                host=os.getenv("POSTGRES_HOST"),
+                port=os.getenv("POSTGRES_PORT"),
+                user=os.getenv("POSTGRES_USER"),
+                password=os.getenv("POSTGRES_PASSWORD"),
+                dbname=os.getenv("POSTGRES_DB"),
+                connect_timeout=2,
+            )
+        except Exception as e:
+            raise unittest.SkipTest(f"No Postgres to compare with: {e}")
+        cls.connection.autocommit = True
+        with cls.connection.cursor() as cursor:
+            cursor.execute("set time zone 'UTC'")
+            cursor.execute(
+                "create temporary table messages (message_id text primary key, "
+                "from_address text, subject text, body text, received_at timestamptz)"
+            )
+            fields = ["message_id", "from_address", "subject", "body", "received_at"]
+            for row in make_rows():
+                cursor.execute(
+                    "insert into messages values (%s, %s, %s, %s, %s)",
+                    [row[field] for field in fields],
+                )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.connection.close()
+
+    def test_parity(self):
+        index = MessageIndex.from_rows(make_rows())
+        with self.connection.cursor() as cursor:
+            for rule in parity_rules:
+                condition = process_rule(rule)
+                where = f"where {condition}" if condition else ""
+                # now() is replaced by the fixed time the index is evaluated at
+                where = where.replace("now()", f"'{now.isoformat()}'::timestamptz")
+                cursor.execute(f"select message_id from messages {where}")
+                expected = sorted(row[0] for row in cursor.fetchall())
+                with self.subTest(rule=rule):
+                    self.assertEqual(sorted(index.match(rule, now)), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
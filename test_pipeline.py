@@ -0,0 +1,169 @@
+import time
+import unittest
+from fake_gmail import make_message
+from utils.gmail import get_required_data, parse_messages_parallel
+from utils.message_index import MessageIndex
+from utils.pipeline import IngestPipeline
+
+
+class ListWriter:
+    def __init__(self, delay=0.0, fail_after=None):
+        self.rows = []
+        self.delay = delay
+        self.fail_after = fail_after
+
+    def add(self, data):
+        if self.fail_after is not None and len(self.rows) >= self.fail_after:
+            raise RuntimeError("database is down")
+        time.sleep(self.delay)
+        self.rows.append(data)
+
+
+class TestIngestPipeline(unittest.TestCase):
+
+    def test_all_messages_are_stored(self):
+        writer = ListWriter()
+        messages = [make_message(f"m{i}") for i in range(50)]
+
+        stats = IngestPipeline(writer, parse_workers=3, queue_size=5).run(messages)
+
+        self.assertEqual(
+            sorted(row["message_id"] for row in writer.rows),
+            sorted(f"m{i}" for i in range(50)),
+        )
+        self.assertEqual(stats["fetch"].items, 50)
+        self.assertEqual(stats["parse"].items, 50)
+        self.assertEqual(stats["store"].items, 50)
+
+    def test_stored_rows_are_indexed(self):
+        index = MessageIndex()
+        messages = [make_message(f"m{i}", sender=f"s{i % 2}@x.com") for i in range(10)]
+
+        IngestPipeline(ListWriter(), index=index).run(messages)
+
+        rule = {
+            "type": "condition",
+            "field": "from_address",
+            "operator": "is",
+            "value": "S1@x.com",
+        }
+        self.assertEqual(sorted(index.match(rule)), ["m1", "m3", "m5", "m7", "m9"])
+
+    def test_slow_store_applies_backpressure(self):
+        pulled = []
+
+        def source():
+            for i in range(30):
+                pulled.append(i)
+                yield make_message(f"m{i}")
+
+        writer = ListWriter(delay=0.01)
+        pipeline = IngestPipeline(writer, parse_workers=1, queue_size=2)
+        maximum_ahead = 0
+
+        original_add = writer.add
+
+        def add(data):
+            nonlocal maximum_ahead
+            maximum_ahead = max(maximum_ahead, len(pulled) - len(writer.rows))
+            original_add(data)
+
+        writer.add = add
+        pipeline.run(source())
+
+        self.assertEqual(len(writer.rows), 30)
+        # two queues of two, one message in each stage and one being stored
+        self.assertLessEqual(maximum_ahead, 8)
+
+    def test_parse_errors_are_skipped(self):
+        broken = make_message("broken")
+        del broken["payload"]["headers"]
+        writer = ListWriter()
+        unparsed = []
+
+        stats = IngestPipeline(
+            writer, parse_workers=2, onParseError=unparsed.append
+        ).run([make_message("m0"), broken, make_message("m1")])
+
+        self.assertEqual(sorted(row["message_id"] for row in writer.rows), ["m0", "m1"])
+        self.assertEqual(stats["parse"].errors, 1)
+        self.assertEqual(unparsed, ["broken"])
+
+    def test_store_error_stops_the_pipeline(self):
+        closed = []
+
+        def source():
+            try:
+                for i in range(1000):
+                    yield make_message(f"m{i}")
+            finally:
+                closed.append(True)
+
+        with self.assertRaises(RuntimeError):
+            IngestPipeline(ListWriter(fail_after=3), queue_size=4).run(source())
+        self.assertEqual(closed, [True])
+
+    def test_fetch_error_is_raised(self):
+        def source():
+            yield make_message("m0")
+            raise ConnectionError("network is down")
+
+        with self.assertRaises(ConnectionError):
+            IngestPipeline(ListWriter()).run(source())
+
+    def test_process_parse_errors_are_counted(self):
+        broken = make_message("broken")
+        del broken["payload"]["headers"]
+        writer = ListWriter()
+        unparsed = []
+
+        stats = IngestPipeline(
+            writer, parse_workers=2, parse_mode="process", onParseError=unparsed.append
+        ).run([make_message("m0"), broken, make_message("m1")])
+
+        self.assertEqual(sorted(row["message_id"] for row in writer.rows), ["m0", "m1"])
+        self.assertEqual(stats["parse"].errors, 1)
+        self.assertEqual(unparsed, ["broken"])
+
+    def test_process_parse_mode(self):
+        writer = ListWriter()
+        messages = [make_message(f"m{i}") for i in range(20)]
+
+        stats = IngestPipeline(writer, parse_workers=2, parse_mode="process").run(
+            messages
+        )
+
+        self.assertEqual(
+            sorted(writer.rows, key=lambda row: row["message_id"]),
+            sorted(map(get_required_data, messages), key=lambda row: row["message_id"]),
+        )
+        self.assertEqual(stats["store"].items, 20)
+
+    def test_invalid_parse_mode(self):
+        with self.assertRaises(ValueError):
+            IngestPipeline(ListWriter(), parse_mode="fibers")
+
+
+class TestParseMessagesParallel(unittest.TestCase):
+
+    def test_same_rows_as_get_required_data(self):
+        messages = [make_message(f"m{i}", body=f"Body {i}") for i in range(25)]
+        broken = make_message("broken")
+        del broken["payload"]["headers"]
+
+        errors = []
+        rows = list(
+            parse_messages_parallel(
+                messages + [broken], workers=2, chunksize=4, onError=errors.append
+            )
+        )
+
+        self.assertEqual(
+            sorted(rows, key=lambda row: row["message_id"]),
+            sorted(map(get_required_data, messages), key=lambda row: row["message_id"]),
+        )
+        self.assertEqual(errors, [["broken"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,179 @@
+import threading
+import unittest
+import httplib2
+from googleapiclient.errors import HttpError
+from entities.google import GmailService
+from entities.google.ratelimit import (
+    RateLimiter,
+    TokenBucket,
+    is_retryable,
+    request_units,
+)
+from fake_gmail import FakeGmailServer, make_message
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+def http_error(status, headers=None):
+    return HttpError(httplib2.Response(dict(headers or {}, status=status)), b"{}")
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_paces_reservations_beyond_the_burst(self):
+        clock = FakeClock()
+        bucket = TokenBucket(100, clock=clock)
+        self.assertEqual(bucket.reserve(100), 0.0)
+        self.assertAlmostEqual(bucket.reserve(50), 0.5)
+        # A reservation larger than the capacity waits its turn
+        self.assertAlmostEqual(bucket.reserve(250), 3.0)
+        clock.now = 3.0
+        self.assertAlmostEqual(bucket.reserve(100), 1.0)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = RateLimiter(
+            units_per_second=100,
+            target=0.9,
+            max_concurrency=8,
+            clock=self.clock,
+            sleep=self.clock.sleep,
+        )
+
+    def test_request_units(self):
+        with FakeGmailServer() as server:
+            service = server.build_service()
+        messages = service.users().messages()
+        batch = service.new_batch_http_request()
+        for i in range(3):
+            batch.add(messages.get(userId="me", id=f"m{i}"))
+        self.assertEqual(request_units(batch), 15)
+        self.assertEqual(request_units(messages.batchModify(userId="me", body={})), 50)
+        self.assertEqual(request_units(service.users().getProfile(userId="me")), 1)
+
+    def test_retryable_errors(self):
+        self.assertTrue(is_retryable(http_error(429)))
+        self.assertTrue(is_retryable(http_error(503)))
+        self.assertTrue(is_retryable(ConnectionResetError()))
+        self.assertFalse(is_retryable(http_error(404)))
+        self.assertFalse(is_retryable(http_error(403)))
+        self.assertFalse(is_retryable(ValueError()))
+
+    def test_rate_limit_errors_decrease_multiplicatively(self):
+        self.limiter.record(http_error(429))
+        self.assertEqual(self.limiter.concurrency, 4)
+        self.assertAlmostEqual(self.limiter.rate, 63)
+        # The calls already in flight when the first error came back count once
+        self.limiter.record(http_error(429))
+        self.assertEqual(self.limiter.concurrency, 4)
+        self.clock.now = 1.5
+        self.limiter.record(http_error(500))
+        self.assertEqual(self.limiter.concurrency, 2)
+        self.assertAlmostEqual(self.limiter.rate, 63)
+        self.assertEqual((self.limiter.rate_limited, self.limiter.errors), (2, 1))
+
+    def test_successes_increase_additively(self):
+        self.limiter.record(http_error(429))
+        for _ in range(4):
+            self.limiter.record()
+        self.assertAlmostEqual(self.limiter.concurrency, 4.9, places=1)
+        self.clock.now = 5.0
+        self.limiter.record()
+        self.assertAlmostEqual(self.limiter.rate, 63 + 22.5)
+        self.clock.now = 60.0
+        self.limiter.record()
+        self.assertEqual(self.limiter.rate, 90)
+
+    def test_call_retries_with_backoff(self):
+        outcomes = [http_error(429, {"retry-after": "5"}), http_error(503), "ok"]
+
+        def function():
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        self.assertEqual(self.limiter.call(function, units=5, backoff_base=1), "ok")
+        first, second = self.clock.slept
+        self.assertEqual(first, 5)
+        self.assertTrue(1 <= second <= 2)
+        self.assertEqual(self.limiter.retries, 2)
+        self.assertEqual(self.limiter.in_flight, 0)
+
+    def test_call_raises_other_errors_and_gives_up(self):
+        with self.assertRaises(HttpError):
+            self.limiter.call(lambda: (_ for _ in ()).throw(http_error(404)))
+        self.assertEqual(self.limiter.retries, 0)
+
+        def always_limited():
+            raise http_error(429)
+
+        with self.assertRaises(HttpError):
+            self.limiter.call(always_limited, max_retries=2, backoff_base=0.01)
+        self.assertEqual(self.limiter.retries, 2)
+        self.assertEqual(self.limiter.in_flight, 0)
+
+    def test_concurrency_limit_blocks_extra_calls(self):
+        limiter = RateLimiter(units_per_second=0, max_concurrency=2)
+        limiter.concurrency = 1
+        entered = threading.Event()
+
+        def second_call():
+            with limiter.slot(1):
+                entered.set()
+
+        with limiter.slot(1):
+            thread = threading.Thread(target=second_call)
+            thread.start()
+            self.assertFalse(entered.wait(0.1))
+        self.assertTrue(entered.wait(1))
+        thread.join()
+        self.assertEqual(limiter.in_flight, 0)
+
+
+class TestQuota(unittest.TestCase):
+    """GmailService against a fake server enforcing a per-user quota."""
+
+    def setUp(self):
+        self.server = FakeGmailServer([make_message(f"m{i}") for i in range(300)])
+        self.server.start()
+        self.server.quota = 1000
+        self.gmail = GmailService()
+        self.gmail.service = self.server.build_service()
+        self.gmail.page_size = 100
+        self.gmail.backoff_base = 0.1
+        self.gmail.max_retries = 10
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_stays_under_the_quota(self):
+        self.gmail.rate_limiter = RateLimiter(units_per_second=1000, target=0.9)
+        messages = list(self.gmail.messages_list(remainingMessages=300, batched=True))
+        self.assertEqual(len({message["id"] for message in messages}), 300)
+        self.assertLessEqual(self.server.quota_rejected, 10)
+
+    def test_rate_limited_batch_modify_is_retried(self):
+        self.server.modify_rate_limited = 2
+        self.gmail.bulk_modify_message_labels(["m1"], ["STARRED"])
+        self.assertEqual(self.server.modify_calls, [(["m1"], ["STARRED"], [])])
+        self.assertEqual(self.gmail.rate_limiter.rate_limited, 2)
+        self.assertEqual(self.gmail.rate_limiter.retries, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+from utils.message_index import compile_rule
+from utils.rule_cache import CompiledRuleCache, rule_key
+from utils.rules_and_actions import process_rule
+
+
+def condition(value, field="subject"):
+    return {"type": "condition", "field": field, "operator": "contains", "value": value}
+
+
+class TestCompiledRuleCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = CompiledRuleCache(maxsize=2)
+
+    def test_key_ignores_key_order(self):
+        reordered = {"value": "a", "operator": "contains", "field": "subject"}
+        reordered["type"] = "condition"
+        self.assertEqual(rule_key(condition("a")), rule_key(reordered))
+        self.assertNotEqual(rule_key(condition("a")), rule_key(condition("b")))
+
+    def test_hits_and_misses(self):
+        first = self.cache.get(condition("a"), process_rule)
+        second = self.cache.get(dict(condition("a")), process_rule)
+
+        self.assertEqual(first, "subject ilike '%a%'")
+        self.assertIs(first, second)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_rule_edited_in_place_is_compiled_again(self):
+        rule = condition("a")
+        self.assertEqual(self.cache.get(rule, process_rule), "subject ilike '%a%'")
+        rule["value"] = "b"
+
+        self.assertEqual(self.cache.get(rule, process_rule), "subject ilike '%b%'")
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+
+    def test_compilers_are_cached_separately(self):
+        sql = self.cache.get(condition("a"), process_rule)
+        predicate = self.cache.get(condition("a"), compile_rule)
+
+        self.assertIsInstance(sql, str)
+        self.assertTrue(callable(predicate))
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.get(condition("a"), process_rule)
+        self.cache.get(condition("b"), process_rule)
+        self.cache.get(condition("a"), process_rule)
+        self.cache.get(condition("c"), process_rule)
+
+        self.assertEqual(len(self.cache), 2)
+        self.cache.get(condition("a"), process_rule)
+        self.assertEqual(self.cache.hits, 2)
+        self.cache.get(condition("b"), process_rule)
+        self.assertEqual(self.cache.misses, 4)
+
+    def test_empty_rules_are_cached(self):
+        empty = {"type": "rule", "predicate": "all", "rules": []}
+        self.assertIsNone(self.cache.get(empty, process_rule))
+        self.assertIsNone(self.cache.get(empty, process_rule))
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_invalid_rules_are_not_cached(self):
+        invalid = condition("x", field="received_at")
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                self.cache.get(invalid, process_rule)
+        self.assertEqual((len(self.cache), self.cache.misses), (0, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
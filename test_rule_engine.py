@@ -0,0 +1,113 @@
+import re
+import unittest
+from utils.rule_engine import (
+    load_rules,
+    get_rule_conditions,
+    merge_actions,
+)
+
+from_marketing = {
+    "type": "condition",
+    "field": "from_address",
+    "operator": "contains",
+    "value": "marketing",
+}
+match_all = {"type": "rule", "predicate": "all", "rules": []}
+
+
+class TestLoadRules(unittest.TestCase):
+
+    def test_rules_list(self):
+        rules = load_rules(
+            {
+                "rules": [
+                    {"name": "marketing", "rule": from_marketing, "action": {}},
+                    {"rule": {}, "action": {"unread": False}},
+                ]
+            }
+        )
+        self.assertEqual([rule["name"] for rule in rules], ["marketing", "rule 2"])
+        self.assertEqual(rules[1]["action"], {"unread": False})
+
+    def test_single_rule_format(self):
+        rules = load_rules({"rule": from_marketing, "action": {"starred": True}})
+        self.assertEqual(
+            rules,
+            [{"name": "rule 1", "rule": from_marketing, "action": {"starred": True}}],
+        )
+
+    def test_missing_action(self):
+        with self.assertRaises(ValueError):
+            load_rules({"rules": [{"rule": from_marketing}]})
+
+    def test_invalid_entries_are_named(self):
+        valid = {"name": "first", "rule": from_marketing, "action": {"starred": True}}
+        for content, message in [
+            ({"rules": [valid, {}]}, "Rule 2 (rule 2)"),
+            ({"rules": [{"name": "stars", "rule": from_marketing}]}, "(stars)"),
+            ({"rules": [valid, "stars"]}, "Rule 2 is not an object"),
+            ({"rules": {"first": valid}}, "must be a list"),
+            ({}, "Rule 1"),
+        ]:
+            with self.subTest(content=content):
+                with self.assertRaisesRegex(ValueError, re.escape(message)):
+                    load_rules(content)
+
+    def test_conditions(self):
+        rules = load_rules(
+            {
+                "rules": [
+                    {"rule": from_marketing, "action": {}},
+                    {"rule": match_all, "action": {}},
+                ]
+            }
+        )
+        conditions = get_rule_conditions(rules)
+        self.assertIn("from_address ilike '%marketing%'", conditions[0])
+        self.assertEqual(conditions[1], "true")
+
+
+class TestMergeActions(unittest.TestCase):
+
+    def setUp(self):
+        self.rules = load_rules(
+            {
+                "rules": [
+                    {"rule": {}, "action": {"unread": False, "starred": True}},
+                    {"rule": {}, "action": {"unread": True}},
+                    {"rule": {}, "action": {"location": "TRASH"}},
+                    {"rule": {}, "action": {}},
+                ]
+            }
+        )
+
+    def test_single_rule(self):
+        changes = merge_actions([("m1", [0], None)], self.rules)
+        self.assertEqual(changes, {"m1": ({"STARRED"}, {"UNREAD"})})
+
+    def test_later_rule_wins(self):
+        changes = merge_actions(
+            [("m1", [1, 0], None), ("m2", [0, 2], None)], self.rules
+        )
+        self.assertEqual(changes["m1"], ({"STARRED", "UNREAD"}, set()))
+        self.assertEqual(
+            changes["m2"], ({"STARRED", "TRASH"}, {"UNREAD", "INBOX", "SPAM"})
+        )
+
+    def test_empty_changes_are_dropped(self):
+        self.assertEqual(merge_actions([("m1", [3], None)], self.rules), {})
+
+    def test_known_labels_skip_no_op_changes(self):
+        changes = merge_actions(
+            [
+                ("m1", [0], ["INBOX", "STARRED"]),
+                ("m2", [0], ["INBOX", "UNREAD"]),
+                ("m3", [2], ["TRASH"]),
+            ],
+            self.rules,
+        )
+        self.assertEqual(changes, {"m2": ({"STARRED"}, {"UNREAD"})})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,250 @@
+import random
+import unittest
+from datetime import datetime, timedelta
+from utils.message_index import MessageIndex, compile_rule
+from utils.rule_engine import rule_condition
+from utils.rule_optimizer import optimize_rule
+
+
+def condition(field, operator, value):
+    return {"type": "condition", "field": field, "operator": operator, "value": value}
+
+
+def group(predicate, *rules):
+    return {"type": "rule", "predicate": predicate, "rules": list(rules)}
+
+
+recent = condition("received_at", "greater_than", "7 days")
+from_shop = condition("from_address", "is", "news@shop.com")
+body_sale = condition("body", "contains", "sale")
+subject_sale = condition("subject", "contains", "sale")
+
+
+class TestFlattening(unittest.TestCase):
+
+    def test_nested_groups_with_the_same_predicate(self):
+        rule = group("all", body_sale, group("all", recent, group("all", from_shop)))
+        self.assertEqual(
+            optimize_rule(rule), group("all", recent, from_shop, body_sale)
+        )
+
+    def test_groups_with_another_predicate_are_kept(self):
+        either = group("any", body_sale, subject_sale)
+        rule = group("all", either, from_shop)
+        self.assertEqual(
+            optimize_rule(rule),
+            group("all", from_shop, group("any", subject_sale, body_sale)),
+        )
+
+    def test_single_condition_groups_are_unwrapped(self):
+        rule = group("any", group("all", body_sale))
+        self.assertEqual(optimize_rule(rule), body_sale)
+
+    def test_empty_groups_are_dropped(self):
+        empty = group("all")
+        self.assertEqual(optimize_rule(group("any", empty, body_sale)), body_sale)
+        self.assertEqual(optimize_rule(empty), empty)
+        self.assertEqual(optimize_rule(group("all", empty, group("any"))), empty)
+
+
+class TestDeduplication(unittest.TestCase):
+
+    def test_duplicate_conditions(self):
+        shouting = condition("body", "contains", "SALE")
+        rule = group("all", body_sale, from_shop, shouting, dict(from_shop))
+        self.assertEqual(optimize_rule(rule), group("all", from_shop, body_sale))
+
+    def test_case_matters_for_subject_is(self):
+        rule = group(
+            "any", condition("subject", "is", "Hi"), condition("subject", "is", "hi")
+        )
+        self.assertEqual(len(optimize_rule(rule)["rules"]), 2)
+
+    def test_duplicate_groups_in_any_order(self):
+        rule = group(
+            "all",
+            group("any", body_sale, subject_sale),
+            group("any", subject_sale, body_sale),
+            from_shop,
+        )
+        self.assertEqual(
+            optimize_rule(rule),
+            group("all", from_shop, group("any", subject_sale, body_sale)),
+        )
+
+
+class TestContradictions(unittest.TestCase):
+
+    def assertNever(self, *conditions):
+        self.assertIsNone(optimize_rule(group("all", *conditions)))
+
+    def test_two_different_senders(self):
+        self.assertNever(from_shop, condition("from_address", "is", "boss@work.com"))
+
+    def test_is_and_is_not(self):
+        self.assertNever(
+            from_shop, condition("from_address", "is_not", "NEWS@shop.com")
+        )
+        self.assertNever(
+            condition("subject", "is", "Hi"), condition("subject", "is_not", "Hi")
+        )
+
+    def test_is_and_contains(self):
+        self.assertNever(from_shop, condition("from_address", "contains", "work"))
+        self.assertNever(from_shop, condition("from_address", "not_contains", "SHOP"))
+        self.assertIsNotNone(
+            optimize_rule(
+                group("all", from_shop, condition("from_address", "contains", "Shop"))
+            )
+        )
+
+    def test_contains_and_not_contains(self):
+        self.assertNever(
+            condition("body", "contains", "big sale"),
+            condition("body", "not_contains", "Sale"),
+        )
+
+    def test_date_ranges(self):
+        self.assertNever(recent, condition("received_at", "less_than", "1 month"))
+        self.assertNever(
+            condition("received_at", "greater_than", "1 month"),
+            condition("received_at", "less_than", "31 days"),
+        )
+        # 1 month can be longer than 28 days, so this range may be non-empty
+        self.assertIsNotNone(
+            optimize_rule(
+                group(
+                    "all",
+                    condition("received_at", "greater_than", "1 month"),
+                    condition("received_at", "less_than", "28 days"),
+                )
+            )
+        )
+
+    def test_different_fields_do_not_contradict(self):
+        rule = group("all", from_shop, condition("subject", "is_not", "news@shop.com"))
+        self.assertIsNotNone(optimize_rule(rule))
+
+    def test_never_branches(self):
+        never = group("all", from_shop, condition("from_address", "is", "a@b.com"))
+        self.assertEqual(optimize_rule(group("any", never, body_sale)), body_sale)
+        self.assertIsNone(optimize_rule(group("any", never, dict(never))))
+        self.assertIsNone(optimize_rule(group("all", never, body_sale)))
+        self.assertEqual(rule_condition(group("all", never, body_sale)), "false")
+
+
+class TestOrdering(unittest.TestCase):
+
+    def test_cheap_conditions_first(self):
+        rule = group(
+            "all",
+            condition("body", "not_contains", "unsubscribe"),
+            body_sale,
+            subject_sale,
+            condition("subject", "is", "Big sale"),
+            from_shop,
+            recent,
+        )
+        fields = [
+            (rule["field"], rule["operator"]) for rule in optimize_rule(rule)["rules"]
+        ]
+        self.assertEqual(
+            fields,
+            [
+                ("from_address", "is"),
+                ("received_at", "greater_than"),
+                ("subject", "is"),
+                ("subject", "contains"),
+                ("body", "contains"),
+                ("body", "not_contains"),
+            ],
+        )
+
+    def test_groups_are_ordered_by_total_cost(self):
+        cheap = group("any", recent, from_shop)
+        expensive = group("any", subject_sale, body_sale)
+        optimized = optimize_rule(group("all", expensive, body_sale, cheap))
+        self.assertEqual(optimized["rules"], [cheap, body_sale, expensive])
+
+
+class TestValidation(unittest.TestCase):
+
+    def test_invalid_conditions_are_rejected(self):
+        with self.assertRaises(ValueError):
+            optimize_rule(condition("received_at", "is", "yesterday"))
+
+    def test_invalid_predicate(self):
+        with self.assertRaises(ValueError):
+            optimize_rule(group("most", body_sale, from_shop))
+
+    def test_rule_is_not_modified(self):
+        rule = group("all", body_sale, group("all", from_shop))
+        optimize_rule(rule)
+        self.assertEqual(rule, group("all", body_sale, group("all", from_shop)))
+
+
+conditions = [
+    condition("from_address", "is", "News@Shop.com"),
+    condition("from_address", "is_not", "boss@work.com"),
+    condition("from_address", "contains", "shop"),
+    condition("from_address", "not_contains", "work"),
+    condition("subject", "is", "Sale"),
+    condition("subject", "contains", "sale"),
+    condition("subject", "not_contains", "hi"),
+    condition("body", "contains", "big sale"),
+    condition("body", "not_contains", "sale"),
+    condition("received_at", "greater_than", "7 days"),
+    condition("received_at", "less_than", "1 month"),
+    condition("received_at", "greater_than", "2 months"),
+]
+
+
+def random_rule(rng, depth=0):
+    if depth > 2 or rng.random() < 0.3:
+        return dict(rng.choice(conditions))
+    children = [random_rule(rng, depth + 1) for _ in range(rng.randint(0, 4))]
+    return group(rng.choice(["all", "any"]), *children)
+
+
+class TestEquivalence(unittest.TestCase):
+
+    def test_optimized_rules_match_the_same_messages(self):
+        now = datetime(2024, 5, 31, 12)
+        senders = ["news@shop.com", "NEWS@SHOP.COM", "boss@work.com", None]
+        subjects = ["Sale", "sale", "Hi there", None]
+        bodies = ["Big SALE today", "nothing", "a sale", None]
+        index = MessageIndex.from_rows(
+            {
+                "message_id": f"m{i}",
+                "from_address": senders[i % 4],
+                "subject": subjects[i // 4 % 4],
+                "body": bodies[i // 16 % 4],
+                "received_at": now - timedelta(days=(i * 7) % 90) if i % 5 else None,
+            }
+            for i in range(64)
+        )
+        rng = random.Random(7)
+        for _ in range(300):
+            rule = random_rule(rng)
+            original = compile_rule(rule)
+            optimized = optimize_rule(rule)
+            expected = [
+                row
+                for row in index.rows()
+                if original is None or original(index, now)(row)
+            ]
+            if optimized is None:
+                actual = []
+            else:
+                predicate = compile_rule(optimized)
+                actual = [
+                    row
+                    for row in index.rows()
+                    if predicate is None or predicate(index, now)(row)
+                ]
+            with self.subTest(rule=rule):
+                self.assertEqual(actual, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
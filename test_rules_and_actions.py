@@ -57,6 +57,33 @@ class TestRulesAndActions(unittest.TestCase):
             "received_at > now() - interval '7 days'"
         )
     
+    def test_get_sql_condition_from_address_ignores_case(self):
+        self.assertEqual(
+            get_sql_condition({"field": "from_address", "operator": "is", "value": "Bob@Example.com"}),
+            "lower(from_address) = lower('Bob@Example.com')"
+        )
+        self.assertEqual(
+            get_sql_condition({"field": "from_address", "operator": "is_not", "value": "bob@example.com"}),
+            "lower(from_address) != lower('bob@example.com')"
+        )
+
+    def test_get_sql_condition_escapes_values(self):
+        # Quotes are doubled
+        self.assertEqual(
+            get_sql_condition({"field": "subject", "operator": "is", "value": "It's"}),
+            "subject = 'It''s'"
+        )
+
+        # Like wildcards are matched literally
+        self.assertEqual(
+            get_sql_condition({"field": "subject", "operator": "contains", "value": "50%_off\\"}),
+            "subject ilike '%50\\%\\_off\\\\%'"
+        )
+        self.assertEqual(
+            get_sql_condition({"field": "body", "operator": "not_contains", "value": "o'clock"}),
+            " (body not ilike '%o''clock%')"
+        )
+
     def test_process_rule_single_condition(self):
         rule = {
             "type": "condition",
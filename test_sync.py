@@ -0,0 +1,343 @@
+import importlib.util
+import unittest
+from entities.google import GmailService
+from fake_db import RecordingDB
+from fake_gmail import FakeGmailServer, make_message
+from utils.sync import FullSyncCheckpoint, collect_history_changes, sync
+
+# entities.db imports GoogleDB, which needs arena
+has_arena = importlib.util.find_spec("arena") is not None
+
+
+class FailingUpsertDB(RecordingDB):
+    """bulk_upsert_emails fails `fail` times, reporting it through onError."""
+
+    def __init__(self, fail=0):
+        super().__init__()
+        self.fail = fail
+
+    def bulk_upsert_emails(self, email_data_list, onSuccess=None, onError=None):
+        if self.fail:
+            self.fail -= 1
+            return onError(RuntimeError("database is down"))
+        return super().bulk_upsert_emails(email_data_list, onSuccess, onError)
+
+
+class CrashingDB(RecordingDB):
+    """Fails the store stage after `crash_after` messages, like a killed run."""
+
+    def __init__(self, crash_after):
+        super().__init__()
+        self.crash_after = crash_after
+
+    def writer(self, onError=None, onCommit=None):
+        writer = super().writer(onError, onCommit)
+        add = writer.add
+
+        def crashing_add(data):
+            if len(self.messages) >= self.crash_after:
+                raise RuntimeError("crashed")
+            add(data)
+
+        writer.add = crashing_add
+        return writer
+
+
+class TestCollectHistoryChanges(unittest.TestCase):
+
+    def test_added_then_deleted(self):
+        history = [
+            {"messagesAdded": [{"message": {"id": "a", "labelIds": ["INBOX"]}}]},
+            {"messagesDeleted": [{"message": {"id": "a"}}]},
+        ]
+        added, deleted, label_changes = collect_history_changes(history)
+        self.assertEqual(added, set())
+        self.assertEqual(deleted, {"a"})
+        self.assertEqual(label_changes, {})
+
+    def test_added_outside_inbox_is_ignored(self):
+        history = [{"messagesAdded": [{"message": {"id": "a", "labelIds": ["SENT"]}}]}]
+        added, _, _ = collect_history_changes(history)
+        self.assertEqual(added, set())
+
+    def test_label_changes_are_netted(self):
+        history = [
+            {"labelsAdded": [{"message": {"id": "a", "labelIds": ["STARRED"]}, "labelIds": ["STARRED"]}]},
+            {"labelsRemoved": [{"message": {"id": "a", "labelIds": []}, "labelIds": ["STARRED", "UNREAD"]}]},
+            {"labelsAdded": [{"message": {"id": "a", "labelIds": ["IMPORTANT"]}, "labelIds": ["IMPORTANT"]}]},
+        ]
+        _, _, label_changes = collect_history_changes(history)
+        self.assertEqual(label_changes, {"a": ({"IMPORTANT"}, {"STARRED", "UNREAD"})})
+
+    def test_moved_into_inbox_is_fetched(self):
+        history = [
+            {"labelsAdded": [{"message": {"id": "a", "labelIds": ["INBOX"]}, "labelIds": ["INBOX"]}]},
+        ]
+        added, _, label_changes = collect_history_changes(history)
+        self.assertEqual(added, {"a"})
+        self.assertEqual(label_changes, {})
+
+
+class TestFullSyncCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = []
+        self.checkpoint = FullSyncCheckpoint(
+            lambda page_token, messages: self.saved.append((page_token, messages))
+        )
+
+    def test_moves_past_pages_once_all_their_messages_are_done(self):
+        self.checkpoint.listed(["a", "b"], "p2")
+        self.checkpoint.listed(["c", "d"], "p3")
+        self.checkpoint.listed(["e"], None)
+        # Batches commit out of listing order
+        self.checkpoint.done(["c", "d", "a"])
+        self.assertEqual(self.saved, [])
+        self.assertEqual(self.checkpoint.pending, 2)
+        self.checkpoint.done(["b"])
+        self.assertEqual(self.saved, [("p3", 4)])
+        self.checkpoint.done(["e"])
+        self.assertEqual(self.saved, [("p3", 4), (None, 5)])
+        self.assertEqual(self.checkpoint.pending, 0)
+
+    def test_overlapping_pages(self):
+        self.checkpoint.listed(["a", "b"], "p2")
+        self.checkpoint.listed(["b", "c"], "p3")
+        self.checkpoint.done(["a", "b"])
+        self.assertEqual(self.saved, [("p2", 2)])
+        self.checkpoint.done(["c"])
+        self.assertEqual(self.saved[-1], ("p3", 4))
+
+
+class TestSync(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeGmailServer([make_message(f"m{i}") for i in range(6)]).start()
+        self.gmail = GmailService()
+        self.gmail.service = self.server.build_service()
+        self.gmail.page_size = 4
+        self.server.history_page_size = 2
+        self.db = RecordingDB()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_full_then_incremental(self):
+        sync(self.gmail, self.db)
+        self.assertEqual(len(self.db.messages), 6)
+        self.assertEqual(self.db.history_id, str(self.server.history_id))
+        gets = self.server.request_counts["messages.get"]
+
+        self.server.add_message(make_message("new"))
+        self.server.delete_message("m0")
+        self.server.modify_labels("m1", add=["STARRED"], remove=["INBOX"])
+        sync(self.gmail, self.db)
+
+        self.assertIn("new", self.db.messages)
+        self.assertNotIn("m0", self.db.messages)
+        self.assertEqual(self.db.labels["m1"], {"STARRED"})
+        # Only the new message was fetched again
+        self.assertEqual(self.server.request_counts["messages.get"], gets + 1)
+        self.assertEqual(self.server.request_counts["messages.list"], 2)
+        self.assertEqual(self.db.history_id, str(self.server.history_id))
+
+    def test_expired_checkpoint_falls_back_to_full_sync(self):
+        sync(self.gmail, self.db)
+        self.server.add_message(make_message("new"))
+        self.server.modify_labels("m2", add=["STARRED"], remove=["UNREAD"])
+        self.server.expire_history()
+
+        sync(self.gmail, self.db)
+
+        self.assertIn("new", self.db.messages)
+        self.assertEqual(self.db.labels["m2"], {"INBOX", "STARRED"})
+        self.assertEqual(self.server.request_counts["messages.get"], 13)
+        # Stored messages only had their labels fetched again
+        self.assertEqual(self.server.formats_served, {"full": 7, "minimal": 6})
+
+    def test_full_resync_skips_the_bodies_of_stored_messages(self):
+        self.server.messages = {
+            f"m{i}": make_message(f"m{i}", body="x" * 2000) for i in range(20)
+        }
+        sync(self.gmail, self.db)
+        served = self.server.bytes_served
+        self.server.modify_labels("m3", add=["IMPORTANT"])
+
+        sync(self.gmail, self.db, full=True)
+
+        self.assertEqual(self.server.formats_served, {"full": 20, "minimal": 20})
+        self.assertEqual(self.db.labels["m3"], {"INBOX", "IMPORTANT"})
+        self.assertLess(self.server.bytes_served - served, served / 5)
+
+    def test_message_moved_back_into_scope_is_not_fetched_in_full(self):
+        sync(self.gmail, self.db)
+        self.server.modify_labels("m1", remove=["INBOX"])
+        sync(self.gmail, self.db)
+        self.server.modify_labels("m1", add=["INBOX", "STARRED"])
+
+        sync(self.gmail, self.db)
+
+        self.assertEqual(self.db.labels["m1"], {"INBOX", "STARRED"})
+        self.assertEqual(self.server.formats_served, {"full": 6, "minimal": 1})
+
+    def test_failed_flush_keeps_the_history_checkpoint(self):
+        db = FailingUpsertDB()
+        sync(self.gmail, db)
+        history_id = db.history_id
+        self.server.add_message(make_message("new"))
+        self.server.delete_message("m0")
+        db.fail = 1
+
+        sync(self.gmail, db)
+
+        self.assertNotIn("new", db.messages)
+        self.assertNotIn("m0", db.messages)
+        self.assertEqual(db.history_id, history_id)
+        # The next sync replays the same history and stores the message
+        sync(self.gmail, db)
+        self.assertIn("new", db.messages)
+        self.assertEqual(db.history_id, str(self.server.history_id))
+
+    def test_rate_limited_message_keeps_the_history_checkpoint(self):
+        sync(self.gmail, self.db)
+        history_id = self.db.history_id
+        self.server.add_message(make_message("new"))
+        self.gmail.max_retries = 1
+        self.gmail.backoff_base = 0.01
+        self.server.rate_limited = {"new": 2}
+
+        sync(self.gmail, self.db)
+
+        self.assertNotIn("new", self.db.messages)
+        self.assertEqual(self.db.history_id, history_id)
+        sync(self.gmail, self.db)
+        self.assertIn("new", self.db.messages)
+        self.assertEqual(self.db.history_id, str(self.server.history_id))
+
+    def test_unparsed_new_message_is_skipped(self):
+        sync(self.gmail, self.db)
+        broken = make_message("new")
+        del broken["payload"]["headers"][1]
+        self.server.add_message(broken)
+
+        sync(self.gmail, self.db)
+
+        self.assertNotIn("new", self.db.messages)
+        self.assertEqual(self.db.history_id, str(self.server.history_id))
+
+    def test_failed_flush_leaves_the_full_sync_unfinished(self):
+        db = FailingUpsertDB(fail=1)
+
+        sync(self.gmail, db)
+
+        self.assertEqual(len(db.messages), 5)
+        self.assertIsNone(db.history_id)
+        self.assertIsNotNone(db.full_sync_progress)
+        sync(self.gmail, db)
+        self.assertEqual(len(db.messages), 6)
+        self.assertEqual(db.history_id, str(self.server.history_id))
+        self.assertIsNone(db.full_sync_progress)
+
+    def test_unparsed_message_is_skipped(self):
+        # Without a To header the message can never be parsed
+        broken = make_message("m2")
+        del broken["payload"]["headers"][1]
+        self.server.messages["m2"] = broken
+
+        sync(self.gmail, self.db)
+
+        self.assertEqual(len(self.db.messages), 5)
+        self.assertEqual(self.db.history_id, str(self.server.history_id))
+        self.assertIsNone(self.db.full_sync_progress)
+        lists = self.server.request_counts["messages.list"]
+        sync(self.gmail, self.db)
+        # The next sync is incremental instead of listing the mailbox again
+        self.assertEqual(self.server.request_counts["messages.list"], lists)
+
+    def test_rate_limited_message_leaves_the_full_sync_unfinished(self):
+        self.gmail.max_retries = 1
+        self.gmail.backoff_base = 0.01
+        self.server.rate_limited = {"m2": 2}
+
+        sync(self.gmail, self.db)
+
+        self.assertNotIn("m2", self.db.messages)
+        self.assertIsNone(self.db.history_id)
+        self.assertIsNotNone(self.db.full_sync_progress)
+        sync(self.gmail, self.db)
+        self.assertIn("m2", self.db.messages)
+        self.assertEqual(self.db.history_id, str(self.server.history_id))
+        self.assertIsNone(self.db.full_sync_progress)
+
+    def test_interrupted_full_sync_resumes(self):
+        self.server.messages = {f"m{i}": make_message(f"m{i}") for i in range(40)}
+        self.gmail.batch_size = 3
+        history_id = str(self.server.history_id)
+        db = CrashingDB(crash_after=15)
+        with self.assertRaises(RuntimeError):
+            sync(self.gmail, db)
+        self.assertIsNone(db.history_id)
+        progress = db.full_sync_progress
+        self.assertEqual(progress["history_id"], history_id)
+        self.assertIsNotNone(progress["page_token"])
+        self.assertTrue(0 < progress["messages"] <= 15)
+
+        stored = len(db.messages)
+        full_gets = self.server.formats_served["full"]
+        lists = self.server.request_counts["messages.list"]
+        self.server.add_message(make_message("new"))
+        db.crash_after = 1000
+        sync(self.gmail, db)
+
+        # Listing resumed from the checkpoint and stored messages were only
+        # refreshed
+        self.assertEqual(len(db.messages), 41)
+        self.assertEqual(self.server.formats_served["full"] - full_gets, 41 - stored)
+        self.assertEqual(
+            self.server.formats_served["minimal"], stored - progress["messages"]
+        )
+        # A listing from the start would take 11 pages
+        self.assertLess(self.server.request_counts["messages.list"] - lists, 11)
+        self.assertIsNone(db.full_sync_progress)
+        # Changes made since the interrupted run started are still replayed
+        self.assertEqual(db.history_id, history_id)
+
+
+@unittest.skipUnless(has_arena, "arena is not installed")
+class TestSyncLabels(unittest.TestCase):
+    """Syncs into GoogleDB when POSTGRES_* points to a database."""
+
+    def setUp(self):
+        from entities.db.googledb import GoogleDB
+
+        self.server = FakeGmailServer(
+            [make_message(f"m{i}", labels=["INBOX", "UNREAD"]) for i in range(3)]
+        ).start()
+        self.addCleanup(self.server.stop)
+        self.gmail = GmailService()
+        self.gmail.service = self.server.build_service()
+        self.db = GoogleDB(account="labels_test")
+        self.message_ids = list(self.server.messages)
+        try:
+            self.db.delete_emails(self.message_ids)
+        except Exception as e:
+            raise unittest.SkipTest(f"No Postgres to sync into: {e}")
+        self.addCleanup(self.db.delete_emails, self.message_ids)
+        self.db.set_history_id(None)
+        self.db.clear_full_sync_progress()
+
+    def test_user_labels_are_registered(self):
+        sync(self.gmail, self.db)
+        # Neither label is seeded by init.sql
+        self.server.modify_labels("m0", add=["Label_sync_1"], remove=["UNREAD"])
+        sync(self.gmail, self.db)
+        self.server.modify_labels("m1", add=["Label_sync_2"])
+        sync(self.gmail, self.db, full=True)
+
+        labels = self.db.get_stored_labels(self.message_ids)
+        self.assertEqual(labels["m0"], {"INBOX", "Label_sync_1"})
+        self.assertEqual(labels["m1"], {"INBOX", "UNREAD", "Label_sync_2"})
+
+
+if __name__ == "__main__":
+    unittest.main()
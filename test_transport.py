@@ -0,0 +1,95 @@
+import threading
+import unittest
+from entities.google import GmailService
+from entities.google.transport import HttpPool
+from fake_gmail import FakeGmailServer, make_message
+
+
+class TestHttpPool(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeGmailServer(
+            [make_message(f"m{i}") for i in range(20)], latency=0.01
+        ).start()
+        self.service = self.server.build_service()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def profile(self):
+        return self.service.users().getProfile(userId="me")
+
+    def test_connections_are_kept_alive(self):
+        pool = HttpPool(size=2)
+        for _ in range(10):
+            pool.execute(self.profile())
+
+        stats = pool.stats()
+        self.assertEqual(stats["transports"], 1)
+        self.assertEqual(stats["checkouts"], 10)
+        self.assertEqual(stats["reused"], 9)
+        self.assertEqual(stats["per_transport"][0]["requests"], 10)
+        self.assertEqual(self.server.connections, 1)
+        pool.close()
+
+    def test_shared_between_threads(self):
+        pool = HttpPool(size=3)
+        in_use = []
+        errors = []
+        lock = threading.Lock()
+        active = [0]
+
+        def work():
+            for i in range(10):
+                try:
+                    with pool.connection() as http:
+                        with lock:
+                            active[0] += 1
+                            in_use.append(active[0])
+                        self.service.users().messages().get(
+                            userId="me", id=f"m{i}"
+                        ).execute(http=http)
+                        with lock:
+                            active[0] -= 1
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=work) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertLessEqual(max(in_use), 3)
+        stats = pool.stats()
+        self.assertLessEqual(stats["transports"], 3)
+        self.assertEqual(stats["checkouts"], 60)
+        self.assertLessEqual(self.server.connections, 3)
+        pool.close()
+
+    def test_broken_transports_are_discarded(self):
+        pool = HttpPool(size=1)
+        with self.assertRaises(ConnectionError):
+            with pool.connection():
+                raise ConnectionError("reset by peer")
+        pool.execute(self.profile())
+        stats = pool.stats()
+        self.assertEqual(stats["discarded"], 1)
+        self.assertEqual(stats["transports"], 1)
+
+    def test_gmail_service_uses_the_pool(self):
+        gmail = GmailService()
+        gmail.service = self.service
+        gmail.fetch_concurrency = 3
+        gmail.batch_size = 4
+        messages = list(gmail.messages_list(remainingMessages=20, batched=True))
+        self.assertEqual(len(messages), 20)
+        gmail.get_profile()
+        self.assertGreater(gmail.http_pool.stats()["reused"], 0)
+        self.assertLessEqual(self.server.connections, gmail.http_pool.size)
+        gmail.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
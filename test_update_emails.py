@@ -0,0 +1,189 @@
+import importlib
+import importlib.util
+import json
+import unittest
+from unittest import mock
+from entities.google import GmailService
+from fake_db import RecordingDB
+from fake_gmail import FakeGmailServer, make_message
+from utils.gmail import get_required_data
+from utils.message_index import MessageIndex
+from utils.rule_engine import load_rules
+
+# 2_update_emails imports GoogleDB, which needs arena
+has_arena = importlib.util.find_spec("arena") is not None
+
+
+def condition(field, value):
+    return {"type": "condition", "field": field, "operator": "contains", "value": value}
+
+
+rules = load_rules(
+    {
+        "rules": [
+            {
+                "name": "invoices",
+                "rule": condition("subject", "invoice"),
+                "action": {"starred": True},
+            },
+            {
+                "name": "newsletters",
+                "rule": condition("from_address", "news"),
+                "action": {"unread": False},
+            },
+            {
+                "name": "never",
+                "rule": {
+                    "type": "rule",
+                    "predicate": "all",
+                    "rules": [
+                        {**condition("subject", "a"), "operator": "is"},
+                        {**condition("subject", "b"), "operator": "is"},
+                    ],
+                },
+                "action": {"starred": True},
+            },
+        ]
+    }
+)
+
+def make_messages():
+    return [
+        make_message(f"invoice{i}", subject=f"Invoice {i}", labels=["INBOX"])
+        for i in range(5)
+    ] + [
+        make_message("news", sender="news@example.com", labels=["INBOX", "UNREAD"]),
+        make_message("starred", subject="Old invoice", labels=["INBOX", "STARRED"]),
+        make_message("other", labels=["INBOX"]),
+    ]
+
+
+class StreamingDB(RecordingDB):
+    """Streams rule matches from an in-memory index, in the batches asked for."""
+
+    def __init__(self, fail_after=None):
+        super().__init__()
+        self.index = MessageIndex()
+        self.batch_sizes = []
+        self.conditions = None
+        self.fail_after = fail_after
+        for message in make_messages():
+            data = get_required_data(message)
+            self.bulk_upsert_emails([data])
+            self.index.add(data)
+
+    def stream_rule_matches(self, conditions, batch_size=1000):
+        self.conditions = conditions
+        self.batch_sizes.append(batch_size)
+        # Same order of indexes as the conditions the script runs
+        matches = self.index.evaluate(rules)
+        for start in range(0, len(matches), batch_size):
+            if self.fail_after is not None and start >= self.fail_after:
+                raise ConnectionError("connection lost")
+            yield matches[start : start + batch_size]
+
+
+@unittest.skipUnless(has_arena, "arena is not installed")
+class TestUpdateEmails(unittest.TestCase):
+
+    def setUp(self):
+        self.script = importlib.import_module("2_update_emails")
+        self.server = FakeGmailServer(make_messages()).start()
+        self.gmail = GmailService()
+        self.gmail.service = self.server.build_service()
+        self.gmail.modify_batch_size = 2
+
+    def tearDown(self):
+        self.server.stop()
+
+    def run_script(self, db):
+        conditions = self.script.get_rule_conditions_to_run(rules)
+        with mock.patch.object(self.script, "GoogleDB", return_value=db):
+            with mock.patch.object(
+                self.script, "GmailService", return_value=self.gmail
+            ):
+                self.script.make_the_actions(rules, conditions)
+        return conditions
+
+    def test_streamed_matches_are_applied(self):
+        db = StreamingDB()
+        conditions = self.run_script(db)
+
+        self.assertEqual(conditions[2], "false")
+        self.assertEqual(db.conditions, conditions)
+        self.assertEqual(db.batch_sizes, [2])
+        modified = {}
+        for message_ids, add, remove in self.server.modify_calls:
+            self.assertLessEqual(len(message_ids), 2)
+            for message_id in message_ids:
+                modified[message_id] = (add, remove)
+        # The starred invoice needs no change and is left out
+        self.assertEqual(
+            modified,
+            {
+                **{f"invoice{i}": (["STARRED"], []) for i in range(5)},
+                "news": ([], ["UNREAD"]),
+            },
+        )
+        self.assertIn("STARRED", db.labels["invoice3"])
+        self.assertNotIn("UNREAD", db.labels["news"])
+
+    def test_stream_error_keeps_the_changes_already_planned(self):
+        db = StreamingDB(fail_after=4)
+        self.run_script(db)
+
+        modified = [
+            message_id
+            for message_ids, _, _ in self.server.modify_calls
+            for message_id in message_ids
+        ]
+        self.assertEqual(len(modified), 4)
+        self.assertTrue(
+            all(message_id.startswith("invoice") for message_id in modified)
+        )
+
+
+@unittest.skipUnless(has_arena, "arena is not installed")
+class TestStreamRuleMatches(unittest.TestCase):
+    """Streams from the named cursor when POSTGRES_* points to a database."""
+
+    def setUp(self):
+        from entities.db.googledb import GoogleDB
+        from utils.rule_engine import get_rule_conditions
+
+        self.db = GoogleDB(account="stream_test")
+        self.messages = make_messages()
+        self.message_ids = [message["id"] for message in self.messages]
+        try:
+            self.db.delete_emails(self.message_ids)
+        except Exception as e:
+            raise unittest.SkipTest(f"No Postgres to stream from: {e}")
+        self.db.bulk_upsert_emails([get_required_data(m) for m in self.messages])
+        self.conditions = get_rule_conditions(rules[:2])
+
+    def tearDown(self):
+        self.db.delete_emails(self.message_ids)
+
+    def test_batches(self):
+        batches = list(self.db.stream_rule_matches(self.conditions, batch_size=2))
+
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 2, 1])
+        matches = {
+            message_id: (sorted(indexes), sorted(labels))
+            for batch in batches
+            for message_id, indexes, labels in batch
+        }
+        self.assertEqual(matches["news"], ([1], ["INBOX", "UNREAD"]))
+        self.assertEqual(matches["starred"], ([0], ["INBOX", "STARRED"]))
+        self.assertNotIn("other", matches)
+
+    def test_explained_plan_is_the_one_run(self):
+        plan = json.dumps(self.db.explain_rule_matches(self.conditions))
+
+        # Scoped to the account, labels looked up per message
+        self.assertIn("'stream_test'::text", plan)
+        self.assertIn("message_labels", plan)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import importlib.util
+import threading
+import time
+import unittest
+from fake_gmail import make_message
+from utils.gmail import get_required_data
+from utils.pipeline import IngestPipeline
+
+
+class UpsertDB:
+    """Records the batches of bulk_upsert_emails, failing the first `fail` ones."""
+
+    def __init__(self, fail=0):
+        self.batches = []
+        self.flushed_at = []
+        self.fail = fail
+
+    def bulk_upsert_emails(self, email_data_list, onSuccess=None, onError=None):
+        if self.fail:
+            self.fail -= 1
+            error = RuntimeError("database is down")
+            if onError is None:
+                raise error
+            return onError(error)
+        self.batches.append([data["message_id"] for data in email_data_list])
+        self.flushed_at.append(time.monotonic())
+        return onSuccess(len(email_data_list)) if onSuccess else len(email_data_list)
+
+
+# entities.db imports GoogleDB, which needs arena
+has_arena = importlib.util.find_spec("arena") is not None
+
+
+def rows(count):
+    return [get_required_data(make_message(f"m{i}")) for i in range(count)]
+
+
+@unittest.skipUnless(has_arena, "arena is not installed")
+class TestBufferedEmailWriter(unittest.TestCase):
+
+    def writer(self, db, **kwargs):
+        from entities.db.writer import BufferedEmailWriter
+
+        return BufferedEmailWriter(db, **kwargs)
+
+    def test_failed_flushes_are_recorded(self):
+        db = UpsertDB(fail=1)
+        errors = []
+        committed = []
+        with self.writer(
+            db, batch_size=2, onError=errors.append, onCommit=committed.extend
+        ) as writer:
+            for data in rows(5):
+                writer.add(data)
+
+        self.assertEqual(db.batches, [["m2", "m3"], ["m4"]])
+        self.assertEqual(committed, ["m2", "m3", "m4"])
+        self.assertEqual((writer.written, writer.failed), (3, 2))
+        self.assertEqual(writer.failed_batches, 1)
+        self.assertIs(writer.error, errors[0])
+
+    def test_failed_flush_raises_without_onError(self):
+        writer = self.writer(UpsertDB(fail=1), batch_size=1)
+        with self.assertRaises(RuntimeError):
+            writer.add(rows(1)[0])
+        self.assertEqual(writer.failed_batches, 1)
+
+    def test_stalled_stream_is_flushed_on_time(self):
+        db = UpsertDB()
+        resume = threading.Event()
+
+        def messages():
+            yield make_message("m0")
+            resume.wait(5)
+            yield make_message("m1")
+
+        writer = self.writer(db, batch_size=100, flush_interval=0.2)
+        thread = threading.Thread(
+            target=lambda: IngestPipeline(writer, parse_workers=1).run(messages())
+        )
+        started = time.monotonic()
+        thread.start()
+        deadline = started + 5
+        while not db.batches and time.monotonic() < deadline:
+            time.sleep(0.01)
+        resume.set()
+        thread.join()
+        writer.close()
+
+        # m0 was written while the stream waited for m1
+        self.assertEqual(db.batches, [["m0"], ["m1"]])
+        self.assertLess(db.flushed_at[0] - started, 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import re
+from dotenv import load_dotenv
+from entities.google import GmailService
+
+load_dotenv()
+
+# Account names end up in file names and in the account column
+_account_name = re.compile(r"^[\w.@+-]+$")
+
+
+def load_accounts(file_content):
+    """
+    Read the account registry.
+
+    Args:
+        file_content: Parsed accounts file, {"accounts": [{"name": ...,
+            "token_path": ..., "user_id": ..., "root_url": ...}]}; only the
+            name is required
+
+    Returns:
+        List of {name, token_path, user_id, root_url}. Tokens default to
+        `GOOGLE_TOKEN_DIR/<name>.json`.
+
+    Raises:
+        ValueError for missing, invalid or duplicate names
+    """
+    token_dir = os.getenv("GOOGLE_TOKEN_DIR", "tokens")
+    accounts = []
+    seen = set()
+    for position, entry in enumerate(file_content.get("accounts", []), start=1):
+        name = entry.get("name")
+        if not name or not _account_name.match(name):
+            raise ValueError(f"Account {position} has an invalid name: {name!r}")
+        if name in seen:
+            raise ValueError(f"Account {name} is listed twice")
+        seen.add(name)
+        accounts.append(
+            {
+                "name": name,
+                "token_path": entry.get("token_path")
+                or os.path.join(token_dir, f"{name}.json"),
+                "user_id": entry.get("user_id", "me"),
+                "root_url": entry.get("root_url"),
+            }
+        )
+    return accounts
+
+
+def gmail_for(account):
+    return GmailService(
+        token_path=account["token_path"],
+        user_id=account["user_id"],
+        root_url=account["root_url"],
+    )
@@ -0,0 +1,107 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def change_key(add_labels, remove_labels):
+    return tuple(sorted(add_labels)), tuple(sorted(remove_labels))
+
+
+class ActionPlanner:
+    """
+    Turns per-message label changes into as few batchModify calls as possible.
+
+    Messages needing exactly the same change are grouped, and a group is sent
+    as soon as it holds `batch_size` ids, so every call but the last of each
+    group carries the maximum number of ids. Up to `concurrency` calls run at
+    the same time. Callbacks run on the thread calling add, flush or close.
+
+    Args:
+        gmail: GmailService used for the calls
+        batch_size: Ids per call, at most 1000
+        concurrency: Number of calls in flight at once
+        onSuccess: Called with (add_labels, remove_labels, message_ids) after
+            each successful call
+        onError: Called with (error, message_ids) when a call fails
+    """
+
+    def __init__(
+        self, gmail, batch_size=None, concurrency=None, onSuccess=None, onError=None
+    ):
+        self.gmail = gmail
+        if gmail.service is None:
+            # Authenticate once here rather than racing in the worker threads
+            gmail.authenticate()
+        self.batch_size = min(1000, batch_size or gmail.modify_batch_size)
+        self.concurrency = concurrency or gmail.modify_concurrency
+        self.onSuccess = onSuccess
+        self.onError = onError
+        self.groups = {}
+        self.pending = set()
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self.calls = 0
+        self.modified = 0
+        self.failed = 0
+
+    def add(self, message_id, add_labels, remove_labels):
+        key = change_key(add_labels, remove_labels)
+        if key == ((), ()):
+            return
+        message_ids = self.groups.setdefault(key, [])
+        message_ids.append(message_id)
+        if len(message_ids) >= self.batch_size:
+            self._submit(key, self.groups.pop(key))
+
+    def add_changes(self, changes):
+        for message_id, (add_labels, remove_labels) in changes.items():
+            self.add(message_id, add_labels, remove_labels)
+
+    def _submit(self, key, message_ids):
+        while len(self.pending) >= self.concurrency:
+            done, self.pending = wait(self.pending, return_when=FIRST_COMPLETED)
+            self._collect(done)
+        self.pending.add(self.executor.submit(self._modify, key, message_ids))
+
+    def _modify(self, key, message_ids):
+        add_labels, remove_labels = key
+        try:
+            self.gmail.bulk_modify_message_labels(
+                message_ids, list(add_labels), list(remove_labels)
+            )
+        except Exception as e:
+            return key, message_ids, e
+        return key, message_ids, None
+
+    def _collect(self, done):
+        for future in done:
+            (add_labels, remove_labels), message_ids, error = future.result()
+            if error is not None:
+                self.failed += len(message_ids)
+                if self.onError:
+                    self.onError(error, message_ids)
+                else:
+                    print(f"Error modifying {len(message_ids)} messages", error)
+                continue
+            self.calls += 1
+            self.modified += len(message_ids)
+            if self.onSuccess:
+                self.onSuccess(add_labels, remove_labels, message_ids)
+
+    def flush(self):
+        """Send the partly filled groups and wait for every call in flight."""
+        groups, self.groups = self.groups, {}
+        for key, message_ids in groups.items():
+            self._submit(key, message_ids)
+        done, _ = wait(self.pending)
+        self.pending = set()
+        self._collect(done)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
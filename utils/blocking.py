@@ -0,0 +1,60 @@
+import asyncio
+import inspect
+import threading
+
+
+class Blocking:
+    """
+    Blocking wrapper around an asyncio client (AsyncGmailService,
+    AsyncGoogleDB), for synchronous code that wants its connection pool.
+
+    The client runs on an event loop in a background thread. Its coroutine
+    methods become blocking calls and its async generators become plain
+    generators; other attributes are passed through.
+
+        with Blocking(AsyncGmailService()) as gmail:
+            for message in gmail.messages_list(remainingMessages=5000):
+                ...
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def _iterate(self, generator):
+        try:
+            while True:
+                try:
+                    yield self._run(generator.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self._run(generator.aclose())
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if inspect.iscoroutinefunction(attribute):
+            return lambda *args, **kwargs: self._run(attribute(*args, **kwargs))
+        if inspect.isasyncgenfunction(attribute):
+            return lambda *args, **kwargs: self._iterate(attribute(*args, **kwargs))
+        return attribute
+
+    def close(self):
+        if self._loop.is_closed():
+            return
+        if hasattr(self._client, "close"):
+            self._run(self._client.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
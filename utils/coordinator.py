@@ -0,0 +1,161 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dotenv import load_dotenv
+from utils.accounts import gmail_for
+from utils.sync import sync
+
+load_dotenv()
+
+# Gmail clients of the accounts a worker process owns, kept between rounds so
+# the token, discovery document and keep-alive connections are reused
+_gmail_clients = {}
+
+
+def _make_db(account_name):
+    from entities.db import GoogleDB
+
+    return GoogleDB(account=account_name)
+
+
+def sync_account(account, make_db=None, full=False, labels=["INBOX"]):
+    """
+    Sync one account in a worker process.
+
+    Args:
+        account: Entry of load_accounts
+        make_db: Called with the account name, returns the database to sync
+            into; GoogleDB(account=name) by default
+
+    Returns:
+        {"account", "pid", "history_id", "messages", "seconds", "error"}
+    """
+    started = time.monotonic()
+    summary = {
+        "account": account["name"],
+        "pid": os.getpid(),
+        "history_id": None,
+        "messages": 0,
+        "seconds": 0.0,
+        "error": None,
+    }
+    db = None
+    try:
+        gmail = _gmail_clients.get(account["name"])
+        if gmail is None:
+            # A worker must never fall back to the browser flow
+            if not os.path.exists(account["token_path"]):
+                raise FileNotFoundError(
+                    f"No token at {account['token_path']}, sign in with --authorize"
+                )
+            gmail = _gmail_clients[account["name"]] = gmail_for(account)
+        fetched = gmail.messages_fetched
+        # One connection per sync rather than per account, a shard can hold
+        # hundreds of accounts
+        db = (make_db or _make_db)(account["name"])
+        summary["history_id"] = sync(gmail, db, labels=labels, full=full)
+        summary["messages"] = gmail.messages_fetched - fetched
+    except Exception as e:
+        summary["error"] = repr(e)
+    finally:
+        if db is not None and hasattr(db, "close"):
+            db.close()
+    summary["seconds"] = time.monotonic() - started
+    return summary
+
+
+class SyncCoordinator:
+    """
+    Syncs many mailboxes by sharding them across worker processes.
+
+    Accounts are dealt round-robin to the workers by name, so the shards
+    differ by at most one account. Every account belongs to one worker for
+    the life of the coordinator, so its Gmail client stays warm in that
+    process and two syncs of the same account never overlap. Each account
+    keeps its own checkpoint (sync_state keyed by account name). Within a
+    round, every worker syncs its accounts least recently synced first,
+    with the ones never synced at the front. An account that fails is
+    reported and retried first next round without holding up the others.
+
+    Args:
+        accounts: Entries of load_accounts
+        workers: Number of worker processes, SYNC_WORKERS or the CPU count
+        make_db: Database factory passed to sync_account, must be picklable
+        labels: Messages carrying all of these labels are synced
+    """
+
+    def __init__(self, accounts, workers=None, make_db=None, labels=["INBOX"]):
+        self.accounts = accounts
+        workers = workers or int(os.getenv("SYNC_WORKERS", "0")) or os.cpu_count()
+        self.workers = max(1, min(workers, len(accounts)))
+        self.make_db = make_db
+        self.labels = labels
+        names = sorted(account["name"] for account in accounts)
+        self.shards = {name: i % self.workers for i, name in enumerate(names)}
+        self.last_synced = {name: None for name in names}
+        self.last_summary = {}
+        self.rounds = 0
+        self._executors = None
+
+    def _order(self):
+        return sorted(
+            self.accounts,
+            key=lambda account: (
+                self.last_synced[account["name"]] is not None,
+                self.last_synced[account["name"]] or 0,
+            ),
+        )
+
+    def run_round(self, full=False):
+        """Sync every account once, returns the summaries in completion order."""
+        if self._executors is None:
+            # One single-process executor per shard runs its accounts in order
+            self._executors = [
+                ProcessPoolExecutor(max_workers=1) for _ in range(self.workers)
+            ]
+        started = time.monotonic()
+        futures = [
+            self._executors[self.shards[account["name"]]].submit(
+                sync_account, account, self.make_db, full, self.labels
+            )
+            for account in self._order()
+        ]
+        summaries = []
+        for future in as_completed(futures):
+            summary = future.result()
+            if not summary["error"]:
+                self.last_synced[summary["account"]] = time.time()
+            self.last_summary[summary["account"]] = summary
+            summaries.append(summary)
+        self.rounds += 1
+        self.report(summaries, time.monotonic() - started)
+        return summaries
+
+    def run(self, interval, stop):
+        """Run rounds every `interval` seconds until the `stop` event is set."""
+        while not stop.is_set():
+            self.run_round()
+            stop.wait(interval)
+
+    def report(self, summaries, seconds):
+        failed = [summary for summary in summaries if summary["error"]]
+        messages = sum(summary["messages"] for summary in summaries)
+        for summary in failed:
+            print(f"{summary['account']}: sync failed, {summary['error']}")
+        print(
+            f"Round {self.rounds}: {len(summaries)} accounts, {len(failed)} failed, "
+            f"{messages} messages in {seconds:.1f}s "
+            f"({messages / seconds if seconds else 0:.0f} messages/s, "
+            f"{self.workers} workers)"
+        )
+
+    def close(self):
+        for executor in self._executors or []:
+            executor.shutdown()
+        self._executors = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,258 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+from utils.action_planner import ActionPlanner
+from utils.message_index import MessageIndex
+from utils.rule_engine import merge_actions
+from utils.sync import sync
+
+load_dotenv()
+
+
+class LatencyStats:
+    """Count, mean and maximum of every sample, percentiles of the latest `window`."""
+
+    def __init__(self, name, window=1000):
+        self.name = name
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def percentile(self, percent):
+        with self._lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "max": self.max,
+        }
+
+    def __str__(self):
+        stats = self.snapshot()
+        return (
+            f"{self.name}: {stats['count']} samples, mean {stats['mean']:.3f}s, "
+            f"p50 {stats['p50']:.3f}s, p95 {stats['p95']:.3f}s, max {stats['max']:.3f}s"
+        )
+
+
+class RuleDaemon:
+    """
+    Keeps the database in sync with the mailbox and applies the rules to new
+    messages as they arrive.
+
+    Every notification (or every `fallback_interval` seconds without one, in
+    case a notification was lost) triggers a cycle: an incremental sync whose
+    new messages are also put in a fresh MessageIndex, in process evaluation
+    of the rules over that index, and batchModify calls for the changes.
+    The Gmail session and the database pool stay open between cycles.
+
+    Latencies are recorded for the cycle itself, from notification to label
+    applied, and from mail arrival (Gmail's internalDate) to label applied.
+
+    Args:
+        gmail: Authenticated GmailService
+        db: GoogleDB, preferably with a connection pool
+        rules: Rules as returned by load_rules
+        notifier: PollingNotifier, QueueNotifier or PushNotifier
+        labels: Messages carrying all of these labels are synced
+        fallback_interval: Seconds without notification before syncing anyway
+        watch_topic: Pub/Sub topic to register with GmailService.watch, renewed
+            once a day
+    """
+
+    def __init__(
+        self,
+        gmail,
+        db,
+        rules,
+        notifier,
+        labels=["INBOX"],
+        fallback_interval=None,
+        watch_topic=None,
+    ):
+        self.gmail = gmail
+        self.db = db
+        self.rules = rules
+        self.notifier = notifier
+        self.labels = labels
+        self.fallback_interval = fallback_interval or float(
+            os.getenv("DAEMON_FALLBACK_INTERVAL", "60")
+        )
+        self.watch_topic = watch_topic
+        self.watch_renewed = None
+        self.history_id = None
+        self.latency = {
+            name: LatencyStats(name)
+            for name in ["cycle", "notification_to_action", "arrival_to_action"]
+        }
+        self.cycles = 0
+        self.errors = 0
+        self.messages_indexed = 0
+        self.messages_modified = 0
+        self._stop = threading.Event()
+        self._planner = None
+        self._index = None
+        self._notification = None
+        self._wait_failures = 0
+
+    def _renew_watch(self):
+        if self.watch_topic is None:
+            return
+        if self.watch_renewed and time.monotonic() - self.watch_renewed < 86400:
+            return
+        response = self.gmail.watch(self.watch_topic, self.labels)
+        self.watch_renewed = time.monotonic()
+        print(f"Watching the mailbox from history id {response.get('historyId')}")
+
+    def _applied(self, add_labels, remove_labels, message_ids):
+        self.db.apply_label_changes(
+            message_ids,
+            add_labels,
+            remove_labels,
+            onError=lambda error: print("Error updating local labels", error),
+        )
+        now, monotonic_now = time.time(), time.monotonic()
+        self.messages_modified += len(message_ids)
+        for message_id in message_ids:
+            if self._notification is not None:
+                self.latency["notification_to_action"].record(
+                    monotonic_now - self._notification["received"]
+                )
+            row = self._index.positions.get(message_id)
+            received_at = self._index.received_at[row] if row is not None else None
+            if received_at is not None:
+                self.latency["arrival_to_action"].record(max(0.0, now - received_at))
+
+    def run_cycle(self, notification=None):
+        started = time.monotonic()
+        self._index = MessageIndex()
+        self._notification = notification
+        self.history_id = sync(
+            self.gmail, self.db, labels=self.labels, index=self._index
+        )
+        self.messages_indexed += len(self._index)
+        if len(self._index):
+            changes = merge_actions(self._index.evaluate(self.rules), self.rules)
+            self._planner.add_changes(changes)
+            self._planner.flush()
+        self.cycles += 1
+        self.latency["cycle"].record(time.monotonic() - started)
+
+    def _run_guarded(self, notification=None):
+        # A failed cycle is retried with the next notification or fallback
+        try:
+            self.run_cycle(notification)
+        except Exception as e:
+            self.errors += 1
+            print("Error running the daemon cycle", e)
+
+    def _wait_guarded(self):
+        # Polling notifiers call Gmail, which can fail for longer than its
+        # retries last; back off and keep waiting rather than ending the daemon
+        try:
+            notification = self.notifier.wait(timeout=1.0)
+        except Exception as e:
+            self.errors += 1
+            self._wait_failures += 1
+            delay = min(60, 2 ** (self._wait_failures - 1))
+            print(f"Error waiting for a notification, retrying in {delay}s", e)
+            self._stop.wait(delay)
+            return None
+        self._wait_failures = 0
+        return notification
+
+    def run(self):
+        """Run cycles until stop is called."""
+        self._planner = ActionPlanner(self.gmail, onSuccess=self._applied)
+        try:
+            # The first cycle catches up with everything since the last run
+            self._run_guarded()
+            last_cycle = time.monotonic()
+            while not self._stop.is_set():
+                try:
+                    self._renew_watch()
+                except Exception as e:
+                    print("Error renewing the mailbox watch", e)
+                notification = self._wait_guarded()
+                if self._stop.is_set():
+                    break
+                if (
+                    notification is None
+                    and time.monotonic() - last_cycle < self.fallback_interval
+                ):
+                    continue
+                self._run_guarded(notification)
+                last_cycle = time.monotonic()
+        finally:
+            self._planner.close()
+
+    def stop(self):
+        self._stop.set()
+        self.notifier.close()
+
+    def metrics(self):
+        return {
+            "history_id": self.history_id,
+            "cycles": self.cycles,
+            "errors": self.errors,
+            "messages_indexed": self.messages_indexed,
+            "messages_modified": self.messages_modified,
+            "latency": {name: stats.snapshot() for name, stats in self.latency.items()},
+            "http": self.gmail.http_pool.stats(),
+            "quota": self.gmail.rate_limiter.stats(),
+        }
+
+    def report(self):
+        print(
+            f"{self.cycles} cycles, {self.errors} errors, "
+            f"{self.messages_indexed} new messages, "
+            f"{self.messages_modified} messages modified"
+        )
+        for stats in self.latency.values():
+            print(stats)
+        print(self.gmail.http_pool)
+        print(self.gmail.rate_limiter)
+
+
+def serve_metrics(daemon, host="127.0.0.1", port=9100):
+    """Expose `daemon.metrics()` as JSON on http://host:port/metrics."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_response(404)
+                self.end_headers()
+                return
+            payload = json.dumps(daemon.metrics()).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
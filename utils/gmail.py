@@ -1,7 +1,112 @@
 import base64
+import codecs
 import html2text
+import os
 import re
+from html.parser import HTMLParser
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
+from itertools import islice
+
+
+body_strategies = ["html2text", "strip", "plain"]
+
+# Elements whose boundaries separate words in the extracted text
+_block_tags = set(
+    "address article blockquote br dd div dl dt footer h1 h2 h3 h4 h5 h6 header "
+    "hr li ol p pre section table td th tr ul".split()
+)
+_skipped_tags = {"head", "script", "style", "title"}
+_email_pattern = re.compile(r"[\w\.-]+@[\w\.-]+")
+
+
+class _TagStripper(HTMLParser):
+    """
+    Passes the text of an HTML document to `write`, dropping tags, scripts
+    and styles.
+    """
+
+    def __init__(self, write):
+        super().__init__(convert_charrefs=True)
+        self.write = write
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "body":
+            self._skip = 0
+        elif tag in _skipped_tags:
+            self._skip += 1
+        elif tag in _block_tags:
+            self.write(" ")
+
+    def handle_endtag(self, tag):
+        if tag in _skipped_tags:
+            self._skip = max(0, self._skip - 1)
+        elif tag in _block_tags:
+            self.write(" ")
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.write(data)
+
+
+def _decoded_chunks(data, chunk_size=1 << 16):
+    # Decode base64 in slices so huge bodies never exist fully decoded when
+    # only their beginning is kept. chunk_size is a multiple of 4.
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start : start + chunk_size]
+        chunk += "=" * (-len(chunk) % 4)
+        yield decoder.decode(base64.urlsafe_b64decode(chunk))
+    yield decoder.decode(b"", final=True)
+
+
+class _BodyText:
+    def __init__(self, max_length):
+        self.max_length = max_length
+        self.pieces = []
+        # Length of the text once whitespace is collapsed, what the cap is
+        # applied to
+        self.length = 0
+        self._space = False
+
+    @property
+    def full(self):
+        return bool(self.max_length) and self.length >= self.max_length
+
+    def write(self, text):
+        self.pieces.append(text)
+        if not self.max_length:
+            return
+        words = text.split()
+        if not words:
+            self._space = self._space or bool(text)
+            return
+        if self.length and (self._space or text[0].isspace()):
+            self.length += 1
+        self.length += sum(map(len, words)) + len(words) - 1
+        self._space = text[-1].isspace()
+
+    def add_text(self, chunks):
+        for chunk in chunks:
+            self.write(chunk)
+            if self.full:
+                break
+        self.write(" ")
+
+    def add_html(self, chunks):
+        stripper = _TagStripper(self.write)
+        for chunk in chunks:
+            stripper.feed(chunk)
+            if self.full:
+                break
+        stripper.close()
+        self.write(" ")
+
+    def text(self):
+        if not self.pieces:
+            return None
+        return _process_content(self.pieces, self.max_length, separator="")
 
 
 def _decode_part(part_body, mime_type, content):
@@ -28,38 +133,90 @@ def _process_parts(parts, content):
     return content
 
 
-def _process_content(content):
-    combined_text = " ".join(content)
-    combined_text = (
-        combined_text.replace("\n", " ").replace("\r", " ").replace("\t", " ")
-    )
-    combined_text = re.sub(r"\s+", " ", combined_text)
-    return combined_text.strip()
-
-
-def get_email_body(payload):
-    content = []
+def _leaf_parts(payload):
     if "parts" in payload:
-        _process_parts(payload["parts"], content)
+        for part in payload["parts"]:
+            yield from _leaf_parts(part)
     elif "body" in payload and "data" in payload["body"]:
-        mime_type = payload.get("mimeType", "")
-        _decode_part(payload["body"], mime_type, content)
+        yield payload
 
-    if not content:
-        return None
 
-    return _process_content(content)
+def _process_content(content, max_length=0, separator=" "):
+    # str.split() without arguments splits on any whitespace run and drops
+    # leading and trailing whitespace, so this normalizes in a single pass
+    combined_text = " ".join(separator.join(content).split())
+    if max_length:
+        combined_text = combined_text[:max_length].rstrip()
+    return combined_text
+
+
+def get_email_body(payload, strategy=None, max_length=None):
+    """
+    Extract the text of a message payload.
+
+    Args:
+        payload: Payload of a Gmail message in full format
+        strategy: "html2text" converts every part, HTML through html2text;
+            "strip" converts every text part, HTML through a streaming tag
+            stripper; "plain" only uses the text/plain parts when there are
+            any and falls back to stripping the HTML ones
+        max_length: Maximum length of the returned text, 0 for no limit
+
+    Returns:
+        The body text with whitespace collapsed, or None without body parts
+    """
+    strategy = strategy or os.getenv("GMAIL_BODY_STRATEGY", "html2text")
+    if max_length is None:
+        max_length = int(os.getenv("GMAIL_BODY_MAX_LENGTH", "0"))
+
+    if strategy == "html2text":
+        content = []
+        if "parts" in payload:
+            _process_parts(payload["parts"], content)
+        elif "body" in payload and "data" in payload["body"]:
+            mime_type = payload.get("mimeType", "")
+            _decode_part(payload["body"], mime_type, content)
+
+        if not content:
+            return None
+
+        return _process_content(content, max_length)
+
+    if strategy not in body_strategies:
+        raise ValueError(f"Invalid body strategy: {strategy}")
+
+    parts = [
+        part
+        for part in _leaf_parts(payload)
+        if part.get("mimeType", "").startswith("text/") or not part.get("mimeType")
+    ]
+    if strategy == "plain":
+        plain_parts = [part for part in parts if part.get("mimeType") == "text/plain"]
+        parts = plain_parts or parts
+
+    body = _BodyText(max_length)
+    for part in parts:
+        try:
+            chunks = _decoded_chunks(part["body"]["data"])
+            if part.get("mimeType") == "text/html":
+                body.add_html(chunks)
+            else:
+                body.add_text(chunks)
+        except Exception as e:
+            print(f"Error decoding body: {e}")
+        if body.full:
+            break
+    return body.text()
 
 
 def _extract_email(address_field):
-    email_pattern = r"[\w\.-]+@[\w\.-]+"
-    match = re.search(email_pattern, address_field)
+    match = _email_pattern.search(address_field)
     if match:
         return match.group(0)
     return address_field
 
 
-def get_required_data(message):
+def get_required_data(message, body_strategy=None, max_body_length=None):
     payload = message["payload"]
     headers = {header["name"]: header["value"] for header in payload["headers"]}
     return {
@@ -71,9 +228,72 @@ def get_required_data(message):
         "subject": headers["Subject"],
         "to_address": _extract_email(headers["To"]),
         "labels": message.get("labelIds", []),
-        "body": get_email_body(payload),
+        "body": get_email_body(payload, body_strategy, max_body_length),
         "thread_id": message["threadId"],
     }
 
 
-__all__ = ["get_email_body", "get_required_data"]
+def parse_chunk(messages):
+    """Parse a chunk of messages in a worker, returns (rows, failed ids)."""
+    rows = []
+    failed = []
+    for message in messages:
+        try:
+            rows.append(get_required_data(message))
+        except Exception as e:
+            failed.append(message.get("id"))
+            print(f"Error parsing message {message.get('id')}: {e}")
+    return rows, failed
+
+
+def parse_messages_parallel(
+    messages, workers=None, chunksize=None, executor=None, onError=None
+):
+    """
+    Run get_required_data over messages in a pool of worker processes.
+
+    Messages are sent to the workers in chunks so the pickling round trip is
+    paid once per chunk rather than once per message. Messages that fail to
+    parse are logged, skipped and reported through onError.
+
+    Args:
+        messages: Iterable of Gmail message resources, consumed lazily
+        workers: Number of worker processes
+        chunksize: Number of messages sent to a worker at once
+        executor: Existing ProcessPoolExecutor to use instead of a new one
+        onError: Called with the ids of the messages of a chunk that failed to
+            parse
+
+    Yields:
+        The dicts get_required_data returns, in the order chunks complete
+    """
+    workers = workers or int(
+        os.getenv("PIPELINE_PARSE_WORKERS", str(os.cpu_count() or 1))
+    )
+    chunksize = chunksize or int(os.getenv("PARSE_CHUNK_SIZE", "50"))
+    messages = iter(messages)
+    own_executor = executor is None
+    executor = executor or ProcessPoolExecutor(max_workers=workers)
+    try:
+        pending = set()
+        while True:
+            # Two chunks per worker keep the pool busy while results come back
+            while len(pending) < workers * 2:
+                chunk = list(islice(messages, chunksize))
+                if not chunk:
+                    break
+                pending.add(executor.submit(parse_chunk, chunk))
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                rows, failed = future.result()
+                if failed and onError:
+                    onError(failed)
+                yield from rows
+    finally:
+        if own_executor:
+            executor.shutdown(cancel_futures=True)
+
+
+__all__ = ["get_email_body", "get_required_data", "parse_messages_parallel"]
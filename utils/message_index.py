@@ -0,0 +1,260 @@
+import calendar
+import pickle
+import sys
+from datetime import datetime, timedelta
+from utils.rules_and_actions import validate_condition
+from utils.rule_cache import compiled_rules
+from utils.rule_optimizer import _interval_pattern, optimize_rule
+
+
+def _epoch(value):
+    # Rows from get_required_data carry local time strings, rows read back from
+    # Postgres carry datetimes
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    return int(value.timestamp())
+
+
+def interval_start(now, value):
+    """
+    `now - interval 'value'` with Postgres calendar rules: months and years
+    move the month and clamp the day to the length of the target month.
+    """
+    count, unit = _interval_pattern.match(value).groups()
+    count = int(count)
+    if unit == "day":
+        return now - timedelta(days=count)
+    months = now.year * 12 + now.month - 1 - count * (12 if unit == "year" else 1)
+    year, month = divmod(months, 12)
+    day = min(now.day, calendar.monthrange(year, month + 1)[1])
+    return now.replace(year=year, month=month + 1, day=day)
+
+
+class MessageIndex:
+    """
+    Columnar in-memory copy of the rule relevant message fields.
+
+    Every column is a list indexed by row number. Senders and labels are
+    interned, since a mailbox has few distinct ones, `received_at` is kept as
+    integer epoch seconds and subject and body are kept both as written (for `is`)
+    and lowercased (for `contains`). Rows of removed messages are left empty
+    and skipped.
+    """
+
+    def __init__(self):
+        self.message_ids = []
+        self.positions = {}
+        self.from_address = []
+        self.subject = []
+        self.subject_lower = []
+        self.body = []
+        self.body_lower = []
+        self.received_at = []
+        self.labels = []
+        self._label_sets = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, message_id):
+        return message_id in self.positions
+
+    def _intern_labels(self, labels):
+        labels = frozenset(labels)
+        return self._label_sets.setdefault(labels, labels)
+
+    def add(self, email_data):
+        """Add or replace a message, given as a row of get_required_data."""
+        sender = email_data.get("from_address")
+        subject = email_data.get("subject")
+        body = email_data.get("body")
+        values = (
+            email_data["message_id"],
+            sys.intern(sender.lower()) if sender is not None else None,
+            subject,
+            subject.lower() if subject is not None else None,
+            body,
+            body.lower() if body is not None else None,
+            _epoch(email_data.get("received_at")),
+            self._intern_labels(email_data.get("labels") or []),
+        )
+        columns = (
+            self.message_ids,
+            self.from_address,
+            self.subject,
+            self.subject_lower,
+            self.body,
+            self.body_lower,
+            self.received_at,
+            self.labels,
+        )
+        row = self.positions.get(email_data["message_id"])
+        if row is None:
+            self.positions[email_data["message_id"]] = len(self.message_ids)
+            for column, value in zip(columns, values):
+                column.append(value)
+        else:
+            for column, value in zip(columns, values):
+                column[row] = value
+
+    def remove(self, message_id):
+        row = self.positions.pop(message_id, None)
+        if row is None:
+            return
+        self.message_ids[row] = None
+        self.from_address[row] = None
+        self.subject[row] = self.subject_lower[row] = None
+        self.body[row] = self.body_lower[row] = None
+        self.received_at[row] = None
+        self.labels[row] = None
+
+    def update_labels(self, message_id, add_labels=(), remove_labels=()):
+        row = self.positions.get(message_id)
+        if row is not None:
+            labels = (self.labels[row] | set(add_labels)) - set(remove_labels)
+            self.labels[row] = self._intern_labels(labels)
+
+    def rows(self):
+        return self.positions.values()
+
+    def match(self, rule, now=None):
+        """Ids of the messages matching a rule, the ones get_rule_matches finds."""
+        predicate = compiled_rules.get(rule, compile_optimized_rule)
+        if predicate is None:
+            return [self.message_ids[row] for row in self.rows()]
+        predicate = predicate(self, now or datetime.now())
+        return [self.message_ids[row] for row in self.rows() if predicate(row)]
+
+    def evaluate(self, rules, now=None):
+        """
+        Evaluate every rule in one pass, like GoogleDB.get_rule_matches.
+
+        Args:
+            rules: Rules as returned by load_rules
+            now: Time `received_at` intervals are counted back from
+
+        Returns:
+            List of (message_id, [indexes of the matched rules], [labels])
+        """
+        now = now or datetime.now()
+        predicates = []
+        for rule in rules:
+            predicate = compiled_rules.get(rule["rule"], compile_optimized_rule)
+            predicates.append(
+                (lambda row: True) if predicate is None else predicate(self, now)
+            )
+        matches = []
+        for row in self.rows():
+            matched = [
+                index for index, predicate in enumerate(predicates) if predicate(row)
+            ]
+            if matched:
+                labels = list(self.labels[row])
+                matches.append((self.message_ids[row], matched, labels))
+        return matches
+
+    def save(self, path):
+        with open(path, "wb") as file:
+            pickle.dump(self.__dict__, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with open(path, "rb") as file:
+            index.__dict__.update(pickle.load(file))
+        index.from_address = [
+            sys.intern(sender) if sender is not None else None
+            for sender in index.from_address
+        ]
+        return index
+
+    @classmethod
+    def from_rows(cls, rows):
+        index = cls()
+        for email_data in rows:
+            index.add(email_data)
+        return index
+
+
+def _compile_condition(condition):
+    validate_condition(condition)
+    field, operator, value = (
+        condition["field"],
+        condition["operator"],
+        condition["value"],
+    )
+
+    if field == "received_at":
+        def bind(index, now):
+            column = index.received_at
+            start = interval_start(now, value).timestamp()
+            if operator == "greater_than":
+                return lambda row: column[row] is not None and column[row] > start
+            return lambda row: column[row] is not None and column[row] < start
+
+        return bind
+
+    # Like the SQL backend: contains is case-insensitive and literal, is / is_not
+    # ignore case only for from_address, and a missing value matches nothing
+    if operator in ["contains", "not_contains"] or field == "from_address":
+        value = value.lower()
+        column_name = field if field == "from_address" else f"{field}_lower"
+    else:
+        column_name = field
+
+    def bind(index, now):
+        column = getattr(index, column_name)
+        if operator == "contains":
+            return lambda row: column[row] is not None and value in column[row]
+        if operator == "not_contains":
+            return lambda row: column[row] is not None and value not in column[row]
+        if operator == "is":
+            return lambda row: column[row] == value
+        return lambda row: column[row] is not None and column[row] != value
+
+    return bind
+
+
+def compile_rule(rule):
+    """
+    Compile a rule tree into a predicate over a MessageIndex.
+
+    The result mirrors process_rule: it is None when the rule has no
+    conditions (and matches every message), otherwise a function
+    `bind(index, now)` returning a `predicate(row)` for that index.
+
+    Raises:
+        ValueError for the rules process_rule rejects
+    """
+    if rule["type"] == "condition":
+        return _compile_condition(rule)
+    if rule["type"] != "rule":
+        return None
+
+    children = [compile_rule(curr_rule) for curr_rule in rule["rules"]]
+    if not children:
+        return None
+    if len(children) == 1:
+        return children[0]
+    if rule["predicate"] not in ["any", "all"]:
+        raise ValueError(f"Invalid predicate: {rule['predicate']}")
+    children = [child for child in children if child is not None]
+    if not children:
+        return None
+    combine = any if rule["predicate"] == "any" else all
+
+    def bind(index, now):
+        predicates = [child(index, now) for child in children]
+        return lambda row: combine(predicate(row) for predicate in predicates)
+
+    return bind
+
+
+def compile_optimized_rule(rule):
+    """compile_rule of the optimized rule, so cheap conditions short-circuit first."""
+    optimized = optimize_rule(rule)
+    if optimized is None:
+        return lambda index, now: lambda row: False
+    return compile_rule(optimized)
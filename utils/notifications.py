@@ -0,0 +1,142 @@
+import base64
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class PollingNotifier:
+    """
+    Polls the mailbox profile and reports a change when its history id moved.
+
+    Args:
+        gmail: GmailService to poll
+        interval: Seconds between polls
+    """
+
+    def __init__(self, gmail, interval=1.0):
+        self.gmail = gmail
+        self.interval = interval
+        self.history_id = None
+        self._stop = threading.Event()
+
+    def wait(self, timeout=None):
+        """
+        Wait up to `timeout` seconds for a change.
+
+        Returns:
+            {"historyId": ..., "received": monotonic time the change was seen},
+            or None when nothing changed
+        """
+        deadline = time.monotonic() + (timeout if timeout is not None else 1e9)
+        while not self._stop.is_set():
+            history_id = self.gmail.get_profile()["historyId"]
+            if history_id != self.history_id:
+                changed = self.history_id is not None
+                self.history_id = history_id
+                if changed:
+                    return {"historyId": history_id, "received": time.monotonic()}
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self._stop.wait(min(self.interval, remaining))
+        return None
+
+    def close(self):
+        self._stop.set()
+
+
+class QueueNotifier:
+    """
+    Local stand-in for Gmail's Pub/Sub notifications: `notify` queues a
+    notification and `wait` hands it to the daemon. Notifications arriving
+    while the daemon is busy are collapsed into one, since a single
+    incremental sync catches up with all of them.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def notify(self, history_id=None, email_address=None):
+        self._queue.put(
+            {
+                "emailAddress": email_address,
+                "historyId": history_id,
+                "received": time.monotonic(),
+            }
+        )
+
+    def wait(self, timeout=None):
+        try:
+            notification = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        while notification is not None:
+            try:
+                newer = self._queue.get_nowait()
+            except queue.Empty:
+                # Latency is counted from the oldest notification of the batch
+                return notification
+            if newer is None:
+                self._queue.put(None)
+                return notification
+            newer["received"] = notification["received"]
+            notification = newer
+        # Closed, wake up any other waiter too
+        self._queue.put(None)
+        return None
+
+    def close(self):
+        self._queue.put(None)
+
+
+class PushNotifier(QueueNotifier):
+    """
+    Receives Gmail notifications from a Cloud Pub/Sub push subscription.
+
+    Pub/Sub POSTs `{"message": {"data": base64 JSON}}` to the endpoint, where
+    the JSON is Gmail's `{"emailAddress": ..., "historyId": ...}`. Point the
+    push subscription of the topic given to GmailService.watch at
+    `http://<host>:<port>/`.
+
+    Args:
+        host: Interface to listen on
+        port: Port to listen on, 0 picks a free one
+    """
+
+    def __init__(self, host="0.0.0.0", port=8080):
+        super().__init__()
+        notifier = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                try:
+                    envelope = json.loads(self.rfile.read(length))
+                    data = json.loads(base64.b64decode(envelope["message"]["data"]))
+                except (ValueError, KeyError, TypeError) as e:
+                    print("Ignoring malformed push notification", e)
+                    # Acknowledge it anyway, Pub/Sub would retry it forever
+                    self.send_response(204)
+                    self.end_headers()
+                    return
+                notifier.notify(data.get("historyId"), data.get("emailAddress"))
+                self.send_response(204)
+                self.end_headers()
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        super().close()
@@ -0,0 +1,263 @@
+import os
+import queue
+import threading
+import time
+from dotenv import load_dotenv
+from utils.gmail import get_required_data, parse_messages_parallel
+
+load_dotenv()
+
+_done = object()
+
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def record(self, busy, error=False):
+        with self._lock:
+            self.busy += busy
+            if error:
+                self.errors += 1
+            else:
+                self.items += 1
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def throughput(self):
+        return self.items / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return (
+            f"{self.name}: {self.items} items in {self.elapsed:.2f}s "
+            f"({self.throughput:.1f}/s, busy {self.busy:.2f}s, {self.errors} errors)"
+        )
+
+
+class IngestPipeline:
+    """
+    Runs fetch, parse and store as concurrent stages connected by bounded
+    queues, so the network, the parser and the database work at the same time.
+
+    The fetch stage drains the message iterator (which does its own concurrent
+    fetching), `parse_workers` threads or processes turn messages into rows
+    and a single store stage hands the rows to the writer. A full queue blocks
+    the stage feeding it, so a slow stage throttles the ones before it.
+
+    Args:
+        writer: Object with an `add(email_data)` method, e.g. BufferedEmailWriter.
+            Its `flush_if_due()`, if any, is called while the store stage waits
+        parse_workers: Number of parser threads or processes
+        queue_size: Capacity of each queue between stages
+        parse: Function turning a Gmail message into the row the writer expects,
+            only used by the "thread" parse mode
+        parse_mode: "thread" to parse in threads, "process" to send chunks of
+            messages to a process pool and get around the GIL
+        index: Optional MessageIndex the store stage also adds every row to
+        onParseError: Called with the id of every message that failed to parse.
+            Such messages are skipped, parsing them again would fail the same
+            way
+    """
+
+    def __init__(
+        self,
+        writer,
+        parse_workers=None,
+        queue_size=None,
+        parse=None,
+        parse_mode=None,
+        index=None,
+        onParseError=None,
+    ):
+        self.writer = writer
+        self.index = index
+        self.onParseError = onParseError
+        self.parse_workers = parse_workers or int(
+            os.getenv("PIPELINE_PARSE_WORKERS", "2")
+        )
+        self.parse_mode = parse_mode or os.getenv("PIPELINE_PARSE_MODE", "thread")
+        if self.parse_mode not in ("thread", "process"):
+            raise ValueError(f"Invalid parse mode: {self.parse_mode}")
+        # Number of end markers between the stages
+        self._parsers = 1 if self.parse_mode == "process" else self.parse_workers
+        self.queue_size = queue_size or int(os.getenv("PIPELINE_QUEUE_SIZE", "200"))
+        self.parse = parse or get_required_data
+        self.stats = {name: StageStats(name) for name in ("fetch", "parse", "store")}
+        self.raw = queue.Queue(maxsize=self.queue_size)
+        self.parsed = queue.Queue(maxsize=self.queue_size)
+        self._stop = threading.Event()
+        self._error = None
+
+    def _put(self, target, item):
+        while not self._stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, source, idle=None):
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                if idle is not None:
+                    idle()
+        return _done
+
+    def _fail(self, error):
+        if self._error is None:
+            self._error = error
+        self._stop.set()
+
+    def _fetch(self, messages):
+        stats = self.stats["fetch"]
+        stats.started = time.monotonic()
+        iterator = iter(messages)
+        try:
+            while True:
+                started = time.monotonic()
+                message = next(iterator, _done)
+                if message is _done:
+                    break
+                stats.record(time.monotonic() - started)
+                if not self._put(self.raw, message):
+                    return
+        except Exception as e:
+            self._fail(e)
+        finally:
+            if hasattr(iterator, "close"):
+                # Stops the listing and fetch threads behind a generator source
+                iterator.close()
+            stats.finished = time.monotonic()
+            for _ in range(self._parsers):
+                self._put(self.raw, _done)
+
+    def _parse_worker(self):
+        stats = self.stats["parse"]
+        while True:
+            message = self._get(self.raw)
+            if message is _done:
+                break
+            started = time.monotonic()
+            try:
+                data = self.parse(message)
+            except Exception as e:
+                stats.record(time.monotonic() - started, error=True)
+                print(f"Error parsing message {message.get('id')}", e)
+                if self.onParseError:
+                    self.onParseError(message.get("id"))
+                continue
+            stats.record(time.monotonic() - started)
+            if not self._put(self.parsed, data):
+                break
+        self._put(self.parsed, _done)
+
+    def _raw_messages(self):
+        while True:
+            message = self._get(self.raw)
+            if message is _done:
+                return
+            yield message
+
+    def _parse_errors(self, message_ids):
+        for message_id in message_ids:
+            self.stats["parse"].record(0.0, error=True)
+            if self.onParseError:
+                self.onParseError(message_id)
+
+    def _parse_in_processes(self):
+        stats = self.stats["parse"]
+        try:
+            started = time.monotonic()
+            for data in parse_messages_parallel(
+                self._raw_messages(),
+                workers=self.parse_workers,
+                onError=self._parse_errors,
+            ):
+                stats.record(time.monotonic() - started)
+                if not self._put(self.parsed, data):
+                    break
+                started = time.monotonic()
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._put(self.parsed, _done)
+
+    def _parse(self):
+        stats = self.stats["parse"]
+        stats.started = time.monotonic()
+        if self.parse_mode == "process":
+            self._parse_in_processes()
+            stats.finished = time.monotonic()
+            return
+        workers = [
+            threading.Thread(target=self._parse_worker, daemon=True)
+            for _ in range(self.parse_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        stats.finished = time.monotonic()
+
+    def _store(self):
+        stats = self.stats["store"]
+        stats.started = time.monotonic()
+        remaining_workers = self._parsers
+        # Rows buffered by the writer are flushed on time even while the
+        # stream stalls
+        idle = getattr(self.writer, "flush_if_due", None)
+        try:
+            while remaining_workers:
+                data = self._get(self.parsed, idle)
+                if data is _done:
+                    remaining_workers -= 1
+                    if self._stop.is_set():
+                        break
+                    continue
+                started = time.monotonic()
+                self.writer.add(data)
+                if self.index is not None:
+                    self.index.add(data)
+                stats.record(time.monotonic() - started)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            stats.finished = time.monotonic()
+
+    def run(self, messages):
+        """
+        Push every message through the pipeline and wait for it to drain.
+
+        Raises:
+            The first error of the fetch or store stage, after all stages stopped
+        """
+        threads = [
+            threading.Thread(target=self._fetch, args=(messages,), daemon=True),
+            threading.Thread(target=self._parse, daemon=True),
+            threading.Thread(target=self._store, daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self._error is not None:
+            raise self._error
+        return self.stats
+
+    def report(self):
+        for stats in self.stats.values():
+            print(stats)
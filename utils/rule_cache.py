@@ -0,0 +1,74 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+_missing = object()
+
+
+def rule_key(rule):
+    """sha256 of the rule's normalized JSON, so key order and spacing don't matter."""
+    normalized = json.dumps(rule, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class CompiledRuleCache:
+    """
+    LRU cache of compiled rules, keyed by the compiler and the rule's content
+    hash. Any compiler works: process_rule for SQL text, compile_rule for
+    Python predicates. Safe to share between threads.
+
+    The content hash is computed on every lookup, so a rule edited in place
+    is compiled again rather than served stale.
+
+    Args:
+        maxsize: Number of compiled rules kept before the least recently used
+            one is evicted
+    """
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize or int(os.getenv("RULE_CACHE_SIZE", "256"))
+        self.hits = 0
+        self.misses = 0
+        self._compiled = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, rule, compiler):
+        key = (compiler.__module__, compiler.__qualname__, rule_key(rule))
+        with self._lock:
+            compiled = self._compiled.get(key, _missing)
+            if compiled is not _missing:
+                self._compiled.move_to_end(key)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+
+        # Compile outside the lock, invalid rules raise and are not cached
+        compiled = compiler(rule)
+        with self._lock:
+            self._compiled[key] = compiled
+            self._compiled.move_to_end(key)
+            while len(self._compiled) > self.maxsize:
+                self._compiled.popitem(last=False)
+        return compiled
+
+    def clear(self):
+        with self._lock:
+            self._compiled.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._compiled)
+
+    def __str__(self):
+        return (
+            f"compiled rules: {len(self)}/{self.maxsize} cached, "
+            f"{self.hits} hits, {self.misses} misses"
+        )
+
+
+compiled_rules = CompiledRuleCache()
@@ -0,0 +1,89 @@
+from utils.rules_and_actions import process_rule, process_action
+from utils.rule_cache import compiled_rules
+from utils.rule_optimizer import optimize_rule
+
+
+def load_rules(file_content):
+    """
+    Read the rules of a rules file.
+
+    Both the list format `{"rules": [{"name": ..., "rule": ..., "action": ...}]}`
+    and the single rule format `{"rule": ..., "action": ...}` are accepted.
+
+    Returns:
+        List of {"name", "rule", "action"} dicts in file order
+
+    Raises:
+        ValueError for entries that are not objects with a rule and an action
+    """
+    if not isinstance(file_content, dict):
+        raise ValueError("A rules file holds an object")
+    if "rules" in file_content:
+        entries = file_content["rules"]
+        if not isinstance(entries, list):
+            raise ValueError("rules must be a list of rules")
+    else:
+        entries = [file_content]
+
+    rules = []
+    for position, entry in enumerate(entries, start=1):
+        if not isinstance(entry, dict):
+            raise ValueError(f"Rule {position} is not an object: {entry!r}")
+        name = entry.get("name", f"rule {position}")
+        for key in ("rule", "action"):
+            if not isinstance(entry.get(key), dict):
+                raise ValueError(
+                    f"Rule {position} ({name}) needs a rule and an action, "
+                    f"its {key} is {entry.get(key)!r}"
+                )
+        rules.append({"name": name, "rule": entry["rule"], "action": entry["action"]})
+    return rules
+
+
+def rule_condition(rule):
+    # "true" for an empty rule, which matches every message, and "false" for a
+    # rule the optimizer found can never match
+    optimized = optimize_rule(rule)
+    if optimized is None:
+        return "false"
+    return process_rule(optimized) or "true"
+
+
+def get_rule_conditions(rules):
+    return [compiled_rules.get(rule["rule"], rule_condition) for rule in rules]
+
+
+def merge_actions(matches, rules):
+    """
+    Merge the actions of every rule a message matched into one label change.
+
+    Rules are applied in file order, so when two rules disagree about a label
+    the later one wins. When the labels a message has are known, labels it
+    already has are not added again and labels it lacks are not removed.
+
+    Args:
+        matches: Iterable of (message_id, [indexes of the matched rules],
+            [labels the message has] or None)
+        rules: Rules as returned by load_rules
+
+    Returns:
+        {message_id: (labels to add, labels to remove)} for messages with a
+        non-empty change
+    """
+    actions = [process_action(rule["action"]) for rule in rules]
+    changes = {}
+    for message_id, rule_indexes, labels in matches:
+        to_add, to_remove = set(), set()
+        for index in sorted(rule_indexes):
+            add_labels, remove_labels = actions[index]
+            to_add.difference_update(remove_labels)
+            to_remove.update(remove_labels)
+            to_remove.difference_update(add_labels)
+            to_add.update(add_labels)
+        if labels is not None:
+            to_add.difference_update(labels)
+            to_remove.intersection_update(labels)
+        if to_add or to_remove:
+            changes[message_id] = (to_add, to_remove)
+    return changes
+
@@ -0,0 +1,176 @@
+import re
+from utils.rules_and_actions import validate_condition
+
+_interval_pattern = re.compile(r"^(\d+) (day|month|year)s?$")
+# Shortest and longest length in days of one interval unit
+_unit_days = {"day": (1, 1), "month": (28, 31), "year": (365, 366)}
+
+# Estimated cost of a condition: indexed range and equality checks first,
+# trigram lookups on short columns next, and scans of whole bodies last
+_field_costs = {"received_at": 1, "from_address": 3, "subject": 3, "body": 6}
+
+
+def _empty():
+    return {"type": "rule", "predicate": "all", "rules": []}
+
+
+def _is_empty(rule):
+    return rule["type"] == "rule" and not rule["rules"]
+
+
+def _folds_case(condition):
+    return (
+        condition["operator"] in ["contains", "not_contains"]
+        or condition["field"] == "from_address"
+    )
+
+
+def _value(condition):
+    return condition["value"].lower() if _folds_case(condition) else condition["value"]
+
+
+def _key(rule):
+    if rule["type"] == "condition":
+        return rule["field"], rule["operator"], _value(rule)
+    return rule["predicate"], frozenset(_key(child) for child in rule["rules"])
+
+
+def _cost(rule):
+    if rule["type"] == "rule":
+        return sum(_cost(child) for child in rule["rules"])
+    field, operator = rule["field"], rule["operator"]
+    if field == "received_at" or (field == "from_address" and operator == "is"):
+        return 1
+    if operator in ["is", "is_not"]:
+        return 2
+    return _field_costs[field] + (1 if operator == "not_contains" else 0)
+
+
+def _interval_days(value):
+    count, unit = _interval_pattern.match(value).groups()
+    shortest, longest = _unit_days[unit]
+    return int(count) * shortest, int(count) * longest
+
+
+def _text_contradicts(conditions):
+    if len({_value(c) for c in conditions if c["operator"] == "is"}) > 1:
+        return True
+    for condition in conditions:
+        value = _value(condition)
+        for other in conditions:
+            other_value = other["value"].lower()
+            match condition["operator"], other["operator"]:
+                case "is", "is_not":
+                    if value == _value(other):
+                        return True
+                case "is", "contains":
+                    if other_value not in value.lower():
+                        return True
+                case "is", "not_contains":
+                    if other_value in value.lower():
+                        return True
+                case "contains", "not_contains":
+                    if other_value in value:
+                        return True
+    return False
+
+
+def _dates_contradict(conditions):
+    after = [c["value"] for c in conditions if c["operator"] == "greater_than"]
+    before = [c["value"] for c in conditions if c["operator"] == "less_than"]
+    # received_at > now() - after and received_at < now() - before can only
+    # both hold when `after` is the longer interval
+    return any(
+        _interval_days(a)[1] <= _interval_days(b)[0] for a in after for b in before
+    )
+
+
+def _contradicts(conditions):
+    by_field = {}
+    for condition in conditions:
+        by_field.setdefault(condition["field"], []).append(condition)
+    for field, field_conditions in by_field.items():
+        if field == "received_at":
+            if _dates_contradict(field_conditions):
+                return True
+        elif _text_contradicts(field_conditions):
+            return True
+    return False
+
+
+def _optimize(rule):
+    if rule["type"] == "condition":
+        validate_condition(rule)
+        return {
+            "type": "condition",
+            "field": rule["field"],
+            "operator": rule["operator"],
+            "value": rule["value"],
+        }
+    if rule["type"] != "rule":
+        # process_rule ignores unknown nodes
+        return _empty()
+
+    children = [_optimize(child) for child in rule["rules"]]
+    if len(children) == 1:
+        return children[0]
+    predicate = rule["predicate"]
+    if children and predicate not in ["any", "all"]:
+        raise ValueError(f"Invalid predicate: {predicate}")
+
+    # Like process_rule, groups without conditions are left out of their parent
+    children = [child for child in children if child is None or not _is_empty(child)]
+    if None in children:
+        if predicate == "all":
+            return None
+        children = [child for child in children if child is not None]
+        if not children:
+            return None
+    if not children:
+        return _empty()
+
+    flattened = []
+    seen = set()
+    for child in children:
+        nested = (
+            child["rules"]
+            if child["type"] == "rule" and child["predicate"] == predicate
+            else [child]
+        )
+        for grandchild in nested:
+            key = _key(grandchild)
+            if key not in seen:
+                seen.add(key)
+                flattened.append(grandchild)
+
+    if predicate == "all" and _contradicts(
+        [child for child in flattened if child["type"] == "condition"]
+    ):
+        return None
+    flattened.sort(key=_cost)
+    if len(flattened) == 1:
+        return flattened[0]
+    return {"type": "rule", "predicate": predicate, "rules": flattened}
+
+
+def optimize_rule(rule):
+    """
+    Rewrite a rule tree into an equivalent one that is cheaper to evaluate.
+
+    Nested groups with the same predicate are flattened, duplicate conditions
+    and groups are removed and the conditions of every group are ordered by
+    estimated cost, cheap and selective ones first. The rewritten rule
+    matches the same messages as the original under process_rule.
+
+    Args:
+        rule: Rule tree as found in the rules file
+
+    Returns:
+        The optimized rule tree, or None when the rule can never match (e.g.
+        `from_address is a` and `from_address is b` in an `all` group), so
+        the query can be skipped
+
+    Raises:
+        ValueError for the rules process_rule rejects
+    """
+    return _optimize(rule)
@@ -3,11 +3,11 @@ import re
 type_defs = {
     "text": {
         "allowed_operators": ["is", "is_not", "contains", "not_contains"],
-        "pattern": r".+",
+        "pattern": re.compile(r".+"),
     },
     "datetime": {
         "allowed_operators": ["greater_than", "less_than"],
-        "pattern": r"^\d+ (days|day|month|months|year|years)$",
+        "pattern": re.compile(r"^\d+ (days|day|month|months|year|years)$"),
     },
 }
 
@@ -36,21 +36,45 @@ def validate_condition(condition):
     operator = condition["operator"]
     if operator not in type_defs[col_type]["allowed_operators"]:
         raise ValueError(f"Invalid operator: {operator}")
-    if not re.match(type_defs[col_type]["pattern"], value):
+    if not type_defs[col_type]["pattern"].match(value):
         raise ValueError(f"Invalid value: {value}")
 
 
+def _quote(value):
+    return value.replace("'", "''")
+
+
+def _like_pattern(value):
+    # Match the value literally: % and _ are wildcards and \ is the default
+    # escape character of (i)like
+    escaped = value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return _quote(f"%{escaped}%")
+
+
+def _sql_column(condition):
+    # Email addresses are case-insensitive; comparing lower(from_address)
+    # also lets is / is_not use the lower(from_address) index of init.sql
+    if condition["field"] == "from_address" and condition["operator"] in ["is", "is_not"]:
+        return "lower(from_address)", f"lower('{_quote(condition['value'])}')"
+    return condition["field"], f"'{_quote(condition['value'])}'"
+
+
 def get_sql_condition(condition):
     validate_condition(condition)
+    # contains / not_contains stay plain ilike expressions so the pg_trgm GIN
+    # indexes of init.sql can serve them (for values of 3 characters or more)
     match condition["operator"]:
         case "contains":
-            return f"{condition['field']} ilike '%{condition['value']}%'"
+            return f"{condition['field']} ilike '{_like_pattern(condition['value'])}'"
         case "not_contains":
-            return f" ({condition['field']} not ilike '%{condition['value']}%')"
+            return (
+                f" ({condition['field']} not ilike "
+                f"'{_like_pattern(condition['value'])}')"
+            )
         case "is":
-            return f"{condition['field']} = '{condition['value']}'"
+            return "{} = {}".format(*_sql_column(condition))
         case "is_not":
-            return f"{condition['field']} != '{condition['value']}'"
+            return "{} != {}".format(*_sql_column(condition))
         case "greater_than":
             return f"{condition['field']} > now() - interval '{condition['value']}'"
         case "less_than":
@@ -0,0 +1,385 @@
+import threading
+from collections import deque
+from googleapiclient.errors import HttpError
+from utils.pipeline import IngestPipeline
+
+
+def onSuccess(_):
+    pass
+
+
+def onErrorEmailInsert(error):
+    print("Error inserting email information into our database", error)
+
+
+def onErrorLabelChange(error):
+    print("Error updating labels in our database", error)
+
+
+def onErrorEmailDelete(error):
+    print("Error deleting emails from our database", error)
+
+
+def onErrorCheckpoint(error):
+    print("Error saving the sync checkpoint", error)
+
+
+def onErrorStoredLookup(error):
+    print("Error looking up stored messages, fetching them in full", error)
+
+
+def collect_history_changes(history, labels=["INBOX"]):
+    """
+    Reduce Gmail history records to the net changes we have to apply.
+
+    Args:
+        history: Iterable of history records, oldest first
+        labels: Messages carrying all of these labels are the ones we store
+
+    Returns:
+        Tuple of (added message ids, deleted message ids,
+        {message_id: (labels added, labels removed)})
+    """
+    added = set()
+    deleted = set()
+    label_changes = {}
+
+    def in_scope(message_labels):
+        return all(label in message_labels for label in labels)
+
+    for record in history:
+        for item in record.get("messagesAdded", []):
+            message = item["message"]
+            if in_scope(message.get("labelIds", [])):
+                added.add(message["id"])
+                deleted.discard(message["id"])
+        for item in record.get("messagesDeleted", []):
+            message_id = item["message"]["id"]
+            deleted.add(message_id)
+            added.discard(message_id)
+            label_changes.pop(message_id, None)
+        for key, adding in (("labelsAdded", True), ("labelsRemoved", False)):
+            for item in record.get(key, []):
+                message = item["message"]
+                message_id = message["id"]
+                if message_id in deleted:
+                    continue
+                moved_into_scope = adding and any(
+                    label in labels for label in item.get("labelIds", [])
+                )
+                if moved_into_scope and in_scope(message.get("labelIds", [])):
+                    # Messages moved into scope are fetched as new ones
+                    added.add(message_id)
+                to_add, to_remove = label_changes.setdefault(message_id, (set(), set()))
+                for label in item.get("labelIds", []):
+                    if adding:
+                        to_add.add(label)
+                        to_remove.discard(label)
+                    else:
+                        to_remove.add(label)
+                        to_add.discard(label)
+
+    for message_id in added:
+        # Freshly fetched messages come with their current labels
+        label_changes.pop(message_id, None)
+    return added, deleted, label_changes
+
+
+def refresh_labels(gmail, db, stored_labels, index=None, onDone=None, onGaveUp=None):
+    """
+    Bring the labels of messages we already store up to date.
+
+    The messages are fetched in the minimal format, ids and labels only, so
+    a known message costs neither its body nor a parse.
+
+    Args:
+        stored_labels: {message_id: set of stored labels}
+        index: Optional MessageIndex to update along with the database
+        onDone: Called with the ids of the messages refreshed or no longer there
+        onGaveUp: Called with the ids of the messages still rate limited after
+            every retry, which were not refreshed
+
+    Returns:
+        Number of messages whose labels changed
+    """
+    relabeled = 0
+    for message in gmail.messages_batch_get(
+        stored_labels, format="minimal", onDropped=onDone, onGaveUp=onGaveUp
+    ):
+        message_id = message["id"]
+        labels = set(message.get("labelIds", []))
+        to_add = labels - stored_labels[message_id]
+        to_remove = stored_labels[message_id] - labels
+        if to_add or to_remove:
+            relabeled += 1
+            db.apply_label_changes(
+                [message_id],
+                sorted(to_add),
+                sorted(to_remove),
+                onSuccess=onSuccess,
+                onError=onErrorLabelChange,
+            )
+            if index is not None:
+                index.update_labels(message_id, to_add, to_remove)
+        if onDone:
+            onDone([message_id])
+    return relabeled
+
+
+class FullSyncCheckpoint:
+    """
+    Where an interrupted full sync resumes: the token of the first listing
+    page not yet entirely stored.
+
+    Pages are registered in listing order as they are listed, and their
+    message ids are marked done as the batches holding them are committed,
+    refreshed, or dropped by the fetch. Whenever the leading pages
+    are all done the checkpoint moves past them and is saved, so it is
+    written at most once per committed batch and never runs ahead of what
+    is stored. A batch that fails to commit or a message Gmail still rate
+    limits after every retry holds the checkpoint back, and is fetched again
+    on resume. Messages deleted meanwhile or that fail to parse are done,
+    fetching them again would fail the same way.
+
+    Args:
+        save: Called with (page_token, messages) every time the checkpoint moves
+        page_token: Token the listing starts from
+        messages: Messages listed before `page_token`
+    """
+
+    def __init__(self, save, page_token=None, messages=0):
+        self.save = save
+        self.page_token = page_token
+        self.messages = messages
+        # [ids not done yet, number of ids, token of the next page]
+        self._pages = deque()
+        self._page_of = {}
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self):
+        """Number of listed messages not stored yet, 0 once every page drained."""
+        with self._lock:
+            return sum(len(page[0]) for page in self._pages)
+
+    def listed(self, message_ids, next_page_token):
+        with self._lock:
+            page = [set(), len(message_ids), next_page_token]
+            for message_id in message_ids:
+                # Listing pages can overlap when mail arrives meanwhile
+                if message_id not in self._page_of:
+                    page[0].add(message_id)
+                    self._page_of[message_id] = page
+            self._pages.append(page)
+            self._advance()
+
+    def done(self, message_ids):
+        with self._lock:
+            for message_id in message_ids:
+                page = self._page_of.pop(message_id, None)
+                if page is not None:
+                    page[0].discard(message_id)
+            self._advance()
+
+    def _advance(self):
+        moved = False
+        while self._pages and not self._pages[0][0]:
+            _, count, next_page_token = self._pages.popleft()
+            self.page_token = next_page_token
+            self.messages += count
+            moved = True
+        if moved:
+            # Saved under the lock so checkpoints are written in order
+            self.save(self.page_token, self.messages)
+
+
+def full_sync(gmail, db, remainingMessages=100000, labels=["INBOX"], index=None):
+    """
+    Store every message of the mailbox, resuming an interrupted full sync.
+
+    Every listing page is checked against gmail.messages in one query: new
+    messages are fetched in full, the ones already stored only have their
+    labels refreshed. The listing position is checkpointed in
+    gmail.full_sync_progress as batches are committed. A full sync finding a
+    checkpoint lists from it and keeps the history id the interrupted one
+    started from.
+    """
+    progress = db.get_full_sync_progress(onError=onErrorCheckpoint)
+    if progress:
+        history_id = progress["history_id"]
+        print(
+            f"Resuming the full sync after {progress['messages']} messages "
+            f"(history id {history_id})..."
+        )
+    else:
+        # Take the checkpoint before listing, so changes made while the full
+        # sync runs are replayed by the next incremental sync instead of being
+        # lost.
+        history_id = gmail.get_profile()["historyId"]
+        print("Running a full sync...")
+
+    def save(page_token, messages):
+        db.set_full_sync_progress(
+            history_id,
+            page_token,
+            messages,
+            onSuccess=onSuccess,
+            onError=onErrorCheckpoint,
+        )
+
+    checkpoint = FullSyncCheckpoint(
+        save,
+        progress["page_token"] if progress else None,
+        progress["messages"] if progress else 0,
+    )
+    if not progress:
+        save(None, 0)
+    pager = None
+    if not (progress and progress["messages"] and not progress["page_token"]):
+        # Otherwise it was interrupted after the last page was stored
+        pager = gmail.message_pages(
+            checkpoint.page_token, remainingMessages - checkpoint.messages, labels
+        )
+    known = 0
+    relabeled = 0
+    # Ids to fetch again on resume, and ids skipped for good
+    unfetched = []
+    unparsed = []
+
+    def skip_unparsed(message_id):
+        unparsed.append(message_id)
+        checkpoint.done([message_id])
+
+    def message_ids():
+        nonlocal known, relabeled
+        for page in pager or []:
+            checkpoint.listed(page, page.next_page_token)
+            stored_labels = (
+                db.get_stored_labels(page, onError=onErrorStoredLookup) or {}
+            )
+            if stored_labels:
+                known += len(stored_labels)
+                relabeled += refresh_labels(
+                    gmail,
+                    db,
+                    stored_labels,
+                    index,
+                    onDone=checkpoint.done,
+                    onGaveUp=unfetched.extend,
+                )
+            yield from (
+                message_id for message_id in page if message_id not in stored_labels
+            )
+
+    try:
+        with db.writer(onError=onErrorEmailInsert, onCommit=checkpoint.done) as writer:
+            pipeline = IngestPipeline(writer, index=index, onParseError=skip_unparsed)
+            pipeline.run(
+                gmail.messages_batch_get(
+                    message_ids(),
+                    onDropped=checkpoint.done,
+                    onGaveUp=unfetched.extend,
+                )
+            )
+    finally:
+        if pager is not None:
+            pager.close()
+    pipeline.report()
+    print(
+        f"Full sync stored {writer.written} new messages, refreshed the labels "
+        f"of {known} stored ones ({relabeled} changed)"
+    )
+    if unparsed:
+        print(
+            f"Skipped {len(unparsed)} messages that could not be parsed: "
+            f"{', '.join(sorted(unparsed))}"
+        )
+    if checkpoint.pending:
+        # Failed batches and messages given up on hold the checkpoint back,
+        # the next sync resumes this one and fetches them again
+        print(
+            f"{checkpoint.pending} messages could not be fetched or stored, the "
+            "full sync is left unfinished"
+        )
+        return history_id
+    db.set_history_id(history_id, onSuccess=onSuccess, onError=onErrorCheckpoint)
+    db.clear_full_sync_progress(onSuccess=onSuccess, onError=onErrorCheckpoint)
+    return history_id
+
+
+def incremental_sync(gmail, db, history_id, labels=["INBOX"], index=None):
+    print(f"Running an incremental sync from history id {history_id}...")
+    added, deleted, label_changes = collect_history_changes(
+        gmail.history_list(history_id), labels
+    )
+    # Messages moved back into scope may still be stored
+    stored_labels = db.get_stored_labels(added, onError=onErrorStoredLookup) or {}
+    # Ids to fetch again by replaying the same history, and ids skipped for good
+    unfetched = []
+    unparsed = []
+    refresh_labels(gmail, db, stored_labels, index, onGaveUp=unfetched.extend)
+    with db.writer(onError=onErrorEmailInsert) as writer:
+        IngestPipeline(writer, index=index, onParseError=unparsed.append).run(
+            gmail.messages_batch_get(
+                added - stored_labels.keys(), onGaveUp=unfetched.extend
+            )
+        )
+    db.delete_emails(list(deleted), onSuccess=onSuccess, onError=onErrorEmailDelete)
+    if index is not None:
+        for message_id in deleted:
+            index.remove(message_id)
+        for message_id, (to_add, to_remove) in label_changes.items():
+            index.update_labels(message_id, to_add, to_remove)
+    for message_id, (to_add, to_remove) in label_changes.items():
+        db.apply_label_changes(
+            [message_id],
+            sorted(to_add),
+            sorted(to_remove),
+            onSuccess=onSuccess,
+            onError=onErrorLabelChange,
+        )
+
+    print(
+        f"Incremental sync: {len(added)} added, {len(deleted)} deleted, "
+        f"{len(label_changes)} relabeled"
+    )
+    if unparsed:
+        print(
+            f"Skipped {len(unparsed)} messages that could not be parsed: "
+            f"{', '.join(sorted(unparsed))}"
+        )
+    if writer.failed_batches or unfetched:
+        # Replaying the same history is harmless, losing the messages is not
+        print(
+            f"{writer.failed + len(unfetched)} messages could not be fetched or "
+            f"stored, keeping the checkpoint at history id {history_id} so the "
+            "next sync fetches them again"
+        )
+        return history_id
+    new_history_id = gmail.history_id or history_id
+    db.set_history_id(new_history_id, onSuccess=onSuccess, onError=onErrorCheckpoint)
+    return new_history_id
+
+
+def sync(
+    gmail, db, remainingMessages=100000, labels=["INBOX"], full=False, index=None
+):
+    """
+    Bring the database up to date with the mailbox.
+
+    Args:
+        index: Optional MessageIndex kept up to date along with the database,
+            so rules can be evaluated in process right after the sync
+    """
+    history_id = None if full else db.get_history_id(onError=onErrorCheckpoint)
+    if history_id and db.get_full_sync_progress(onError=onErrorCheckpoint):
+        # An interrupted full sync is finished before syncing incrementally
+        history_id = None
+    if history_id:
+        try:
+            return incremental_sync(gmail, db, history_id, labels, index)
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            print("History checkpoint has expired, falling back to a full sync...")
+    return full_sync(gmail, db, remainingMessages, labels, index)